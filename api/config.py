@@ -3,7 +3,7 @@ import os
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'K@35emzx%9%sco8H'
     MAP_CONFIG = {
-        "options": {"datadir": "/data"},
+        "options": {"datadir": "/data", "decimal_places": 1, "relative_paths": True},
         "srtm": {
             "options": {
                 "datadir": "/data/srtm",
@@ -11,11 +11,28 @@ class Config(object):
             },
             "data": {
                 "url_template": "https://e4ftl01.cr.usgs.gov/MEASURES/SRTMGL1.003/2000.02.11/<GRID>.SRTMGL1.hgt.zip",
-                "samples": 3601
+                "samples": 3601,
+                "feature_mm": 0.2,
+                "max_factor": 16,
+                "tolerance_mm": 0.1
             }
         },
         "overpass": {
-            "endpoint": "https://overpass-api.de/api/interpreter"
+            "endpoint": "https://overpass-api.de/api/interpreter",
+            "stream": True,
+            "format": "json",
+            "snapshots": "/data/cache/snapshots",
+            "cache": {
+                "dir": "/data/cache/overpass",
+                "ttl": 86400,
+                "max_size": 1024
+            },
+            "tile": 0.05,
+            "scheduler": {
+                "redis": "redis://redis:6379",
+                "slots": 2,
+                "retries": 5
+            }
         },
         "layers": {
             "forests": {
@@ -0,0 +1,134 @@
+# Compares fetching and loading the same region as Overpass XML and JSON
+#
+# e.g. python benchmark.py 51.40 -1.0 51.45 -0.92 --xml area.osm --json area.json
+#
+import os
+import time
+import copy
+import logging
+import logging.config
+from argparse import ArgumentParser
+import xml.etree.ElementTree as ET
+
+import common
+import osm
+import overpass
+
+
+def fetch(config, fmt, bbox, savefile=None):
+    log = logging.getLogger(__name__)
+    config = copy.deepcopy(config)
+    config["overpass"]["format"] = fmt
+    query = overpass.ovp_query(config, bbox)
+    log.info("Downloading {} data".format(fmt))
+    t = time.time()
+    data = overpass.ovp_download(config, query)
+    elapsed = time.time() - t
+    if savefile is not None:
+        with open(savefile, "wb") as f:
+            f.write(data)
+    return data, elapsed
+
+
+# Load the data the ways the worker can, returning the best time of each
+def time_loads(data, fmt, repeat):
+    times = {}
+    for i in range(repeat):
+        loads = {}
+        t = time.time()
+        osmap = osm.OSMData()
+        for j in range(0, len(data), osm.OSMData.CHUNK_SIZE):
+            osmap.feed(data[j:j + osm.OSMData.CHUNK_SIZE])
+        osmap.close()
+        loads["indexed"] = time.time() - t
+
+        if fmt == "xml":
+            # The original route, through an XML tree
+            t = time.time()
+            osmap = osm.OSMData()
+            osmap.fromXML(ET.fromstring(data))
+            loads["tree"] = time.time() - t
+
+        for name in loads:
+            if name not in times or loads[name] < times[name]:
+                times[name] = loads[name]
+    return times
+
+
+def main():
+    common.setup_logging()
+    log = logging.getLogger(__name__)
+
+    # Set up command line interface
+    parser = ArgumentParser()
+    parser.add_argument(
+            "min_lat",
+            type=float,
+            help="Minimum latitude"
+            )
+    parser.add_argument(
+            "min_lon",
+            type=float,
+            help="Minimum longitude"
+            )
+    parser.add_argument(
+            "max_lat",
+            type=float,
+            help="Maximum latitude"
+            )
+    parser.add_argument(
+            "max_lon",
+            type=float,
+            help="Maximum longitude"
+            )
+    parser.add_argument(
+            "--config",
+            dest="configfile",
+            default="conf/all.yaml",
+            help="Config file to use. Defaults to ./conf/all.yaml"
+            )
+    parser.add_argument(
+            "--repeat",
+            dest="repeat",
+            type=int,
+            default=3,
+            help="Number of times to load each response, the best is reported"
+            )
+    parser.add_argument(
+            "--xml",
+            dest="xmlfile",
+            help="Use this saved XML response rather than downloading (or save to it if it doesn't exist)"
+            )
+    parser.add_argument(
+            "--json",
+            dest="jsonfile",
+            help="Use this saved JSON response rather than downloading (or save to it if it doesn't exist)"
+            )
+
+    args = parser.parse_args()
+    config = common.load_config(os.path.abspath(args.configfile))
+    bbox = (args.min_lat, args.min_lon, args.max_lat, args.max_lon)
+
+    results = []
+    for fmt, filename in (("xml", args.xmlfile), ("json", args.jsonfile)):
+        if filename is not None and os.path.exists(filename):
+            log.info("Reading {} data from {}".format(fmt, filename))
+            with open(filename, "rb") as f:
+                data = f.read()
+            download = None
+        else:
+            data, download = fetch(config, fmt, bbox, filename)
+        for name, elapsed in time_loads(data, fmt, args.repeat).items():
+            results.append((fmt, name, len(data), download, elapsed))
+
+    print("{:<8}{:<10}{:>12}{:>12}{:>10}".format("format", "load", "bytes", "download", "load"))
+    for fmt, name, size, download, elapsed in results:
+        if download is None:
+            download = "-"
+        else:
+            download = "{:.2f}s".format(download)
+        print("{:<8}{:<10}{:>12}{:>12}{:>9.2f}s".format(fmt, name, size, download, elapsed))
+
+
+if __name__ == "__main__":
+    main()
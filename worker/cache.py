@@ -0,0 +1,129 @@
+import os
+import time
+import threading
+import gzip
+import logging
+import logging.config
+
+
+# A directory of gzip compressed files, each stored under a key.
+# Entries older than ttl seconds are treated as missing and the
+# least recently used are removed once the total size goes over
+# max_size bytes.  Several processes can share the directory: files
+# are written alongside then moved into place, and anything removed
+# by another process while in use is treated as a miss
+class FileCache(object):
+
+
+    # gzip level.  Higher levels save little on OSM XML and are much
+    # slower, which matters as responses are compressed as they arrive
+    COMPRESS_LEVEL = 3
+
+    def __init__(self, dirname, ttl=None, max_size=None):
+        self.dirname = os.path.abspath(dirname)
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(self.dirname, exist_ok=True)
+
+    def __path(self, key):
+        return os.path.join(self.dirname, key + ".gz")
+
+    # Returns a file to read the data stored under key, or None
+    def open(self, key):
+        log = logging.getLogger(__name__)
+        path = self.__path(key)
+        try:
+            stat = os.stat(path)
+            if self.ttl is not None and time.time() - stat.st_mtime > self.ttl:
+                log.info("Cache entry expired: " + key)
+                os.remove(path)
+                return None
+            f = gzip.open(path, "rb")
+            # Mark as used.  The modified time stays as the time
+            # it was stored, for the ttl
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            return None
+        log.info("Cache hit: " + key)
+        return f
+
+    # Returns the data stored under key, or None if there is none
+    def get(self, key):
+        f = self.open(key)
+        if f is None:
+            return None
+        try:
+            with f:
+                return f.read()
+        except (EOFError, OSError):
+            return None
+
+    def put(self, key, data):
+        writer = self.writer(key)
+        writer.write(data)
+        writer.commit()
+
+    # Returns a CacheWriter to store data under key as it arrives
+    def writer(self, key):
+        return CacheWriter(self, key, self.__path(key))
+
+    # Remove the least recently used entries until we fit in max_size
+    def evict(self):
+        log = logging.getLogger(__name__)
+        entries = []
+        total = 0
+        for name in os.listdir(self.dirname):
+            if not name.endswith(".gz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.dirname, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, name))
+            total += stat.st_size
+
+        entries.sort()
+        for atime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.dirname, name))
+                log.info("Evicted from cache: " + name)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+# Writes a cache entry a piece at a time.  Nothing is visible in the
+# cache until commit(), and abort() throws away what was written
+class CacheWriter(object):
+
+
+    def __init__(self, cache, key, path):
+        self.__cache = cache
+        self.__key = key
+        self.__path = path
+        # Unique to the thread as well as the process, as the parts of a
+        # query may be fetched on several threads
+        self.__tmpfile = path + ".tmp{}.{}".format(os.getpid(), threading.get_ident())
+        self.__file = gzip.open(self.__tmpfile, "wb", compresslevel=cache.COMPRESS_LEVEL)
+        self.size = 0
+
+    def write(self, data):
+        self.__file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        log = logging.getLogger(__name__)
+        self.__file.close()
+        os.replace(self.__tmpfile, self.__path)
+        log.info("Cached {} bytes as {}".format(self.size, self.__key))
+        if self.__cache.max_size is not None:
+            self.__cache.evict()
+
+    def abort(self):
+        self.__file.close()
+        try:
+            os.remove(self.__tmpfile)
+        except FileNotFoundError:
+            pass
@@ -7,9 +7,11 @@ import re
 import yaml
 from argparse import ArgumentParser
 import xml.etree.ElementTree as ET
+import numpy as np
 
 
 from common import setup_logging
+import pathdata
 
 
 # Reads the svg file stripping the default namespace
@@ -87,16 +89,153 @@ def set_bounds(svg, l, t, w, h):
     svg.attrib["height"] = str(round(h, 2)) + "mm"
 
 
+# A clipped path, kept as its points so that it can be written out
+# along with the others in one go
+class ClipPath(object):
+
+    def __init__(self):
+        self.points = []
+        self.lengths = []
+        self.closed = []
+
+    def add(self, cmnd, x, y):
+        if cmnd in "Mm" or len(self.lengths) == 0:
+            self.lengths.append(0)
+            self.closed.append(False)
+        elif self.closed[-1]:
+            # Carrying on from a closed subpath starts a new one
+            # from its start
+            start = len(self.points) - 2 * self.lengths[-1]
+            self.points.extend(self.points[start:start + 2])
+            self.lengths.append(1)
+            self.closed.append(False)
+        self.points.append(x)
+        self.points.append(y)
+        self.lengths[-1] += 1
+
+    # As for the list of a path with curves, "Z" closes the subpath
+    def append(self, cmnd):
+        if cmnd == "Z" and len(self.closed) > 0:
+            self.closed[-1] = True
+
+
+# Paths with curves are kept as a list of their parts
 def add_to_path(d, cmnd, x, y):
-    d.append(cmnd)
-    d.append(str(round(x, 2)))
-    d.append(str(round(y, 2)))
+    if type(d) is list:
+        d.append(cmnd)
+        d.append(str(round(x, 2)))
+        d.append(str(round(y, 2)))
+    else:
+        d.add(cmnd, x, y)
     return d
 
 
-def svg_clip(svg, left=None, top=None, width=None, height=None, decimal_places=1, pretty=True):
+# Does the path data have relative commands or a command repeated for
+# a run of points, which need spelling out before clipping?
+def is_compact(d, parts):
+    for cmnd in "mlzc":
+        if cmnd in d:
+            return True
+    return len(parts) != 3 * (d.count("M") + d.count("L")) + d.count("Z") + 7 * d.count("C")
+
+
+# Spell out the M, L and Z commands of a path as absolute commands,
+# each M and L with its own x, y, as the clipping expects
+def expand_path(parts):
+    expanded = []
+    cmnd = "M"
+    x = 0.0
+    y = 0.0
+    start_x = 0.0
+    start_y = 0.0
+    i = 0
+    while i < len(parts):
+        part = parts[i]
+        if part in "MLZmlz":
+            cmnd = part
+            if part in "Zz":
+                expanded.append("Z")
+                x = start_x
+                y = start_y
+            i += 1
+        elif part in "Cc":
+            # Curves are kept as they are
+            expanded.extend(parts[i:i + 7])
+            i += 7
+        else:
+            try:
+                next_x = float(parts[i])
+                next_y = float(parts[i + 1])
+            except (ValueError, IndexError):
+                expanded.append(part)
+                i += 1
+                continue
+            if cmnd in "ml":
+                next_x += x
+                next_y += y
+            x = next_x
+            y = next_y
+            if cmnd in "Mm":
+                expanded.append("M")
+                start_x = x
+                start_y = y
+                # Any more points are lines
+                cmnd = "L" if cmnd == "M" else "l"
+            else:
+                expanded.append("L")
+            expanded.append(str(x))
+            expanded.append(str(y))
+            i += 2
+    return expanded
+
+
+# The parts of the path data of subpaths of (n, 2) arrays of x, y and
+# whether each is closed, as expand_path gives them but with the
+# numbers left as they are rather than written out and read back
+def array_parts(subpaths):
+    parts = []
+    for points, closed in subpaths:
+        if len(points) == 0:
+            continue
+        cmnds = np.full(len(points), "L", dtype=object)
+        cmnds[0] = "M"
+        parts.extend(np.column_stack((cmnds, points.astype(object))).ravel().tolist())
+        if closed:
+            parts.append("Z")
+    return parts
+
+
+# Subpaths of arrays as a ClipPath, unclipped
+def array_path(subpaths):
+    d2 = ClipPath()
+    for points, closed in subpaths:
+        for i, (x, y) in enumerate(points.tolist()):
+            d2.add("L" if i > 0 else "M", x, y)
+        if closed:
+            d2.append("Z")
+    return d2
+
+
+# Clip the paths of the svg to the rectangle, or the viewBox if not
+# given.  The clipped paths are written to decimal_places and, with
+# relative, as moves from point to point
+def svg_clip(svg, left=None, top=None, width=None, height=None, decimal_places=1, pretty=True,
+             relative=False):
+    l, t, w, h = clip_bounds(get_bounds(svg), left, top, width, height, decimal_places)
+    set_bounds(svg, l,t,w,h)
+
+    # Get all the paths
+    clip_paths([path.attrib for path in svg.findall(".//path")], l, t, w, h,
+               decimal_places, relative)
+    if pretty:
+        svg = indent(svg)
+    return svg
+
+
+# The bounds l, t, w, h of an svg cut down to the rectangle, if given
+def clip_bounds(bounds, left=None, top=None, width=None, height=None, decimal_places=1):
     log = logging.getLogger(__name__)
-    l, t, w, h = get_bounds(svg)
+    l, t, w, h = bounds
     # Calculate the Union of the rectangles
     if left is None:
         left = l
@@ -124,17 +263,33 @@ def svg_clip(svg, left=None, top=None, width=None, height=None, decimal_places=1
     h = round(h, decimal_places)
 
     log.info("Clipping to: l: {}, t: {}, w: {}, h: {}".format(l, t, w, h))
-    set_bounds(svg, l,t,w,h)
+    return l, t, w, h
 
-    # Get all the paths
-    paths = svg.findall(".//path")
+
+# Clip the d of the attributes of each path to the bounds, moving them
+# so that l, t is at 0, 0.  The d is either path data or, as
+# svg.SVG.get_layers gives it, a list of subpaths as ((n, 2) array of
+# x, y, closed) tuples, which are written out once they are clipped
+def clip_paths(paths, l, t, w, h, decimal_places=1, relative=False):
+    log = logging.getLogger(__name__)
     log.info("Found {} paths".format(len(paths)))
+    # Only spend time on the messages for each point if they are shown
+    debug = log.isEnabledFor(logging.DEBUG)
+    clipped = []
     for path in paths:
-        d = str(path.attrib["d"])
-        parts = d.split()
+        if type(path["d"]) is list:
+            parts = array_parts(path["d"])
+        else:
+            d = str(path["d"])
+            parts = d.split()
+            if is_compact(d, parts):
+                parts = expand_path(parts)
 
         # Prepare for the start of a path
-        d2 = []  
+        if "C" in parts or "c" in parts:
+            d2 = []
+        else:
+            d2 = ClipPath()
         i = 0
         x = None
         y = None
@@ -178,7 +333,8 @@ def svg_clip(svg, left=None, top=None, width=None, height=None, decimal_places=1
                 if prev_x is not None and prev_y is not None and \
                     (x == prev_x and y == prev_y):
                     # We have not moved far enough away so drop the point
-                    log.debug("Point to close to last, dropping last: ({},{})  ({},{})".format(x, y, prev_x, prev_y))
+                    if debug:
+                        log.debug("Point to close to last, dropping last: ({},{})  ({},{})".format(x, y, prev_x, prev_y))
                 else:
                     # Are we within bounds?
                     bounds = x <= l + w and x >= l and y <= t + h and y >= t
@@ -276,7 +432,8 @@ def svg_clip(svg, left=None, top=None, width=None, height=None, decimal_places=1
                                 count += 1
                                 d2 = add_to_path(d2, "M", x - l, y - t)
                         else:
-                            log.debug("Starting point(s) outside bounds, dropping: {} {}".format(x,y))
+                            if debug:
+                                log.debug("Starting point(s) outside bounds, dropping: {} {}".format(x,y))
 
                     else:
                         # We already have at least one valid point in our path
@@ -321,7 +478,8 @@ def svg_clip(svg, left=None, top=None, width=None, height=None, decimal_places=1
                         elif bounds is False and prev_bounds is False:
                             # We have stayed outside bounds
                             count += 1
-                            log.debug("Dropping point outside bounds: {}, {}".format(x, y))
+                            if debug:
+                                log.debug("Dropping point outside bounds: {}, {}".format(x, y))
                         else:
                             log.error("This should be impossible!")
 
@@ -334,7 +492,8 @@ def svg_clip(svg, left=None, top=None, width=None, height=None, decimal_places=1
                             log.error("We appear to have crossed 3 or more boundaries - impossible!")
                         else:
                             log.debug("{} crossing points". format(count))
-                        log.debug("tx: {} bx: {} ly: {} ry: {}".format (tx,bx,ly,ry))
+                        if debug:
+                            log.debug("tx: {} bx: {} ly: {} ry: {}".format (tx,bx,ly,ry))
 
                 i += 3
 
@@ -358,13 +517,32 @@ def svg_clip(svg, left=None, top=None, width=None, height=None, decimal_places=1
                 i += 1
 
         if path_valid:
-            log.debug("Adding path: {}".format(d2))
-            path.attrib["d"] = " ".join(d2)
+            if debug:
+                log.debug("Adding path: {}".format(d2))
+            clipped.append((path, d2))
         else:
-            log.debug("Dropping empty path {}".format(d2))
-    if pretty:
-        svg = indent(svg)
-    return svg
+            if debug:
+                log.debug("Dropping empty path {}".format(d2))
+            if type(path["d"]) is list:
+                # Left as it is, as path data is, but written out
+                clipped.append((path, array_path(path["d"])))
+
+    # Write the clipped paths all in one go, apart from any with curves
+    written = []
+    for path, d2 in clipped:
+        if type(d2) is list:
+            path["d"] = " ".join(d2)
+        else:
+            written.append((path, d2))
+    if len(written) > 0:
+        points = np.fromiter((v for path, d2 in written for v in d2.points), dtype=np.float64)
+        data = pathdata.write_paths(points.reshape((-1, 2)),
+                                    [n for path, d2 in written for n in d2.lengths],
+                                    [c for path, d2 in written for c in d2.closed],
+                                    [len(d2.lengths) for path, d2 in written],
+                                    decimal_places, relative)
+        for (path, d2), d in zip(written, data):
+            path["d"] = d
                 
 
 def main():
@@ -404,6 +582,19 @@ def main():
             type=float,
             help="Height of the bounding box"
             )
+    parser.add_argument(
+            "--decimal_places",
+            dest="decimal_places",
+            type=int,
+            default=1,
+            help="Places after the decimal point of the path coordinates, defaults to 1"
+            )
+    parser.add_argument(
+            "--relative",
+            dest="relative",
+            action="store_true",
+            help="Write each point of the paths as a move from the last, making the file smaller"
+            )
         
     # Parse the command line
     args = parser.parse_args()
@@ -420,7 +611,8 @@ def main():
     svg = svg_read(svgfile)
 
     # Clip the svg
-    new_svg = svg_clip(svg, args.left, args.top, args.width, args.height)
+    new_svg = svg_clip(svg, args.left, args.top, args.width, args.height,
+                       decimal_places=args.decimal_places, relative=args.relative)
 
     # Write out the svg file
     svg_write(new_svg, outputfile)
@@ -9,6 +9,7 @@ import re
 import xml.etree.ElementTree as ET
 
 import common
+import osm
 import srtm
 
 
@@ -16,6 +17,9 @@ def osm_read(filename):
     log = logging.getLogger(__name__)
     log.info("Reading OSM file from " + filename)
     filename = os.path.abspath(filename)
+    if os.path.isdir(filename):
+        # A snapshot saved by OSMData.save()
+        return osm.OSMData(filename)
     with open(filename, "r") as f:
         osm_string = f.read()
     # Strip the default namespace so we don't prefix every tag with ns0
@@ -26,14 +30,19 @@ def osm_read(filename):
 def osm_write(root, filename):
     log = logging.getLogger(__name__)
     log.info("Writing OSM file with contours to " + filename)
+    if type(root) == osm.OSMData:
+        # Snapshots are written back as snapshots
+        root.save(filename)
+        return
     tree = ET.ElementTree(root)
     with open(filename, "wb") as f:
         tree.write(f, encoding="UTF-8", xml_declaration=True)
 
 
-def add_contours(config, interval, minlat, minlon, maxlat, maxlon, osm):
-    # Build the contours from the SRTM data
-    contours = srtm.contour(config, interval, minlat, minlon, maxlat, maxlon)
+def add_contours(config, interval, minlat, minlon, maxlat, maxlon, osm, x_mm=None, y_mm=None):
+    # Build the contours from the SRTM data, at no more detail than
+    # can be drawn at x_mm by y_mm
+    contours = srtm.contour(config, interval, minlat, minlon, maxlat, maxlon, x_mm, y_mm)
 
     # Remove the bounds tag so we can iterate through all others
     bounds = contours.find("./bounds")
@@ -51,7 +60,7 @@ def main():
     parser = ArgumentParser()
     parser.add_argument(
             "osmfile",
-            help="The OSM filename to which you want to add contours"
+            help="The OSM filename (or snapshot directory) to which you want to add contours"
             )
     parser.add_argument(
             "outfile",
@@ -97,11 +106,14 @@ def main():
     osm = osm_read(osmfile)
 
     # Get the bounds of the file
-    bounds = osm.find("./bounds")
-    minlat = float(bounds.attrib["minlat"])
-    minlon = float(bounds.attrib["minlon"])
-    maxlat = float(bounds.attrib["maxlat"])
-    maxlon = float(bounds.attrib["maxlon"])
+    if isinstance(osm, ET.Element):
+        bounds = osm.find("./bounds").attrib
+    else:
+        bounds = osm.bounds
+    minlat = float(bounds["minlat"])
+    minlon = float(bounds["minlon"])
+    maxlat = float(bounds["maxlat"])
+    maxlon = float(bounds["maxlon"])
     log.info("Read bonds from OSM file: {} {} {} {}".format(minlat, minlon,
         maxlat, maxlon))
 
@@ -15,11 +15,14 @@ import xml.etree.ElementTree as ET
 
 import common
 import overpass
-import contours
+import scheduler
+import srtm
 import svgmap
 
 
-def run_job(config, jobspec, osmfile=None):
+# Makes the map of the jobspec, written to out, a binary file, as it is
+# made if given, otherwise returned as an element (as the api wants)
+def run_job(config, jobspec, osmfile=None, out=None):
     host = socket.gethostname()
     log = logging.getLogger(__name__)
     file_handler = RotatingFileHandler(
@@ -32,6 +35,8 @@ def run_job(config, jobspec, osmfile=None):
     log.addHandler(file_handler)
     log.setLevel(logging.INFO)
     t_start = time.time()
+    hits = overpass.cache_stats["hits"]
+    misses = overpass.cache_stats["misses"]
 
     if "user" in jobspec:
         if "email" in jobspec["user"] and "name" in jobspec["user"]:
@@ -82,34 +87,46 @@ def run_job(config, jobspec, osmfile=None):
     # Time the setup stage
     t_setup = time.time() - t_start
 
-    # Get the data from overpass
-    osm = overpass.get_osm(minlat, minlon, maxlat, maxlon, config)
+    # Get the data from overpass, timing the waits of this job's
+    # requests for a slot
+    stream = "stream" in config["overpass"] and config["overpass"]["stream"]
+    with scheduler.timing() as clock:
+        osm = overpass.get_osm(minlat, minlon, maxlat, maxlon, config, stream=stream)
 
     # Save the osm data if needed
     if osmfile is not None:
-        with open(osmfile, "wb") as f:
-            tree = ET.ElementTree(osm)
-            tree.write(f, encoding="UTF-8", xml_declaration=True)
+        if isinstance(osm, ET.Element):
+            with open(osmfile, "wb") as f:
+                tree = ET.ElementTree(osm)
+                tree.write(f, encoding="UTF-8", xml_declaration=True)
+        else:
+            osm.write(osmfile)
 
-    # Time the overpass stage
-    t_overpass = time.time() - t_start - t_setup
+    # Time the overpass stage, less any time spent waiting for the server
+    t_wait = clock.wait
+    t_overpass = time.time() - t_start - t_setup - t_wait
             
-    # Get the contour lines if wanted
+    # Get the contour lines if wanted, as arrays to go straight
+    # into the svg rather than through the OSM data
+    lines = None
     if "contours" in jobspec["layers"]:
-        contours.add_contours(config["srtm"], interval, minlat, minlon, maxlat, maxlon, osm)
+        lines = list(srtm.contour_lines(config["srtm"], interval, minlat, minlon, maxlat, maxlon,
+                                        x_mm, y_mm))
 
     # Time the contours stage
-    t_contours = time.time() -t_start - t_setup - t_overpass
+    t_contours = time.time() -t_start - t_setup - t_wait - t_overpass
 
     # Create the svg map
-    svg = svgmap.osm_to_svg(osm, config, x_mm, y_mm)
+    svg = svgmap.osm_to_svg(osm, config, x_mm, y_mm, lines=lines, out=out)
 
     # Time the svg stage
-    t_svg = time.time() - t_start - t_setup - t_overpass - t_contours
+    t_svg = time.time() - t_start - t_setup - t_wait - t_overpass - t_contours
 
     
     t_end = time.time() - t_start
-    log.info("total: {:.3f}, setup: {:.3f}, overpass: {:.3f}, contours: {:.3f}, svg: {:.3f}".format(t_end, t_setup, t_overpass, t_contours, t_svg))
+    hits = overpass.cache_stats["hits"] - hits
+    misses = overpass.cache_stats["misses"] - misses
+    log.info("total: {:.3f}, setup: {:.3f}, wait: {:.3f}, overpass: {:.3f}, contours: {:.3f}, svg: {:.3f}, cache hits: {}, misses: {}".format(t_end, t_setup, t_wait, t_overpass, t_contours, t_svg, hits, misses))
 
     return svg
 
@@ -180,13 +197,10 @@ def main():
     with open(jobfile, "r") as f:
         jobspec = json.load(f)
 
-    # Create the svg
-    svg = run_job(config, jobspec, osmfile)
-
-    # Write it to disk
-    job = os.path.splitext(jobfile)[0]
-    svgfile = job + ".svg"
-    svgmap.svg_write(svg, svgfile)
+    # Create the svg, writing it to disk as it goes
+    log.info("Writing svg file to " + svgfile)
+    with open(svgfile, "wb") as f:
+        run_job(config, jobspec, osmfile, out=f)
     
 
 
@@ -0,0 +1,259 @@
+import logging
+import logging.config
+from collections import deque
+
+import numpy as np
+
+
+# Marching squares for many contour levels at once.  Each cell of the
+# grid is visited once and emits segments for every level that crosses
+# it, so the work grows with the cells plus the vertices of the
+# contours rather than the cells times the levels.  The segments are
+# made and joined up just as skimage.measure.find_contours does (with
+# its default fully_connected="low"), so the contours are the same,
+# point for point and in the same order
+
+
+# The edges of a cell that a contour crosses
+TOP = 0
+BOTTOM = 1
+LEFT = 2
+RIGHT = 3
+
+# The segments of each case of a cell, as (from, to) edges in the
+# order that find_contours makes them.  The case has a bit set for
+# each corner above the level: 1 upper left, 2 upper right, 4 lower
+# left and 8 lower right.  Only the saddles (6 and 9) have two
+CASES = {
+    1: [(TOP, LEFT)],
+    2: [(RIGHT, TOP)],
+    3: [(RIGHT, LEFT)],
+    4: [(LEFT, BOTTOM)],
+    5: [(TOP, BOTTOM)],
+    6: [(RIGHT, TOP), (LEFT, BOTTOM)],
+    7: [(RIGHT, BOTTOM)],
+    8: [(BOTTOM, RIGHT)],
+    9: [(TOP, LEFT), (BOTTOM, RIGHT)],
+    10: [(BOTTOM, TOP)],
+    11: [(BOTTOM, LEFT)],
+    12: [(LEFT, RIGHT)],
+    13: [(TOP, RIGHT)],
+    14: [(LEFT, TOP)],
+}
+
+# CASES as arrays indexed by case and segment
+SEGMENTS = np.array([len(CASES.get(case, [])) for case in range(16)])
+FROM = np.zeros((16, 2), dtype=np.int64)
+TO = np.zeros((16, 2), dtype=np.int64)
+for case in CASES:
+    for i, (a, b) in enumerate(CASES[case]):
+        FROM[case, i] = a
+        TO[case, i] = b
+
+
+# Rows of cells read from the image at a time
+BAND = 256
+
+# The most crossings of cells by levels joined up at a time.  The
+# levels are taken in batches of about this many crossings, so that
+# a noisy image crossed by many levels in every cell doesn't need them
+# all at once
+BATCH = 1 << 20
+
+
+# Returns the contours of image at each of levels (in ascending order)
+# as a list with one entry per level.  Each entry is a list of (n, 2)
+# arrays of row, column as given by find_contours(image, level)
+def find_contours(image, levels):
+    return list(iter_contours(image, levels))
+
+
+# As find_contours, but yields the entry for each level in turn, so
+# that they can be used without holding the contours of every level.
+# The image is read a band of rows at a time, so it can be a memory
+# map of a whole tile
+def iter_contours(image, levels):
+    log = logging.getLogger(__name__)
+    image = np.asanyarray(image)
+    levels = np.asarray(levels, dtype=np.float64)
+    if image.ndim != 2 or image.shape[0] < 2 or image.shape[1] < 2:
+        raise ValueError("Input array must be 2D and at least 2x2")
+
+    # A level crosses a cell unless all of the corners are above it
+    # or all are at or below it, so the levels crossing each cell are
+    # a run of the sorted levels, from first for count.  Cells with a
+    # NaN corner are skipped
+    rows = image.shape[0] - 1
+    width = image.shape[1] - 1
+    small = np.min_scalar_type(len(levels))
+    first = np.empty((rows, width), dtype=small)
+    count = np.empty((rows, width), dtype=small)
+    crossings = np.zeros(len(levels) + 1, dtype=np.int64)
+    for row in range(0, rows, BAND):
+        band = np.asarray(image[row:row + BAND + 1], dtype=np.float64)
+        low = np.minimum(np.minimum(band[:-1, :-1], band[:-1, 1:]),
+                         np.minimum(band[1:, :-1], band[1:, 1:]))
+        high = np.maximum(np.maximum(band[:-1, :-1], band[:-1, 1:]),
+                          np.maximum(band[1:, :-1], band[1:, 1:]))
+        low = np.searchsorted(levels, low, "left")
+        high = np.searchsorted(levels, high, "left")
+        first[row:row + BAND] = low
+        count[row:row + BAND] = high - low
+        crossings += np.bincount(low.ravel(), minlength=len(levels) + 1) - \
+            np.bincount(high.ravel(), minlength=len(levels) + 1)
+
+    # Batches of levels with about BATCH crossings
+    crossings = np.cumsum(crossings[:-1])
+    log.debug("{} cell crossings of {} levels".format(crossings.sum(), len(levels)))
+    batches = [0]
+    total = 0
+    for i, n in enumerate(crossings.tolist()):
+        if total + n > BATCH and i > batches[-1]:
+            batches.append(i)
+            total = 0
+        total += n
+    batches.append(len(levels))
+    return (contours for lo, hi in zip(batches[:-1], batches[1:])
+            for contours in contour_batch(image, levels, first, count, lo, hi))
+
+
+# The contours of the levels from lo up to hi, as lists of arrays
+# for each level in turn.  first and count are the levels crossing
+# each cell, as found by iter_contours
+def contour_batch(image, levels, first, count, lo, hi):
+    width = image.shape[1] - 1
+    index = []
+    starts = []
+    ends = []
+    for row in range(0, image.shape[0] - 1, BAND):
+        # The levels of the batch crossing each cell of the band
+        low = np.maximum(first[row:row + BAND].ravel().astype(np.int64), lo)
+        n = np.minimum(first[row:row + BAND].ravel().astype(np.int64) +
+                       count[row:row + BAND].ravel(), hi) - low
+        cells = np.flatnonzero(n > 0)
+        if len(cells) == 0:
+            continue
+        low = low[cells]
+        n = n[cells]
+
+        # One entry for each level crossing each cell, grouped by level
+        # with the cells in row major order within each
+        cells = np.repeat(cells, n)
+        level = np.repeat(low - np.cumsum(n) + n, n) + np.arange(len(cells))
+        order = np.argsort(level, kind="stable")
+        cells = cells[order]
+        level = level[order]
+
+        band = np.asarray(image[row:row + BAND + 1], dtype=np.float64)
+        r0, c0 = np.divmod(cells, width)
+        a = band[r0, c0]
+        b = band[r0, c0 + 1]
+        c = band[r0 + 1, c0]
+        d = band[r0 + 1, c0 + 1]
+        height = levels[level]
+        case = (a > height) + 2 * (b > height) + 4 * (c > height) + 8 * (d > height)
+
+        # The segments, in the order find_contours makes them
+        owner = np.repeat(np.arange(len(cells)), SEGMENTS[case])
+        k = np.arange(len(owner)) - np.repeat(np.cumsum(SEGMENTS[case]) - SEGMENTS[case], SEGMENTS[case])
+        r0 = (r0 + row).astype(np.float64)[owner]
+        c0 = c0.astype(np.float64)[owner]
+        corners = (a[owner], b[owner], c[owner], d[owner], height[owner])
+        index.append(level[owner])
+        starts.append(edge_points(FROM[case[owner], k], r0, c0, *corners))
+        ends.append(edge_points(TO[case[owner], k], r0, c0, *corners))
+
+    if len(index) == 0:
+        for i in range(lo, hi):
+            yield []
+        return
+    # The bands in turn are in row major order, so keep them so within
+    # each level
+    index = np.concatenate(index)
+    order = np.argsort(index, kind="stable")
+    index = index[order]
+    starts = np.concatenate(starts)[order]
+    ends = np.concatenate(ends)[order]
+    del order
+
+    # Number the points, so that they are joined up by number rather
+    # than by comparing coordinates.  Points are the same when their
+    # coordinates are exactly equal, as they are for find_contours
+    coords, ids = np.unique(np.concatenate((starts, ends)).view(np.complex128),
+                            return_inverse=True)
+    del starts, ends
+    coords = np.column_stack((coords.real, coords.imag))
+    ids = ids.reshape((2, -1)).tolist()
+
+    # Join up the segments of each level in turn
+    bounds = np.searchsorted(index, np.arange(lo, hi + 1), "left")
+    for i in range(hi - lo):
+        segments = zip(ids[0][bounds[i]:bounds[i + 1]], ids[1][bounds[i]:bounds[i + 1]])
+        yield [coords[c] for c in assemble(segments)]
+
+
+# Where the level crosses the given edges of cells with top left corner
+# r0, c0 and corners a, b, c and d, as (n, 2) row, column
+def edge_points(edge, r0, c0, a, b, c, d, level):
+    t = fraction(np.choose(edge, (a, c, a, b)), np.choose(edge, (b, d, c, d)), level)
+    across = edge < LEFT
+    points = np.empty((len(edge), 2))
+    points[:, 0] = r0 + (edge == BOTTOM) + np.where(across, 0.0, t)
+    points[:, 1] = c0 + (edge == RIGHT) + np.where(across, t, 0.0)
+    return points
+
+
+# Where along an edge from a corner of value start to one of value
+# end the level is, as find_contours does
+def fraction(start, end, level):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(end == start, 0.0, (level - start) / (end - start))
+
+
+# Join (from, to) segments of points end to end into contours, as
+# find_contours does.  The contours are returned as arrays of their
+# points, in the order of their first segment
+def assemble(segments):
+    current = 0
+    contours = {}
+    starts = {}
+    ends = {}
+    for start, end in segments:
+        # A corner exactly on the level gives a zero length segment,
+        # which the neighbouring cells pick up
+        if start == end:
+            continue
+        tail, tail_num = starts.pop(end, (None, None))
+        head, head_num = ends.pop(start, (None, None))
+        if tail is not None and head is not None:
+            if tail is head:
+                # Close a contour
+                head.append(end)
+            elif tail_num > head_num:
+                # Join two contours, keeping the one made first
+                head.extend(tail)
+                contours.pop(tail_num, None)
+                starts[head[0]] = (head, head_num)
+                ends[head[-1]] = (head, head_num)
+            else:
+                tail.extendleft(reversed(head))
+                starts.pop(head[0], None)
+                contours.pop(head_num, None)
+                starts[tail[0]] = (tail, tail_num)
+                ends[tail[-1]] = (tail, tail_num)
+        elif tail is None and head is None:
+            # A new contour
+            contour = deque((start, end))
+            contours[current] = contour
+            starts[start] = (contour, current)
+            ends[end] = (contour, current)
+            current += 1
+        elif head is None:
+            # Add to the start of a contour
+            tail.appendleft(start)
+            starts[start] = (tail, tail_num)
+        else:
+            # Add to the end of a contour
+            head.append(end)
+            ends[end] = (head, head_num)
+    return [np.array(contour) for _, contour in sorted(contours.items())]
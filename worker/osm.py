@@ -1,9 +1,16 @@
 import os
 import sys
+import re
+import codecs
 import logging
 import logging.config
 import yaml
+import json
+import shutil
 import xml.etree.ElementTree as ET
+from array import array
+from collections import namedtuple
+import numpy as np
 from pyproj import CRS, Transformer
 
 # Representation of an OSM node
@@ -68,8 +75,8 @@ class Node (object):
     def toXML(self, parent):
         if self.id is not None:
             attrs = {"id": self.id,
-                     "lat": self.lat,
-                     "lon": self.lon
+                     "lat": str(self.lat),
+                     "lon": str(self.lon)
                     }
             ET.SubElement(parent, "node", attrs)
         return parent
@@ -81,6 +88,7 @@ class Way (list):
 
     def __init__(self, id=None, xml=None):
         self.__id = id
+        self.tags = {}
         if xml is not None:
             self.fromXML(xml)
 
@@ -100,12 +108,14 @@ class Way (list):
     def fromXML(self, element):
         if element is not None and element.tag == "way":
             self.__id = element.attrib["id"]
-            for nd in element.findall("./nd"):
-                self.append(nd.attrib["ref"])
+            for child in element:
+                if child.tag == "nd":
+                    self.append(child.attrib["ref"])
+                elif child.tag == "tag":
+                    self.tags[child.attrib["k"]] = child.attrib["v"]
         else:
             raise ValueError
 
-    # Very minimal XML missing all of the tags from the original data!
     def toXML(self, parent):
         if self.__id is not None:
             attrs = {"id": self.__id}
@@ -113,6 +123,8 @@ class Way (list):
             for ref in self:
                 attrs = {"ref": ref}
                 ET.SubElement(way, "nd", attrs)
+            for k in self.tags:
+                ET.SubElement(way, "tag", {"k": k, "v": self.tags[k]})
         return parent
 
 
@@ -128,10 +140,13 @@ class Member(object):
 class Relation(object):
 
 
-    def __init__(self, id):
+    def __init__(self, id=None, xml=None):
         self.__id = id
         self.__members = []
         self.__by_role = {}
+        self.tags = {}
+        if xml is not None:
+            self.fromXML(xml)
 
     @property
     def id(self):
@@ -171,248 +186,1096 @@ class Relation(object):
         else:
             raise ValueError
 
+    def fromXML(self, element):
+        if element is not None and element.tag == "relation":
+            self.__id = element.attrib["id"]
+            for child in element:
+                if child.tag == "member":
+                    self.add(Member(child.attrib["type"],
+                                    child.attrib["ref"],
+                                    child.attrib["role"]))
+                elif child.tag == "tag":
+                    self.tags[child.attrib["k"]] = child.attrib["v"]
+        else:
+            raise ValueError
+
+    def toXML(self, parent):
+        if self.__id is not None:
+            rel = ET.SubElement(parent, "relation", {"id": self.__id})
+            for member in self.__members:
+                attrs = {"type": member.type,
+                         "ref": member.ref,
+                         "role": member.role
+                        }
+                ET.SubElement(rel, "member", attrs)
+            for k in self.tags:
+                ET.SubElement(rel, "tag", {"k": k, "v": self.tags[k]})
+        return parent
+
+
+
+# Turn a config source ("key" or "key=value") into the tags to select
+def make_query(feature, source):
+    log = logging.getLogger(__name__)
+    tags = None
+    if "=" in source:
+        parts = source.split("=")
+        if len(parts) != 2:
+            log.error("Unable to correctly parse kv pair from " + source)
+        else:
+            tags = {parts[0]: parts[1]}
+    else:
+        tags = {source: None}
+    if tags is not None and feature == "relation":
+        # Only multipolygons can be assembled into complex areas
+        tags["type"] = "multipolygon"
+    log.info("Source: {}, Tags: {}".format(source, tags))
+    return tags
+
+# Map each layer to a list of (feature, tags) queries for OSMData.classify
+def make_rules(layers):
+    log = logging.getLogger(__name__)
+    rules = {}
+    for name in layers:
+        rules[name] = []
+        for shape in ["ways", "areas", "complex"]:
+            if shape in layers[name]:
+                log.info("Processing " + shape + " for layer " + name)
+                for source in layers[name][shape]:
+                    log.info("Using source " + source)
+                    if shape == "complex":
+                        feature = "relation"
+                    else:
+                        feature = "way"
+                    tags = make_query(feature, layers[name][shape][source])
+                    if tags is not None:
+                        rules[name].append((feature, tags))
+    return rules
+
+
+# Does a feature with tags match a (feature, tags) rule's tags?
+# A rule value of None matches any value for that key, as in select()
+def match_tags(query, tags):
+    for k in query:
+        if k not in tags or (query[k] is not None and tags[k] != query[k]):
+            return False
+    return True
+
+
+# A problem found while joining the member ways of a relation into rings
+# problem is one of:
+#   bad_role     the member is neither "inner" nor "outer"
+#   missing_way  the member way is not in the data
+#   short_way    the member way has fewer than 2 nodes
+#   branched     more than two ways meet at a junction
+#   unclosed     the ring could not be closed
+RingDiagnostic = namedtuple("RingDiagnostic", ["relation", "role", "way", "problem"])
+
+
+# Whitespace and commas between the elements of Overpass JSON
+JSON_SEPARATORS = re.compile(r"[\s,]*")
+
+# Bump this if the layout of a saved snapshot changes
+SNAPSHOT_VERSION = 1
+
+
+# Is dirname a snapshot that this version can read?
+def is_snapshot(dirname):
+    metafile = os.path.join(dirname, "meta.json")
+    if not os.path.isfile(metafile):
+        return False
+    with open(metafile) as f:
+        meta = json.load(f)
+    return "version" in meta and meta["version"] == SNAPSHOT_VERSION
+
+
+# Splits an (n, 2) array of lat, lon at each run of missing (NaN)
+# positions, as left by bbox limited geometry.  Returns the pieces with
+# two or more points
+def split_gaps(points):
+    present = ~np.isnan(points[:, 0])
+    edges = np.diff(np.concatenate(([0], present.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return [points[s:e] for s, e in zip(starts, ends) if e - s > 1]
+
+
+# Clips a ring of lat, lon to the bbox (minlat, minlon, maxlat, maxlon).
+# The ring may have gaps of missing (NaN) positions, which must be
+# outside the bbox, and is taken to join its last point to its first.
+# Each gap is replaced by the edge of the bbox between where the ring
+# leaves and comes back, going the shorter way round, then the ring is
+# clipped (Sutherland-Hodgman) so that anything else outside follows
+# the edge too.  Returns the closed ring, or None if none of it is inside
+def clip_ring(points, bbox):
+    present = ~np.isnan(points[:, 0])
+    if not present.any():
+        return None
+    if present.all():
+        ring = points
+    else:
+        # Start at the start of a run of positions
+        first = np.flatnonzero(present & ~np.roll(present, 1))[0]
+        points = np.roll(points, -first, axis=0)
+        present = np.roll(present, -first)
+        edges = np.diff(np.concatenate(([0], present.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        parts = []
+        for i in range(len(starts)):
+            run = points[starts[i]:ends[i]]
+            # Along the edge of the bbox to the next run
+            a = _clamp(run[-1], bbox)
+            b = _clamp(points[starts[(i + 1) % len(starts)]], bbox)
+            parts += [run, [a], _walk(a, b, bbox), [b]]
+        ring = np.concatenate(parts)
+
+    minlat, minlon, maxlat, maxlon = bbox
+    for axis, value, below in ((0, minlat, False), (0, maxlat, True),
+                               (1, minlon, False), (1, maxlon, True)):
+        ring = _clip_edge(ring, axis, value, below)
+    if len(ring) < 3:
+        return None
+    if (ring[0] != ring[-1]).any():
+        ring = np.concatenate((ring, ring[:1]))
+    return ring
+
+
+# The nearest point on the edge of the bbox to a point outside it
+def _clamp(point, bbox):
+    minlat, minlon, maxlat, maxlon = bbox
+    return np.array([min(max(point[0], minlat), maxlat), min(max(point[1], minlon), maxlon)])
+
+
+# The corners of the bbox passed going the shorter way round its edge
+# between the points a and b on it
+def _walk(a, b, bbox):
+    minlat, minlon, maxlat, maxlon = bbox
+    w = maxlon - minlon
+    h = maxlat - minlat
+    length = 2 * (w + h)
+
+    # Distance along the edge anticlockwise from the south west corner
+    def along(p):
+        if p[0] <= minlat:
+            return p[1] - minlon
+        elif p[1] >= maxlon:
+            return w + p[0] - minlat
+        elif p[0] >= maxlat:
+            return w + h + maxlon - p[1]
+        else:
+            return 2 * w + h + maxlat - p[0]
+
+    corners = np.array([[minlat, maxlon], [maxlat, maxlon], [maxlat, minlon], [minlat, minlon]])
+    position = np.array([w, w + h, 2 * w + h, 0])
+    ahead = (along(b) - along(a)) % length
+    if ahead <= length / 2:
+        distance = (position - along(a)) % length
+        passed = (distance > 0) & (distance < ahead)
+    else:
+        distance = (along(a) - position) % length
+        passed = (distance > 0) & (distance < length - ahead)
+    return corners[passed][np.argsort(distance[passed])].reshape((-1, 2))
+
+
+# One step of Sutherland-Hodgman: keeps the part of a ring on one side
+# (below or not) of the line where column axis is value, with points
+# added where the ring crosses it
+def _clip_edge(ring, axis, value, below):
+    if len(ring) == 0:
+        return ring
+    if below:
+        inside = ring[:, axis] <= value
+    else:
+        inside = ring[:, axis] >= value
+    prev = np.roll(ring, 1, axis=0)
+    cross = inside != np.roll(inside, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (value - prev[:, axis]) / (ring[:, axis] - prev[:, axis])
+        meet = prev + t[:, np.newaxis] * (ring - prev)
+    meet[:, axis] = value
+    points = np.stack((meet, ring), axis=1).reshape((-1, 2))
+    keep = np.stack((cross, inside), axis=1).ravel()
+    return points[keep]
 
 
 class OSMData(object):
 
 
-    def __init__(self, filename=None):
+    # Size of the blocks fed to the parser when streaming from a file
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, filename=None, stream=False):
         self.__root = None
         self.__bounds = None
-        self.__nodes = {}
-        self.__ways = {}
+        self.__parser = None
+        self.__parse_root = None
+        self.__depth = 0
+        self.__json = None
+        self.__remark = None
+        self.__remarks = []
+
+        # Columnar store, built from the load buffers when first needed
+        # Nodes: ids sorted for searchsorted lookup with an (n, 2) array of lat, lon
+        # Ways: ids sorted, with offsets into an array of node indexes
+        self.__node_ids = np.empty(0, dtype=np.int64)
+        self.__latlon = np.empty((0, 2), dtype=np.float64)
+        self.__way_ids = np.empty(0, dtype=np.int64)
+        self.__way_offsets = np.zeros(1, dtype=np.int64)
+        self.__way_index = np.empty(0, dtype=np.int64)
         self.__relations = {}
+
+        # Inverted tag index, built as the data is loaded
+        # (key, value) -> ids and (key, None) -> ids for each feature type
+        self.__tag_index = {"way": {}, "relation": {}}
+        self.__clear_buffers()
+
         if filename is not None:
-            self.load(filename)
+            self.load(filename, stream)
 
 
     @property
     def bounds(self):
         return self.__bounds
 
+    # Any remark (e.g. a timeout) Overpass made about the data of the last
+    # incremental load
+    @property
+    def remark(self):
+        return self.__remark
+
+    # The remarks of all of the loads, e.g. of each part of a split query
+    @property
+    def remarks(self):
+        return self.__remarks
+
+    @bounds.setter
+    def bounds(self, bounds):
+        if type(bounds) == dict and \
+                "minlat" in bounds and \
+                "minlon" in bounds and \
+                "maxlat" in bounds and \
+                "maxlon" in bounds:
+            self.__bounds = bounds
+        else:
+            raise ValueError
+
 
-    def load(self, filename):
+    def load(self, filename, stream=False):
         log = logging.getLogger(__name__)
         fullpath = os.path.abspath(filename)
 
-        # Parse the file
-        log.info("Reading data file: " + fullpath)
-        tree = ET.parse(fullpath)
-        self.__root =  tree.getroot()
-        self.fromXML(self.__root)
+        if os.path.isdir(fullpath):
+            # A snapshot saved by save()
+            self.load_snapshot(fullpath)
+        elif stream or fullpath.endswith(".json"):
+            # Index the file as it is read, never holding the whole tree
+            log.info("Streaming data file: " + fullpath)
+            with open(fullpath, "rb") as f:
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                    self.feed(chunk)
+            self.close()
+            if self.__bounds is None:
+                # Overpass JSON has no bounds, so take them from the
+                # extent of the nodes
+                self.__bounds = self.__extent()
+        else:
+            # Parse the file
+            log.info("Reading data file: " + fullpath)
+            tree = ET.parse(fullpath)
+            self.fromXML(tree.getroot())
 
 
     def fromXML(self, root):
         log = logging.getLogger(__name__)
         self.__root = root
 
-        # Get the bounding box from the data file
-        b = self.__root.find("./bounds")
-        self.__bounds = {
-                "minlat": b.attrib["minlat"],
-                "minlon": b.attrib["minlon"],
-                "maxlat": b.attrib["maxlat"],
-                "maxlon": b.attrib["maxlon"]
-                }
+        log.info("Indexing data...")
+        for element in self.__root:
+            self.__index(element)
+        self.__build()
         log.info("Geographic bounds of the data: " + str(self.__bounds))
 
-        self.__parse_ways()
 
-    # Parse the ways into lists of Nodes
-    # Then place them into a dictionary referenced by ID
-    def __parse_ways(self):
-        log = logging.getLogger(__name__)
-        log.info("Indexing ways...")
-        # Index node data by id for fast lookup
-        nodes = self.__root.findall("./node")
-        for node in nodes:
-            n = Node()
-            n.fromXML(node)
-            self.__nodes[n.id] = n
-
-        # Index way data by id for fast lookup
-        ways = self.__root.findall("./way")
-        for way in ways:
-            wy = Way()
-            wy.fromXML(way)
-            self.__ways[wy.id] = wy
-
-
-    # Pulls together a list of nodes that for the way
-    def path(self, way_id):
+    # Incremental loading.  Data can be fed in as it arrives, e.g. from a
+    # file or a network response.  Each top level element is indexed then
+    # dropped as soon as it is complete, so no tree is ever kept.
+    # Overpass JSON ([out:json]) is recognised by its opening "{",
+    # anything else is taken to be XML
+    def feed(self, data):
+        if self.__parser is None and self.__json is None:
+            self.__remark = None
+            if bytes(data[:64]).lstrip()[:1] == b"{":
+                self.__json = {"utf8": codecs.getincrementaldecoder("utf-8")(),
+                               "decoder": json.JSONDecoder(),
+                               "pieces": [], "size": 0, "retry": 0,
+                               "state": "head"}
+            else:
+                self.__parser = ET.XMLPullParser(events=("start", "end"))
+                self.__parse_root = None
+                self.__depth = 0
+        if self.__json is not None:
+            self.__feed_json(self.__json["utf8"].decode(data))
+        else:
+            self.__parser.feed(data)
+            self.__read_events()
 
-        path = []
-        if way_id in self.__ways:
-            for nid in self.__ways[way_id]:
-                path.append(self.__nodes[nid])
-        else: 
-            raise ValueError
 
-        return path
+    # Finish an incremental load started by feed().  With build=False
+    # the data is left in the load buffers, e.g. while more parts of the
+    # same area are to come, until it is first used
+    def close(self, build=True):
+        log = logging.getLogger(__name__)
+        if self.__parser is not None:
+            self.__parser.close()
+            self.__read_events()
+            self.__parser = None
+            self.__parse_root = None
+        elif self.__json is not None:
+            self.__feed_json(self.__json["utf8"].decode(b"", final=True), final=True)
+            state = self.__json["state"]
+            rest = "".join(self.__json["pieces"])
+            self.__json = None
+            if state != "tail":
+                raise ValueError("Incomplete JSON data")
+            # Anything after the elements is more of the outer object
+            rest = json.loads("{" + rest.lstrip().lstrip(","))
+            if "remark" in rest:
+                self.__remark = rest["remark"]
+        else:
+            return
+        if build:
+            self.__build()
+            log.info("Indexed {} nodes, {} ways, {} relations".format(
+                len(self.__node_ids), len(self.__way_ids), len(self.__relations)))
+        if self.__remark is not None:
+            self.__remarks.append(self.__remark)
+            log.warning("Overpass remark: " + self.__remark)
+
+
+    # Pick the elements out of Overpass JSON one at a time, leaving any
+    # incomplete one at the end until the rest of it arrives.  The text
+    # is kept as the pieces it arrived in, and only joined up to try
+    # again once it has doubled in size, so an element spread over many
+    # chunks doesn't cost a join and a failed decode for each of them
+    def __feed_json(self, text, final=False):
+        state = self.__json
+        state["pieces"].append(text)
+        state["size"] += len(text)
+        if state["size"] < state["retry"] and not final:
+            return
+        text = "".join(state["pieces"])
+        pos = 0
+        if state["state"] == "head":
+            m = re.search(r'"elements"\s*:\s*\[', text)
+            if m is not None:
+                pos = m.end()
+                state["state"] = "elements"
+        while state["state"] == "elements":
+            pos = JSON_SEPARATORS.match(text, pos).end()
+            if pos == len(text):
+                break
+            if text[pos] == "]":
+                pos += 1
+                state["state"] = "tail"
+                break
+            try:
+                element, pos = state["decoder"].raw_decode(text, pos)
+            except json.JSONDecodeError:
+                break
+            self.__index_json(element)
+        rest = text[pos:]
+        state["pieces"] = [rest]
+        state["size"] = len(rest)
+        state["retry"] = 2 * len(rest)
+
+
+    # As __index, for an element of Overpass JSON
+    def __index_json(self, element):
+        if element["type"] == "node":
+            self.__buf_node_ids.append(element["id"])
+            self.__buf_latlon.append(element["lat"])
+            self.__buf_latlon.append(element["lon"])
+        elif element["type"] == "way":
+            wid = element["id"]
+            refs = element["nodes"]
+            self.__buf_way_refs.extend(refs)
+            self.__buf_way_ids.append(wid)
+            self.__buf_way_lengths.append(len(refs))
+            if "geometry" in element:
+                # Inline geometry (out geom).  With a bbox, positions
+                # outside it are null
+                for ref, point in zip(refs, element["geometry"]):
+                    if point is not None:
+                        self.__buf_node_ids.append(ref)
+                        self.__buf_latlon.append(point["lat"])
+                        self.__buf_latlon.append(point["lon"])
+            if "tags" in element:
+                tags = element["tags"]
+                for k in tags:
+                    self.__add_tag("way", wid, k, tags[k])
+        elif element["type"] == "relation":
+            # Ids are kept as strings, as they are when read from XML
+            rel = Relation(str(element["id"]))
+            if "tags" in element:
+                rel.tags = element["tags"]
+            for member in element["members"]:
+                rel.add(Member(member["type"], str(member["ref"]), member["role"]))
+            self.add_relation(rel)
+
+
+    def __read_events(self):
+        for event, element in self.__parser.read_events():
+            if event == "start":
+                self.__depth += 1
+                if self.__depth == 1:
+                    self.__parse_root = element
+            else:
+                self.__depth -= 1
+                if self.__depth == 1:
+                    self.__index(element)
+                    # Release the element (and its children) now indexed
+                    self.__parse_root.clear()
+
+
+    # Add a single top level element (node, way, relation or bounds).
+    # Mirrors ET.Element.append so that OSMData can be used in its place
+    def append(self, element):
+        if self.__root is not None:
+            self.__root.append(element)
+        self.__index(element)
+
+
+    # Bulk loading from arrays, e.g. from a local extract
+    # ids and latlon are array-likes of node ids and (n, 2) lat, lon
+    def add_nodes(self, ids, latlon):
+        self.__buf_node_ids.frombytes(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+        self.__buf_latlon.frombytes(np.ascontiguousarray(latlon, dtype=np.float64).tobytes())
+
+
+    # Ways are given as ids, the number of nodes in each and the node ids
+    # of all of the ways joined together.  tags is a list of dicts, one per way
+    def add_ways(self, ids, lengths, refs, tags=None):
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        self.__buf_way_ids.frombytes(ids.tobytes())
+        self.__buf_way_lengths.frombytes(np.ascontiguousarray(lengths, dtype=np.int64).tobytes())
+        self.__buf_way_refs.frombytes(np.ascontiguousarray(refs, dtype=np.int64).tobytes())
+        if tags is not None:
+            for wid, wtags in zip(ids.tolist(), tags):
+                for k in wtags:
+                    self.__add_tag("way", wid, k, wtags[k])
+
+
+    # Take in the data of another OSMData, e.g. one part of a split
+    # query loaded on its own while the others download.  other must
+    # have been loaded with close(build=False), and is left empty
+    def merge(self, other):
+        self.__buf_node_ids.extend(other.__buf_node_ids)
+        self.__buf_latlon.extend(other.__buf_latlon)
+        self.__buf_way_ids.extend(other.__buf_way_ids)
+        self.__buf_way_lengths.extend(other.__buf_way_lengths)
+        self.__buf_way_refs.extend(other.__buf_way_refs)
+        index = self.__tag_index["way"]
+        for key, ids in other.__tag_index["way"].items():
+            if key not in index:
+                index[key] = list(ids)
+            else:
+                if type(index[key]) is not list:
+                    # Still a view into a snapshot
+                    index[key] = index[key].tolist()
+                index[key].extend(ids)
+        for relation in other.__relations.values():
+            self.add_relation(relation)
+        self.__remarks.extend(other.__remarks)
+        other.__init__()
+
+
+    # As with nodes and ways, the first copy of a repeated relation wins
+    def add_relation(self, relation):
+        if type(relation) != Relation:
+            raise ValueError
+        rid = int(relation.id)
+        if rid in self.__relations:
+            return
+        self.__relations[rid] = relation
+        for k in relation.tags:
+            self.__add_tag("relation", rid, k, relation.tags[k])
+
+
+    # Gather node, way and relation data into the load buffers
+    def __index(self, element):
+        if element.tag == "node":
+            self.__buf_node_ids.append(int(element.attrib["id"]))
+            self.__buf_latlon.append(float(element.attrib["lat"]))
+            self.__buf_latlon.append(float(element.attrib["lon"]))
+        elif element.tag == "way":
+            wid = int(element.attrib["id"])
+            count = 0
+            for child in element:
+                if child.tag == "nd":
+                    ref = int(child.attrib["ref"])
+                    self.__buf_way_refs.append(ref)
+                    count += 1
+                    if "lat" in child.attrib:
+                        # Inline geometry (out geom)
+                        self.__buf_node_ids.append(ref)
+                        self.__buf_latlon.append(float(child.attrib["lat"]))
+                        self.__buf_latlon.append(float(child.attrib["lon"]))
+                elif child.tag == "tag":
+                    self.__add_tag("way", wid, child.attrib["k"], child.attrib["v"])
+            self.__buf_way_ids.append(wid)
+            self.__buf_way_lengths.append(count)
+        elif element.tag == "relation":
+            self.add_relation(Relation(xml=element))
+        elif element.tag == "remark":
+            self.__remark = element.text
+        elif element.tag == "bounds":
+            # Get the bounding box from the data file
+            self.__bounds = {
+                    "minlat": element.attrib["minlat"],
+                    "minlon": element.attrib["minlon"],
+                    "maxlat": element.attrib["maxlat"],
+                    "maxlon": element.attrib["maxlon"]
+                    }
 
 
-    # Returns a list of Nodes that match the xpath
-    def get_nodes(self, xpath):
-        nodes = []
-        for node in self.__root.findall(xpath):
-            if node.tag == "node":
-                nid = node.attrs["id"]
-                nodes.append(self.__nodes[nid])
+    def __add_tag(self, feature, fid, k, v):
+        index = self.__tag_index[feature]
+        for key in ((k, v), (k, None)):
+            if key in index:
+                if type(index[key]) is not list:
+                    # Still a view into a snapshot
+                    index[key] = index[key].tolist()
+                index[key].append(fid)
             else:
-                raise ValueError
+                index[key] = [fid]
+
+
+    # The tags of each way, rebuilt from the tag index
+    def __way_tags(self):
+        tags = {}
+        for (k, v), ids in self.__tag_index["way"].items():
+            if v is not None:
+                for wid in ids:
+                    if wid in tags:
+                        tags[wid][k] = v
+                    else:
+                        tags[wid] = {k: v}
+        return tags
+
 
-        return nodes
+    def __clear_buffers(self):
+        self.__buf_node_ids = array("q")
+        self.__buf_latlon = array("d")
+        self.__buf_way_ids = array("q")
+        self.__buf_way_lengths = array("q")
+        self.__buf_way_refs = array("q")
 
 
-    # Returns a list of lists of Nodes
-    # Each sublist defines a way
-    def get_ways(self, xpath):
-        ways = []
-        for way in self.__root.findall(xpath):
-            if way.tag == "way":
-                wid = way.attrib["id"]
-                ways.append(self.path(wid))
+    # Merge anything in the load buffers into the columnar store
+    def __build(self):
+        log = logging.getLogger(__name__)
+        if len(self.__buf_node_ids) == 0 and len(self.__buf_way_ids) == 0:
+            return
+
+        # Ways already in the store refer to nodes by index, so
+        # take them back to ids before the node arrays are rebuilt
+        old_refs = self.__node_ids[self.__way_index]
+        old_lengths = np.diff(self.__way_offsets)
+
+        # Nodes, sorted by id.  The first copy of a repeated id wins.
+        # Places kept for missing nodes are left out, to be made again
+        # below if the new data doesn't have them either
+        known = ~np.isnan(self.__latlon[:, 0])
+        node_ids = np.concatenate((self.__node_ids[known],
+            np.frombuffer(self.__buf_node_ids, dtype=np.int64)))
+        latlon = np.concatenate((self.__latlon[known],
+            np.frombuffer(self.__buf_latlon, dtype=np.float64).reshape((-1, 2))))
+        self.__node_ids, first = np.unique(node_ids, return_index=True)
+        self.__latlon = latlon[first]
+
+        # Ways, as node indexes into the sorted node arrays
+        way_ids = np.concatenate((self.__way_ids,
+            np.frombuffer(self.__buf_way_ids, dtype=np.int64)))
+        lengths = np.concatenate((old_lengths,
+            np.frombuffer(self.__buf_way_lengths, dtype=np.int64)))
+        refs = np.concatenate((old_refs,
+            np.frombuffer(self.__buf_way_refs, dtype=np.int64)))
+        self.__clear_buffers()
+
+        index = np.searchsorted(self.__node_ids, refs)
+        found = index < len(self.__node_ids)
+        found[found] = self.__node_ids[index[found]] == refs[found]
+        if not found.all():
+            # Keep a place with no position for each node that we don't
+            # have.  This is expected for bbox limited geometry, where
+            # the ways are split or clipped at the gaps as they are read
+            missing = np.unique(refs[~found])
+            log.warning("Missing {} nodes referenced by ways".format(len(missing)))
+            node_ids = np.concatenate((self.__node_ids, missing))
+            order = np.argsort(node_ids, kind="stable")
+            self.__node_ids = node_ids[order]
+            self.__latlon = np.concatenate(
+                (self.__latlon, np.full((len(missing), 2), np.nan)))[order]
+            index = np.searchsorted(self.__node_ids, refs)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        # Sort the ways by id, the first copy of a repeated id wins
+        self.__way_ids, first = np.unique(way_ids, return_index=True)
+        lengths = lengths[first]
+        self.__way_offsets = np.concatenate(([0], np.cumsum(lengths)))
+        gather = np.repeat(starts[first] - self.__way_offsets[:-1], lengths) + \
+                 np.arange(self.__way_offsets[-1])
+        self.__way_index = index[gather]
+
+        if len(self.__way_ids) < len(way_ids):
+            # Repeated ways (e.g. from overlapping downloads) were
+            # tagged once for each copy
+            tags = self.__tag_index["way"]
+            for key in tags:
+                tags[key] = list(dict.fromkeys(tags[key]))
+
+
+    # Position of each way id in the way arrays, -1 if it is missing
+    def __way_pos(self, way_ids):
+        return self.__lookup(self.__way_ids, way_ids)
+
+
+    # Position of each id in a sorted id array, -1 if it is missing
+    def __lookup(self, sorted_ids, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.searchsorted(sorted_ids, ids)
+        found = pos < len(sorted_ids)
+        found[found] = sorted_ids[pos[found]] == ids[found]
+        pos[~found] = -1
+        return pos
+
+
+    # Rebuild an OSM XML tree from the indexed data
+    def toXML(self):
+        self.__build()
+        way_tags = self.__way_tags()
+        root = ET.Element("osm", {"version": "0.6"})
+        if self.__bounds is not None:
+            attrib = {k: str(self.__bounds[k]) for k in self.__bounds}
+            ET.SubElement(root, "bounds", attrib)
+        known = ~np.isnan(self.__latlon[:, 0])
+        for nid, (lat, lon) in zip(self.__node_ids[known], self.__latlon[known]):
+            attrs = {"id": str(nid), "lat": str(lat), "lon": str(lon)}
+            ET.SubElement(root, "node", attrs)
+        for i, wid in enumerate(self.__way_ids):
+            way = ET.SubElement(root, "way", {"id": str(wid)})
+            s = self.__way_offsets[i]
+            e = self.__way_offsets[i + 1]
+            for ref in self.__node_ids[self.__way_index[s:e]]:
+                ET.SubElement(way, "nd", {"ref": str(ref)})
+            if wid in way_tags:
+                tags = way_tags[wid]
+                for k in tags:
+                    ET.SubElement(way, "tag", {"k": k, "v": tags[k]})
+        for rid in self.__relations:
+            self.__relations[rid].toXML(root)
+        return root
+
+
+    def write(self, filename):
+        log = logging.getLogger(__name__)
+        log.info("Writing OSM file to " + filename)
+        tree = ET.ElementTree(self.toXML())
+        with open(filename, "wb") as f:
+            tree.write(f, encoding="UTF-8", xml_declaration=True)
+
+
+    # Save the indexed data as a snapshot directory of .npy arrays and json
+    # that load_snapshot() can memory map rather than parse.  The snapshot
+    # is written alongside then moved into place, so readers never see
+    # a partial one
+    def save(self, dirname):
+        log = logging.getLogger(__name__)
+        self.__build()
+        dirname = os.path.abspath(dirname)
+        log.info("Saving snapshot to " + dirname)
+
+        tmpdir = dirname + ".tmp{}".format(os.getpid())
+        os.makedirs(tmpdir, exist_ok=True)
+        arrays = {"node_ids": self.__node_ids, "latlon": self.__latlon,
+                  "way_ids": self.__way_ids, "way_offsets": self.__way_offsets,
+                  "way_index": self.__way_index}
+
+        # Each feature's tag index is flattened into a list of keys
+        # with the ids of each key held end to end
+        tags = {}
+        for feature in self.__tag_index:
+            index = self.__tag_index[feature]
+            tags[feature] = list(index.keys())
+            lengths = [len(index[key]) for key in tags[feature]]
+            arrays[feature + "_tag_offsets"] = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+            arrays[feature + "_tag_ids"] = np.array(
+                [fid for key in tags[feature] for fid in index[key]], dtype=np.int64)
+
+        relations = []
+        for rid in self.__relations:
+            rel = self.__relations[rid]
+            relations.append([rel.id, rel.tags,
+                              [[m.type, m.ref, m.role] for m in rel.members]])
+
+        for name in arrays:
+            np.save(os.path.join(tmpdir, name + ".npy"), arrays[name])
+        with open(os.path.join(tmpdir, "tags.json"), "w") as f:
+            json.dump(tags, f)
+        with open(os.path.join(tmpdir, "relations.json"), "w") as f:
+            json.dump(relations, f)
+        with open(os.path.join(tmpdir, "meta.json"), "w") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "bounds": self.__bounds}, f)
+
+        # Swap in the new snapshot.  Anyone with the old one mapped keeps
+        # reading it until they are done
+        if os.path.exists(dirname):
+            old = dirname + ".old{}".format(os.getpid())
+            os.rename(dirname, old)
+            shutil.rmtree(old, ignore_errors=True)
+        try:
+            os.rename(tmpdir, dirname)
+        except OSError:
+            # Someone else saved the same snapshot first
+            log.info("Snapshot was saved by another process")
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+    # Load a snapshot saved by save().  The arrays are memory mapped
+    # so this takes milliseconds whatever the size of the data
+    def load_snapshot(self, dirname):
+        log = logging.getLogger(__name__)
+        dirname = os.path.abspath(dirname)
+        if not is_snapshot(dirname):
+            raise ValueError("Not a snapshot: " + dirname)
+        log.info("Loading snapshot: " + dirname)
+
+        def mapped(name):
+            return np.load(os.path.join(dirname, name + ".npy"), mmap_mode="r")
+
+        self.__clear_buffers()
+        self.__root = None
+        self.__node_ids = mapped("node_ids")
+        self.__latlon = mapped("latlon")
+        self.__way_ids = mapped("way_ids")
+        self.__way_offsets = mapped("way_offsets")
+        self.__way_index = mapped("way_index")
+
+        with open(os.path.join(dirname, "tags.json")) as f:
+            tags = json.load(f)
+        self.__tag_index = {}
+        for feature in tags:
+            offsets = mapped(feature + "_tag_offsets")
+            ids = mapped(feature + "_tag_ids")
+            self.__tag_index[feature] = {
+                    tuple(key): ids[offsets[i]:offsets[i + 1]]
+                    for i, key in enumerate(tags[feature])}
+
+        with open(os.path.join(dirname, "relations.json")) as f:
+            relations = json.load(f)
+        self.__relations = {}
+        for rid, rtags, members in relations:
+            rel = Relation(rid)
+            rel.tags = rtags
+            for mtype, ref, role in members:
+                rel.add(Member(mtype, ref, role))
+            self.__relations[int(rid)] = rel
+
+        with open(os.path.join(dirname, "meta.json")) as f:
+            self.__bounds = json.load(f)["bounds"]
+        log.info("Loaded {} nodes, {} ways, {} relations".format(
+            len(self.__node_ids), len(self.__way_ids), len(self.__relations)))
+
+
+    # Returns the ids of the ways or relations having all of the tags
+    # A tag value of None matches any value for that key
+    def select(self, feature, tags):
+        if feature not in self.__tag_index:
+            raise ValueError
+        index = self.__tag_index[feature]
+
+        # Look up each tag then intersect, walking the shortest list
+        # so that the ids come back in the order they were loaded
+        matches = []
+        for k in tags:
+            key = (k, tags[k])
+            if key not in index:
+                return []
+            matches.append(index[key])
+        if len(matches) == 0:
+            return []
+        matches.sort(key=len)
+        others = [set(m) for m in matches[1:]]
+
+        ids = []
+        for fid in dict.fromkeys(matches[0]):
+            for other in others:
+                if fid not in other:
+                    break
             else:
-                raise ValueError
+                ids.append(fid)
+        return ids
+
 
-        return ways
+    # Sorts the ways and relations into layers using the tag index
+    # rules maps each layer name to a list of (feature, tags) queries
+    # Returns the paths (as get_ways and get_relations) for each layer
+    def classify(self, rules):
+        log = logging.getLogger(__name__)
+        self.__build()
+        layers = {}
+        for name in rules:
+            paths = []
+            way_ids = []
+            for feature, tags in rules[name]:
+                if feature == "way":
+                    # Gather the ways so they are fetched in one go
+                    way_ids += self.select(feature, tags)
+                elif feature == "relation":
+                    paths += self.get_ways(way_ids)
+                    way_ids = []
+                    paths += self.get_relations(self.select(feature, tags))
+                else:
+                    raise ValueError
+            paths += self.get_ways(way_ids)
+            log.debug("Classified {} features into {}".format(len(paths), name))
+            layers[name] = paths
+        return layers
+
+
+    # Finds the ids of the elements matching a query
+    # which is either an xpath or a list of ids
+    def __find(self, feature, query):
+        if type(query) is str:
+            if self.__root is None:
+                raise ValueError("XPath queries need the XML tree, use select() for streamed data")
+            ids = []
+            for element in self.__root.findall(query):
+                if element.tag == feature:
+                    ids.append(int(element.attrib["id"]))
+                else:
+                    raise ValueError
+            return ids
+        else:
+            return [int(fid) for fid in query]
+
+
+    # Node indexes of a way, as a view into the way index array
+    def __way_nodes(self, way_id):
+        self.__build()
+        pos = self.__way_pos([way_id])[0]
+        if pos < 0:
+            raise ValueError
+        return self.__way_index[self.__way_offsets[pos]:self.__way_offsets[pos + 1]]
+
+
+    # Returns an (n, 2) array of the lat, lon of each node in the way
+    def path(self, way_id):
+        return self.__latlon[self.__way_nodes(int(way_id))]
+
+
+    # Returns an (n, 2) array of lat, lon for the nodes that match the xpath or ids
+    def get_nodes(self, query):
+        self.__build()
+        index = self.__lookup(self.__node_ids, self.__find("node", query))
+        if (index < 0).any():
+            raise ValueError
+        return self.__latlon[index]
+
+
+    # The bounds taken from the positions of the nodes, or None if
+    # there are none
+    def __extent(self):
+        self.__build()
+        latlon = self.__latlon[~np.isnan(self.__latlon[:, 0])]
+        if len(latlon) == 0:
+            return None
+        low = latlon.min(axis=0)
+        high = latlon.max(axis=0)
+        return {"minlat": str(low[0]), "minlon": str(low[1]),
+                "maxlat": str(high[0]), "maxlon": str(high[1])}
+
+
+    # The bounds as (minlat, minlon, maxlat, maxlon), or None
+    def __bbox(self):
+        if self.__bounds is None:
+            return None
+        return tuple(float(self.__bounds[k]) for k in ("minlat", "minlon", "maxlat", "maxlon"))
+
+
+    # Returns a list of (n, 2) arrays of lat, lon
+    # Each array defines a way.  Where nodes are missing (outside the
+    # bbox) a way is split into a piece for each run of nodes we have,
+    # or if it is an area, clipped to the bounds
+    def get_ways(self, query):
+        self.__build()
+        pos = self.__way_pos(self.__find("way", query))
+        if (pos < 0).any():
+            raise ValueError
+
+        if len(pos) == 0:
+            return []
+
+        # Gather all of the coordinates in one go then split into ways
+        starts = self.__way_offsets[pos]
+        lengths = self.__way_offsets[pos + 1] - starts
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        gather = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        nodes = self.__way_index[gather]
+        coords = self.__latlon[nodes]
+        ways = np.split(coords, offsets[1:-1])
+        missing = np.isnan(coords[:, 0])
+        if not missing.any():
+            return ways
+
+        gaps = np.bincount(np.repeat(np.arange(len(pos)), lengths), missing, len(pos)) > 0
+        closed = lengths > 2
+        closed[closed] = nodes[offsets[:-1][closed]] == nodes[offsets[1:][closed] - 1]
+        bbox = self.__bbox()
+        paths = []
+        for way, gap, area in zip(ways, gaps, closed):
+            if not gap:
+                paths.append(way)
+            elif area and bbox is not None:
+                ring = clip_ring(way, bbox)
+                if ring is not None:
+                    paths.append(ring)
+            else:
+                paths += split_gaps(way)
+        return paths
 
 
     # Returns a list of dictionaries
     # Each dictionary (hopefully) contains 2 keys "inner" and "outer"
-    # Each of these expand to a list of Nodes that define the ways
-    # that make up the complex relational object
-    def get_relations(self, xpath):
-        log = logging.getLogger(__name__)
+    # Each of these expand to a list of (n, 2) arrays of lat, lon that
+    # define the rings that make up the complex relational object.
+    # Any problems found joining the rings are listed under "diagnostics"
+    def get_relations(self, query):
+        self.__build()
 
         relations = []
 
-        # relation = Node,Way,Relation - Stuff we expect to get back...
-        for relation in self.__root.findall(xpath):
-            if relation.tag == "relation":
-                # There is an extra layer of indirection in the data
-                members =  relation.findall("./member[@type='way']")
-                log.debug("Found {} member ways".format(len(members)))
-                inner = []
-                outer = []
-                ways_left = {}
-                endpoints = {"inner": {}, "outer":{}}
-                for member in members:
-                    way_id = member.attrib["ref"]
-                    role = member.attrib["role"]
-                    if role not in ["inner", "outer"]:
-                        log.error("Bad role: " + role)
-                    else:
-                        if way_id in self.__ways:
-                            if len(self.__ways[way_id]) > 1:
-                                # Add it for processing
-                                ways_left[way_id] = role
-                                # Capture the endpoints of the ways
-                                start = role + str(self.__nodes[self.__ways[way_id][0]].id)
-                                end =   role + str(self.__nodes[self.__ways[way_id][-1]].id)
-                                if start not in endpoints[role]:
-                                    endpoints[role][start] = [way_id]
-                                else:
-                                    endpoints[role][start].append(way_id)
-                                if end not in endpoints[role]:
-                                    endpoints[role][end] = [way_id]
-                                else:
-                                    endpoints[role][end].append(way_id)
-                            else:
-                                log.warning("Short way " + way_id)
-                        else:
-                            log.warning("Missing way: " + way_id)
-
-                log.debug("Endpoints " + str(endpoints))
-                
-                for role in endpoints:
-                    for jn in endpoints[role]:
-                        if endpoints[role][jn][0] in ways_left:
-                            # Mark the way as processed by removing it
-                            log.debug("Way " + endpoints[role][jn][0])
-                            del ways_left[endpoints[role][jn][0]]
-
-                            # Make sure that we have a matching endpoint
-                            if len(endpoints[role][jn]) != 2:
-                                log.error("Unclosed multipolygon " + relation.attrib["id"])
-
-                            # Look for islands (self-closed way)
-                            elif endpoints[role][jn][0] == endpoints[role][jn][1]:
-                                # We have a self closed way (polygon)
-                                log.debug("Found island " + endpoints[role][jn][0])
-                                if role == "inner":
-                                    inner.append(self.path(endpoints[role][jn][0]))
-                                elif role == "outer":
-                                    outer.append(self.path(endpoints[role][jn][0]))
-                                else:
-                                    log.error("unregonised role " + role)
-                            else:
-                                # General open way that needs to be joined
-                                begin = endpoints[role][jn][0]
-                                nextway = endpoints[role][jn][1]
-                                # Start the chain
-                                chain = self.path(begin)
-
-                                log.debug("Start of chain: " + str(chain))
-
-                                while nextway in ways_left:
-                                    # Mark the way as processed by removing it
-                                    del ways_left[nextway]
-                                    log.debug("Way " + nextway)
-
-                                    # Join this way to the chain
-                                    if (self.__ways[nextway][0] == chain[-1].id):
-                                        # The start of the next way matches the end of the chain
-                                        chain = chain + self.path(nextway)
-
-                                    elif (self.__ways[nextway][-1] == chain[-1].id):
-                                        # The end of the next matches the end of the chain
-                                        chain = chain + list(reversed(self.path(nextway)))
-
-                                    elif (self.__ways[nextway][0] == chain[0].id):
-                                        # The start of the next way matches the start of the chain
-                                        chain = list(reversed(self.path(nextway))) + chain
-
-                                    elif (self.__ways[nextway][-1] == chain[0].id):
-                                        # The end of the next way matches the start of the chain
-                                        chain = self.path(nextway) + chain
-
-                                    else:
-                                        log.error("Broken chain " + nextway)
-                                    
-                                    # Follow the chain
-                                    for junction in endpoints[role]:
-                                        if nextway in endpoints[role][junction]:
-                                            if len(endpoints[role][junction]) > 1:
-                                                if nextway == endpoints[role][junction][0]:
-                                                    n = endpoints[role][junction][1]
-                                                else:
-                                                    n = endpoints[role][junction][0]
-                                            else:
-                                                log.error("Missing way causing incomplete chain")
-                                            if n in ways_left:                                                    
-                                                nextway = n
-                                                break
-                                    
-                                # Check to see that the chain is closed
-                                if chain[0].id != chain[-1].id:
-                                    log.error ("Incomplete chain " + nextway)
-
-                                # Add the chain anyway so can debug or recover
-                                if role == "inner":
-                                    inner.append(chain)
-                                elif role == "outer":
-                                    outer.append(chain)
-                                else:
-                                    log.error("Unrecognised role " + role)
-            else:
-                raise ValueError
-            
-            relations.append({"outer": outer, "inner": inner})
+        for rid in self.__find("relation", query):
+            relation = self.__relations[rid]
+            diagnostics = []
+
+            # There is an extra layer of indirection in the data
+            ways = {"inner": [], "outer": []}
+            for member in relation.members:
+                if member.type != "way":
+                    continue
+                if member.role not in ways:
+                    diagnostics.append(RingDiagnostic(rid, member.role, member.ref, "bad_role"))
+                    continue
+                pos = self.__way_pos([int(member.ref)])[0]
+                if pos < 0:
+                    diagnostics.append(RingDiagnostic(rid, member.role, member.ref, "missing_way"))
+                    continue
+                nodes = self.__way_index[self.__way_offsets[pos]:self.__way_offsets[pos + 1]]
+                if len(nodes) < 2:
+                    diagnostics.append(RingDiagnostic(rid, member.role, member.ref, "short_way"))
+                    continue
+                ways[member.role].append((member.ref, nodes))
+
+            rings = {}
+            for role in ways:
+                rings[role] = []
+                for ring in self.__assemble(rid, role, ways[role], diagnostics):
+                    ring = self.__ring(ring)
+                    if ring is not None:
+                        rings[role].append(ring)
+
+            relations.append({"outer": rings["outer"],
+                              "inner": rings["inner"],
+                              "diagnostics": diagnostics})
 
         return relations
 
 
+    # The lat, lon of a ring of node indexes.  Rings with nodes missing
+    # (outside the bbox), or left open outside it where member ways
+    # are missing, are clipped to the bounds
+    def __ring(self, nodes):
+        ring = self.__latlon[nodes]
+        bbox = self.__bbox()
+        if bbox is None:
+            return ring[~np.isnan(ring[:, 0])]
+        if nodes[0] != nodes[-1] and not np.isnan(ring[[0, -1], 0]).any():
+            minlat, minlon, maxlat, maxlon = bbox
+            ends = ring[[0, -1]]
+            outside = (ends[:, 0] < minlat) | (ends[:, 0] > maxlat) | \
+                      (ends[:, 1] < minlon) | (ends[:, 1] > maxlon)
+            if outside.all():
+                # Mark the gap between the ends
+                ring = np.concatenate((ring, [[np.nan, np.nan]]))
+        if np.isnan(ring[:, 0]).any():
+            return clip_ring(ring, bbox)
+        return ring
+
+
+    # Join the member ways of one role into rings.  Ways are linked
+    # through a map of endpoint node to ways, and each ring is only
+    # ever appended to, so this is linear in the number of members
+    def __assemble(self, rid, role, ways, diagnostics):
+        ends = {}
+        for i, (way_id, nodes) in enumerate(ways):
+            for n in (nodes[0], nodes[-1]):
+                if n in ends:
+                    ends[n].append(i)
+                else:
+                    ends[n] = [i]
+
+        used = [False] * len(ways)
+        rings = []
+        for i, (way_id, nodes) in enumerate(ways):
+            if used[i]:
+                continue
+            used[i] = True
+
+            # Look for islands (self-closed way)
+            if nodes[0] == nodes[-1]:
+                rings.append(nodes)
+                continue
+
+            # Grow the ring from its end until it closes
+            forward = [nodes]
+            last = self.__follow(rid, role, ways, ends, used, forward, nodes[-1], nodes[0], diagnostics)
+            first = nodes[0]
+            backward = []
+            if last != first:
+                # We hit a gap, so grow it backwards from its start too
+                first = self.__follow(rid, role, ways, ends, used, backward, nodes[0], last, diagnostics)
+
+            if first != last:
+                diagnostics.append(RingDiagnostic(rid, role, way_id, "unclosed"))
+
+            # Add the ring anyway so can debug or recover
+            pieces = [piece[::-1] for piece in reversed(backward)] + forward
+            rings.append(np.concatenate(pieces))
+
+        return rings
+
+
+    # Add unused ways that join at node to pieces until we get to stop
+    # Each piece leaves out the junction node it shares with the last
+    def __follow(self, rid, role, ways, ends, used, pieces, node, stop, diagnostics):
+        while node != stop:
+            candidates = [j for j in ends[node] if not used[j]]
+            if len(candidates) == 0:
+                break
+            if len(candidates) > 1:
+                diagnostics.append(RingDiagnostic(rid, role, ways[candidates[0]][0], "branched"))
+            j = candidates[0]
+            used[j] = True
+            nodes = ways[j][1]
+            if nodes[0] != node:
+                nodes = nodes[::-1]
+            pieces.append(nodes[1:])
+            node = nodes[-1]
+        return node
+
+
 
 def main():
     pass
@@ -1,6 +1,14 @@
 import os
 import sys
 import re
+import math
+import time
+import hashlib
+import shutil
+import queue
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import logging
 import logging.config
 import yaml
@@ -9,7 +17,26 @@ import requests
 from requests.compat import urljoin
 import xml.etree.ElementTree as ET
 
+import cache
 import common
+import osm
+import pbf
+import scheduler
+
+
+# Counts of downloads saved by the cache (or a snapshot) and those made
+cache_stats = {"hits": 0, "misses": 0}
+
+# Number of chunks a streamed download can get ahead of the parser
+STREAM_QUEUE = 16
+
+# Remarks with which Overpass gives up on a query that is too big
+SPLIT_REMARK = re.compile(r"timed out|out of memory")
+
+
+# Raised when a part of a split query needs splitting further
+class QueryTooLarge(Exception):
+    pass
 
 
 def ovp_query(config, bbox):
@@ -29,41 +56,474 @@ def ovp_query(config, bbox):
                     else:
                         ways.append("way[{}]{}".format(config["layers"][name][shape][source], bbox))
 
+    # Sorted so the same layers always give the same query
     q = "("
     if len(ways) > 0:   
-        q += ";".join(ways) + ";"
+        q += ";".join(sorted(set(ways))) + ";"
     if len(relations) > 0:
-        q += ";".join(relations) + ";"
-    q += ");(._;>;);out;"
+        q += ";".join(sorted(set(relations))) + ";"
+    if ovp_clip(config):
+        # Only the coordinates inside the bbox (and the first beyond it
+        # each side) are sent, inline with the ways.  The member ways of
+        # the relations are fetched as ways so they share node ids
+        q += ")->.a;(way.a;way(r.a){0};);out geom{0};rel.a;out;".format(bbox)
+    else:
+        q += ");(._;>;);out;"
+    settings = ""
+    if ovp_json(config):
+        settings += "[out:json]"
+    if "split" in config["overpass"] and "timeout" in config["overpass"]["split"]:
+        # Have the server give up on a part sooner, so it is split
+        # rather than holding a slot
+        settings += "[timeout:{}]".format(config["overpass"]["split"]["timeout"])
+    if settings != "":
+        q = settings + ";" + q
     log.debug("Overpass QL: " + q)
     return q
 
 
-def ovp_download(endpoint, query):
-    r = requests.post(endpoint, data=query)
-    return r.content
+# Is the geometry to be limited to the bbox?
+def ovp_clip(config):
+    return "clip" in config["overpass"] and config["overpass"]["clip"]
+
+
+# Is the data to be fetched as Overpass JSON rather than XML?
+def ovp_json(config):
+    return "format" in config["overpass"] and config["overpass"]["format"] == "json"
+
+
+# Key identifying a query, ignoring any whitespace
+def ovp_key(query):
+    return hashlib.sha1(re.sub(r"\s+", "", query).encode("utf-8")).hexdigest()
+
+
+# Any remark Overpass made about a response, e.g. that the query timed out
+def ovp_remark(data):
+    if data.lstrip()[:1] == b"{":
+        # After the elements, so that a "remark" tag isn't taken for it
+        m = re.search(rb'"remark"\s*:\s*"((?:[^"\\]|\\.)*)"', data[data.rfind(b"]"):])
+    else:
+        m = re.search(rb"<remark>(.*?)</remark>", data, re.S)
+    if m is None:
+        return None
+    return m.group(1).decode("utf-8", "replace").strip()
+
+
+# Requests go through the scheduler, which shares the Overpass
+# slots between the workers and retries when the server is busy
+def ovp_download(config, query):
+    sched = scheduler.get_scheduler(config)
+    with sched.post(config["overpass"]["endpoint"], query) as r:
+        return r.content
+
+
+# Yields the response to a query in chunks as it downloads.  The
+# download runs in its own thread so that the network keeps going
+# while the chunks are being parsed
+def ovp_stream(config, query):
+    chunks = queue.Queue(maxsize=STREAM_QUEUE)
+    stop = threading.Event()
+
+    # Returns False if the reader has gone away
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def download():
+        try:
+            sched = scheduler.get_scheduler(config)
+            with sched.post(config["overpass"]["endpoint"], query, stream=True) as r:
+                for chunk in r.iter_content(chunk_size=osm.OSMData.CHUNK_SIZE):
+                    if not put(chunk):
+                        return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    # In the caller's context, so that its waits count towards the job
+    threading.Thread(target=contextvars.copy_context().run, args=(download,), daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+
+
+# The response cache set up under overpass.cache in the config, or None
+def ovp_cache(config):
+    if "cache" not in config["overpass"]:
+        return None
+    conf = config["overpass"]["cache"]
+    ttl = None
+    max_size = None
+    if "ttl" in conf:
+        ttl = conf["ttl"]
+    if "max_size" in conf:
+        # Configured in MB
+        max_size = conf["max_size"] * 1024 * 1024
+    return cache.FileCache(conf["dir"], ttl, max_size)
+
+
+# Is a snapshot within the cache ttl (if there is one)?
+def ovp_fresh(config, snapshot):
+    if not osm.is_snapshot(snapshot):
+        return False
+    if "cache" in config["overpass"] and "ttl" in config["overpass"]["cache"]:
+        age = time.time() - os.path.getmtime(os.path.join(snapshot, "meta.json"))
+        return age <= config["overpass"]["cache"]["ttl"]
+    return True
+
+
+# Remove the snapshots past the cache ttl, then the least recently used
+# until they fit in the cache max_size.  The limits apply to the
+# snapshots separately from the cached responses
+def ovp_evict_snapshots(config):
+    log = logging.getLogger(__name__)
+    if "cache" not in config["overpass"]:
+        return
+    conf = config["overpass"]["cache"]
+    dirname = config["overpass"]["snapshots"]
+    entries = []
+    total = 0
+    for name in os.listdir(dirname):
+        snapshot = os.path.join(dirname, name)
+        if not osm.is_snapshot(snapshot):
+            continue
+        try:
+            stat = os.stat(os.path.join(snapshot, "meta.json"))
+            size = sum(os.path.getsize(os.path.join(snapshot, f)) for f in os.listdir(snapshot))
+        except FileNotFoundError:
+            continue
+        if "ttl" in conf and time.time() - stat.st_mtime > conf["ttl"]:
+            size = None
+        entries.append((stat.st_atime, size, snapshot))
+        if size is not None:
+            total += size
+
+    entries.sort(key=lambda entry: entry[0])
+    for atime, size, snapshot in entries:
+        if size is not None:
+            if "max_size" not in conf or total <= conf["max_size"] * 1024 * 1024:
+                continue
+            total -= size
+        # Anyone with the snapshot mapped keeps reading it until done
+        old = snapshot + ".old{}".format(os.getpid())
+        try:
+            os.rename(snapshot, old)
+        except OSError:
+            continue
+        shutil.rmtree(old, ignore_errors=True)
+        log.info("Evicted snapshot: " + snapshot)
+
+
+# Download the data for a query, going to the cache first
+def ovp_fetch(config, query):
+    log = logging.getLogger(__name__)
+    store = ovp_cache(config)
+    key = ovp_key(query)
+    if store is not None:
+        data = store.get(key)
+        if data is not None:
+            cache_stats["hits"] += 1
+            return data
+
+    cache_stats["misses"] += 1
+    log.info("Downloading data from " + config["overpass"]["endpoint"])
+    data = ovp_download(config, query)
+    if store is not None:
+        if ovp_remark(data) is not None:
+            # Overpass reports errors such as timeouts in a remark
+            # alongside whatever data it managed, so don't keep it
+            log.warning("Not caching a response with a remark")
+        else:
+            store.put(key, data)
+    return data
+
 
-def get_osm(min_lat, min_lon, max_lat, max_lon, config):
+# Index the data for a query into osmap as it downloads, going to the
+# cache first.  The response is never held in memory as a whole.  With
+# build=False osmap is left to be built when it is first used, e.g.
+# once more data has been loaded into it
+def ovp_load(config, query, osmap, build=True):
+    log = logging.getLogger(__name__)
+    store = ovp_cache(config)
+    key = ovp_key(query)
+    if store is not None:
+        f = store.open(key)
+        if f is not None:
+            cache_stats["hits"] += 1
+            with f:
+                for chunk in iter(lambda: f.read(osm.OSMData.CHUNK_SIZE), b""):
+                    osmap.feed(chunk)
+            osmap.close(build)
+            return
+
+    cache_stats["misses"] += 1
+    log.info("Downloading data from " + config["overpass"]["endpoint"])
+    writer = None
+    if store is not None:
+        writer = store.writer(key)
+    try:
+        for chunk in ovp_stream(config, query):
+            osmap.feed(chunk)
+            if writer is not None:
+                writer.write(chunk)
+        osmap.close(build)
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    if writer is not None:
+        if osmap.remark is not None:
+            # Overpass reports errors such as timeouts in a remark
+            # alongside whatever data it managed, so don't keep it
+            log.warning("Not caching a response with a remark")
+            writer.abort()
+        else:
+            writer.commit()
+
+
+# The cells of a grid of size degrees that cover a bbox.  Each is
+# (min_lat, min_lon, max_lat, max_lon), rounded so that the same cell
+# always gives the same query
+def ovp_tiles(size, min_lat, min_lon, max_lat, max_lon):
+    tiles = []
+    # Round the cell numbers first, as e.g. -0.95 / 0.05 is -18.999...
+    # and a bbox on the grid lines would take in a row of cells too many
+    bottom = math.floor(round(min_lat / size, 9))
+    top = max(math.ceil(round(max_lat / size, 9)), bottom + 1)
+    left = math.floor(round(min_lon / size, 9))
+    right = max(math.ceil(round(max_lon / size, 9)), left + 1)
+    for y in range(bottom, top):
+        for x in range(left, right):
+            tiles.append((round(y * size, 6), round(x * size, 6),
+                          round((y + 1) * size, 6), round((x + 1) * size, 6)))
+    return tiles
+
+
+# Splits a bbox into quarters, rounded so that the same bbox always
+# gives the same quarters
+def ovp_quarters(bbox):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    mid_lat = round((min_lat + max_lat) / 2, 6)
+    mid_lon = round((min_lon + max_lon) / 2, 6)
+    return [(min_lat, min_lon, mid_lat, mid_lon), (min_lat, mid_lon, mid_lat, max_lon),
+            (mid_lat, min_lon, max_lat, mid_lon), (mid_lat, mid_lon, max_lat, max_lon)]
+
+
+# The configs for each group of layers under overpass.split.groups.
+# Any layers not in a group are fetched together.  Layers with no
+# sources to query are left out, so that no part is sent for nothing
+def ovp_groups(config):
+    groups = []
+    if "groups" in config["overpass"]["split"]:
+        groups = config["overpass"]["split"]["groups"]
+    rest = [name for name in config["layers"] if not any(name in g for g in groups)]
+    configs = []
+    for group in groups + [rest]:
+        layers = {name: config["layers"][name] for name in group if name in config["layers"] and
+                  any(shape in config["layers"][name] for shape in ["ways", "areas", "complex"])}
+        if len(layers) > 0:
+            configs.append(dict(config, layers=layers))
+    return configs
+
+
+# Index the data for one part of a split query as it downloads, going
+# to the cache first.  Returns the part, as an osm.OSMData left unbuilt
+# to be merged with the others, and whether it came from the cache
+def ovp_part(config, query, max_bytes=None):
+    store = ovp_cache(config)
+    key = ovp_key(query)
+    part = osm.OSMData()
+    if store is not None:
+        f = store.open(key)
+        if f is not None:
+            with f:
+                for chunk in iter(lambda: f.read(osm.OSMData.CHUNK_SIZE), b""):
+                    part.feed(chunk)
+            part.close(build=False)
+            return part, True
+
+    writer = None
+    if store is not None:
+        writer = store.writer(key)
+    try:
+        size = 0
+        sched = scheduler.get_scheduler(config)
+        # Too big a part is split rather than sent again
+        with sched.post(config["overpass"]["endpoint"], query, stream=True, split=True) as r:
+            for chunk in r.iter_content(chunk_size=osm.OSMData.CHUNK_SIZE):
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise QueryTooLarge("More than {} bytes".format(max_bytes))
+                part.feed(chunk)
+                if writer is not None:
+                    writer.write(chunk)
+        part.close(build=False)
+        if part.remark is not None and SPLIT_REMARK.search(part.remark):
+            raise QueryTooLarge(part.remark)
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    if writer is not None:
+        if part.remark is not None:
+            # As in ovp_load, don't keep a response with a remark
+            writer.abort()
+        else:
+            writer.commit()
+    return part, False
+
+
+# Would a part that failed in this way succeed if it were smaller?
+def ovp_splittable(e):
+    if isinstance(e, (QueryTooLarge, requests.Timeout)):
+        return True
+    return isinstance(e, requests.HTTPError) and e.response is not None and \
+        e.response.status_code == 504
+
+
+# Fetch the data for a list of (bbox, config) parts into osmap, several
+# at once.  Parts that time out or are too large are split into
+# quarters and tried again, down to split.min_size degrees across.
+# Each part is indexed in its own thread as it downloads, then merged
+def ovp_fetch_parts(config, parts, osmap):
+    log = logging.getLogger(__name__)
+    conf = config["overpass"]["split"]
+    workers = conf["workers"] if "workers" in conf else 4
+    min_size = conf["min_size"] if "min_size" in conf else 0.01
+    max_bytes = None
+    if "max_size" in conf:
+        # Configured in MB
+        max_bytes = conf["max_size"] * 1024 * 1024
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+
+        def submit(bbox, part_config):
+            future = pool.submit(contextvars.copy_context().run, ovp_part, part_config,
+                                 ovp_query(part_config, bbox), max_bytes)
+            pending[future] = (bbox, part_config)
+
+        for bbox, part_config in parts:
+            submit(bbox, part_config)
+        try:
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    bbox, part_config = pending.pop(future)
+                    try:
+                        part, hit = future.result()
+                    except Exception as e:
+                        if not ovp_splittable(e) or \
+                                max(bbox[2] - bbox[0], bbox[3] - bbox[1]) / 2 < min_size:
+                            raise
+                        log.warning("Splitting {} ({})".format(bbox, e))
+                        for quarter in ovp_quarters(bbox):
+                            submit(quarter, part_config)
+                        continue
+
+                    cache_stats["hits" if hit else "misses"] += 1
+                    # Built once all of the parts are in, so that ways
+                    # clipped by one part are joined up by the others
+                    osmap.merge(part)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def get_osm(min_lat, min_lon, max_lat, max_lon, config, stream=False):
     log = logging.getLogger(__name__)
     log.info("Creating contours for B: {} L: {} T: {} R: {}".format(
         min_lat, min_lon, max_lat, max_lon))
 
+    # Use a local extract if one covers the whole area
+    extract = pbf.find_extract(config, min_lat, min_lon, max_lat, max_lon)
+    if extract is not None:
+        log.info("Reading data from local extract " + extract)
+        return pbf.get_osm(extract, min_lat, min_lon, max_lat, max_lon, config)
+
     # Create the overpass query from the config file
     bbox = (min_lat, min_lon, max_lat, max_lon)
     query = ovp_query(config, bbox)
     log.info("Query: " + query)
 
-    # Get the data using the overpass API
-    log.info("Downloading data from " + config["overpass"]["endpoint"])
-    data = ovp_download(config["overpass"]["endpoint"], query)
+    # Use the snapshot of an earlier run of the same query if we have one
+    snapshot = None
+    if "snapshots" in config["overpass"]:
+        snapshot = os.path.join(config["overpass"]["snapshots"], ovp_key(query))
+        if ovp_fresh(config, snapshot):
+            log.info("Using snapshot " + snapshot)
+            cache_stats["hits"] += 1
+            # Mark as used for the eviction, keeping the modified
+            # time as the time it was saved, for the ttl
+            meta = os.path.join(snapshot, "meta.json")
+            os.utime(meta, (time.time(), os.path.getmtime(meta)))
+            return osm.OSMData(snapshot)
 
-    # Parse XML so we can add the "bounds" element
-    log.info("Parsing XML")
-    root = ET.fromstring(data)
     attrib = {"minlat": str(min_lat), "minlon": str(min_lon),
               "maxlat": str(max_lat), "maxlon": str(max_lon)}
-    ET.SubElement(root, "bounds", attrib)
-    return root
+
+    if "split" in config["overpass"]:
+        # Fetch pieces of the area (and groups of layers) concurrently
+        conf = config["overpass"]["split"]
+        if "tile" in config["overpass"]:
+            boxes = ovp_tiles(config["overpass"]["tile"], min_lat, min_lon, max_lat, max_lon)
+        else:
+            boxes = [bbox]
+            if "size" in conf:
+                while max(b[2] - b[0] for b in boxes) > conf["size"] or \
+                        max(b[3] - b[1] for b in boxes) > conf["size"]:
+                    boxes = [q for b in boxes for q in ovp_quarters(b)]
+        parts = [(b, c) for b in boxes for c in ovp_groups(config)]
+        log.info("Fetching {} parts".format(len(parts)))
+        osmap = osm.OSMData()
+        ovp_fetch_parts(config, parts, osmap)
+    elif "tile" in config["overpass"]:
+        # Fetch whole grid cells so that overlapping jobs share
+        # downloads through the cache, then merge them
+        tiles = ovp_tiles(config["overpass"]["tile"], min_lat, min_lon, max_lat, max_lon)
+        log.info("Fetching {} tiles".format(len(tiles)))
+        osmap = osm.OSMData()
+        for tile in tiles:
+            # Built once all of the tiles are in, rather than after each
+            ovp_load(config, ovp_query(config, tile), osmap, build=False)
+    elif stream or snapshot is not None or ovp_json(config) or ovp_clip(config):
+        # Index the data directly without building an XML tree
+        log.info("Indexing data")
+        osmap = osm.OSMData()
+        ovp_load(config, query, osmap)
+    else:
+        # Parse XML so we can add the "bounds" element
+        data = ovp_fetch(config, query)
+        log.info("Parsing XML")
+        root = ET.fromstring(data)
+        ET.SubElement(root, "bounds", attrib)
+        return root
+
+    osmap.bounds = attrib
+    if snapshot is not None:
+        if len(osmap.remarks) > 0:
+            # As for the cache, don't keep a timed out or partial response
+            # (or one with any part or tile that was)
+            log.warning("Not saving a snapshot of a response with a remark")
+        else:
+            os.makedirs(config["overpass"]["snapshots"], exist_ok=True)
+            osmap.save(snapshot)
+            ovp_evict_snapshots(config)
+    return osmap
 
 def main ():
     # Configure logging
@@ -121,9 +581,12 @@ def main ():
     root = get_osm(args.min_lat, args.min_lon, args.max_lat, args.max_lon, config)
 
     # Write out the file
-    tree = ET.ElementTree(root)
-    with open(outfile, "wb") as f:
-        tree.write(f, encoding="UTF-8", xml_declaration=True)
+    if type(root) == osm.OSMData:
+        root.write(outfile)
+    else:
+        tree = ET.ElementTree(root)
+        with open(outfile, "wb") as f:
+            tree.write(f, encoding="UTF-8", xml_declaration=True)
                 
     # And we are done!
     log.info("Processing completed")
@@ -0,0 +1,89 @@
+import logging
+import logging.config
+
+import numpy as np
+
+
+# Writes SVG path data (the d attribute of a path) for many paths at
+# once.  The coordinates are rounded to whole units of the last decimal
+# place in numpy, so points that round to the same place as the one
+# before can be dropped and relative moves worked out exactly, and each
+# distinct number is only formatted once
+
+
+# Decimal strings for integers counted in units of the last of
+# decimal_places, e.g. 125 is "1.25" with 2 places, without trailing
+# zeros
+def format_fixed(values, decimal_places):
+    values, index = np.unique(values, return_inverse=True)
+    # The shortest repr of the nearest float is the decimal itself
+    strings = [s[:-2] if s.endswith(".0") else s
+               for s in map(str, (values / 10 ** decimal_places).tolist())]
+    return np.array(strings, dtype=object)[index.ravel()].tolist()
+
+
+# Returns the d attribute for each of paths, a list of subpaths as
+# ((n, 2) array of x, y, closed) tuples.  See write_paths
+def path_data(paths, decimal_places=1, relative=False, implicit=True):
+    subpaths = [subpath for path in paths for subpath in path]
+    if len(subpaths) == 0:
+        return [""] * len(paths)
+    points = np.concatenate([np.asarray(points, dtype=np.float64).reshape((-1, 2))
+                             for points, closed in subpaths])
+    return write_paths(points, [len(points) for points, closed in subpaths],
+                       [closed for points, closed in subpaths], [len(path) for path in paths],
+                       decimal_places, relative, implicit)
+
+
+# Returns the d attribute for each path, from the points of all of the
+# subpaths of all of the paths one after another.  lengths is the
+# number of points in each subpath, closed whether each is closed and
+# counts the number of subpaths in each path.  With relative, each
+# point after the first of a subpath is a move from the last (l rather
+# than L).  With implicit, the command is given once for a run of
+# points rather than for every point.  Points that round to the same
+# place as the last are dropped
+def write_paths(points, lengths, closed, counts, decimal_places=1, relative=False, implicit=True):
+    log = logging.getLogger(__name__)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    points = np.rint(np.asarray(points, dtype=np.float64) * 10 ** decimal_places).astype(np.int64)
+
+    # Drop the zero length segments
+    first = np.zeros(len(points), dtype=bool)
+    first[offsets[:-1][lengths > 0]] = True
+    keep = first.copy()
+    keep[1:] |= (points[1:] != points[:-1]).any(axis=1)
+    subpath = np.repeat(np.arange(len(lengths)), lengths)[keep]
+    points = points[keep]
+    first = first[keep]
+    offsets = np.searchsorted(subpath, np.arange(len(lengths) + 1), "left").tolist()
+
+    if relative:
+        moves = np.diff(points, axis=0, prepend=0)
+        points = np.where(first[:, np.newaxis], points, moves)
+
+    numbers = format_fixed(points.ravel(), decimal_places)
+    pairs = [x + " " + y for x, y in zip(numbers[0::2], numbers[1::2])]
+
+    line = "l" if relative else "L"
+    join = " " if implicit else " " + line + " "
+    close = " z" if relative else " Z"
+    texts = []
+    for i, (s, e, c) in enumerate(zip(offsets[:-1], offsets[1:], closed)):
+        if e == s:
+            continue
+        text = "M " + pairs[s]
+        if e - s > 1:
+            text += " " + line + " " + join.join(pairs[s + 1:e])
+        if c:
+            text += close
+        texts.append((i, text))
+    log.debug("Wrote {} paths of {} points".format(len(counts), len(points)))
+
+    # Back into the paths
+    d = [[] for count in counts]
+    owner = np.repeat(np.arange(len(counts)), counts).tolist()
+    for i, text in texts:
+        d[owner[i]].append(text)
+    return [" ".join(texts) for texts in d]
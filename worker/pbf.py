@@ -0,0 +1,712 @@
+# Local OpenStreetMap extracts in the .osm.pbf format
+#
+# Regional extracts can be downloaded from e.g.
+# https://download.geofabrik.de/
+#
+# The first time an extract is used a one-off index is built in a
+# directory beside it.  Jobs that fall inside the extract are then
+# answered from the (memory mapped) index without going to overpass.
+#
+# The file format is described at
+# https://wiki.openstreetmap.org/wiki/PBF_Format
+
+import os
+import json
+import fcntl
+import lzma
+import shutil
+import struct
+import zlib
+import logging
+import logging.config
+from argparse import ArgumentParser
+from array import array
+
+import numpy as np
+
+import common
+import osm
+
+
+# Size in degrees of the grid cells used for the spatial index
+CELL_SIZE = 0.05
+
+# Ways covering more than this many cells across (or down) are not put
+# in the grid, they are kept in a short list checked on every query
+MAX_CELLS = 4
+
+# Bump if the layout of the index changes
+INDEX_VERSION = 3
+
+# Indexes opened by this process, by directory.  Each is checked
+# against the stat of its meta.json before it is used again, as the
+# index is replaced when the extract is
+_indexes = {}
+
+
+# Protobuf decoding
+def _varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+# int64 fields hold two's complement values
+def _int64(value):
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+# sint64 fields are zigzag encoded
+def _sint64(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+# Iterate over the (field number, wire type, value) of a message
+def _fields(buf):
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 2:
+            size, pos = _varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire))
+        yield key >> 3, wire, value
+
+
+# Decode a packed repeated varint field in one go
+def _packed(buf, signed=False):
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if len(b) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shift = (np.arange(ends[-1] + 1) - np.repeat(starts, ends - starts + 1)) * 7
+    parts = (b[:ends[-1] + 1] & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    values = np.add.reduceat(parts, starts)
+    if signed:
+        return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+    else:
+        return values.astype(np.int64)
+
+
+# Repeated fields are normally packed, but may not be
+def _repeated(parts, wire, value, signed=False):
+    if wire == 2:
+        parts.append(_packed(value, signed))
+    elif signed:
+        parts.append(np.array([_sint64(value)], dtype=np.int64))
+    else:
+        parts.append(np.array([_int64(value)], dtype=np.int64))
+
+
+def _join(parts):
+    if len(parts) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(parts)
+
+
+# Iterate over the (type, data) of the blocks in the file
+def _blocks(filename):
+    with open(filename, "rb") as f:
+        while True:
+            head = f.read(4)
+            if len(head) < 4:
+                break
+            header = memoryview(f.read(struct.unpack(">I", head)[0]))
+            btype = None
+            size = 0
+            for field, wire, value in _fields(header):
+                if field == 1:
+                    btype = bytes(value).decode("utf-8")
+                elif field == 3:
+                    size = value
+            yield btype, _blob_data(memoryview(f.read(size)))
+
+
+def _blob_data(blob):
+    for field, wire, value in _fields(blob):
+        if field == 1:
+            return value
+        elif field == 3:
+            return memoryview(zlib.decompress(value))
+        elif field == 4:
+            return memoryview(lzma.decompress(value))
+    raise ValueError("Unsupported compression in PBF blob")
+
+
+# Returns the bbox from the header (minlat, minlon, maxlat, maxlon) if given
+def _header(data):
+    bbox = None
+    for field, wire, value in _fields(data):
+        if field == 1:
+            box = {}
+            for f, w, v in _fields(value):
+                box[f] = _sint64(v) / 1e9
+            bbox = (box[4], box[1], box[3], box[2])
+        elif field == 4:
+            feature = bytes(value).decode("utf-8")
+            if feature not in ("OsmSchema-V0.6", "DenseNodes"):
+                raise ValueError("Unsupported PBF feature " + feature)
+    return bbox
+
+
+def _tags(strings, keys, vals):
+    tags = {}
+    for k, v in zip(keys.tolist(), vals.tolist()):
+        tags[strings[k]] = strings[v]
+    return tags
+
+
+# Iterate over the contents of a data block yielding
+#   ("nodes", ids, lat, lon) for each group of nodes
+#   ("way", id, tags, refs) and ("relation", id, tags, members)
+def _primitives(data):
+    strings = []
+    groups = []
+    granularity = 100
+    lat_offset = 0
+    lon_offset = 0
+    for field, wire, value in _fields(data):
+        if field == 1:
+            strings = [bytes(s).decode("utf-8") for f, w, s in _fields(value)]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = _int64(value)
+        elif field == 20:
+            lon_offset = _int64(value)
+
+    for group in groups:
+        nodes = []
+        for field, wire, value in _fields(group):
+            if field == 1:
+                # Single node
+                nid = lat = lon = 0
+                for f, w, v in _fields(value):
+                    if f == 1:
+                        nid = _sint64(v)
+                    elif f == 8:
+                        lat = _sint64(v)
+                    elif f == 9:
+                        lon = _sint64(v)
+                nodes.append((nid, lat, lon))
+            elif field == 2:
+                # Dense nodes, delta coded
+                ids = []
+                lats = []
+                lons = []
+                for f, w, v in _fields(value):
+                    if f == 1:
+                        _repeated(ids, w, v, signed=True)
+                    elif f == 8:
+                        _repeated(lats, w, v, signed=True)
+                    elif f == 9:
+                        _repeated(lons, w, v, signed=True)
+                yield ("nodes", np.cumsum(_join(ids)),
+                       (lat_offset + granularity * np.cumsum(_join(lats))) / 1e9,
+                       (lon_offset + granularity * np.cumsum(_join(lons))) / 1e9)
+            elif field == 3:
+                wid = 0
+                keys = []
+                vals = []
+                refs = []
+                for f, w, v in _fields(value):
+                    if f == 1:
+                        wid = _int64(v)
+                    elif f == 2:
+                        _repeated(keys, w, v)
+                    elif f == 3:
+                        _repeated(vals, w, v)
+                    elif f == 8:
+                        _repeated(refs, w, v, signed=True)
+                yield ("way", wid, _tags(strings, _join(keys), _join(vals)),
+                       np.cumsum(_join(refs)))
+            elif field == 4:
+                rid = 0
+                keys = []
+                vals = []
+                roles = []
+                memids = []
+                types = []
+                for f, w, v in _fields(value):
+                    if f == 1:
+                        rid = _int64(v)
+                    elif f == 2:
+                        _repeated(keys, w, v)
+                    elif f == 3:
+                        _repeated(vals, w, v)
+                    elif f == 8:
+                        _repeated(roles, w, v)
+                    elif f == 9:
+                        _repeated(memids, w, v, signed=True)
+                    elif f == 10:
+                        _repeated(types, w, v)
+                mtypes = ("node", "way", "relation")
+                members = [[mtypes[t], m, strings[r]] for t, m, r in
+                           zip(_join(types).tolist(),
+                               np.cumsum(_join(memids)).tolist(),
+                               _join(roles).tolist())]
+                yield ("relation", rid, _tags(strings, _join(keys), _join(vals)), members)
+        if len(nodes) > 0:
+            nodes = np.array(nodes, dtype=np.int64).reshape((-1, 3))
+            yield ("nodes", nodes[:, 0],
+                   (lat_offset + granularity * nodes[:, 1]) / 1e9,
+                   (lon_offset + granularity * nodes[:, 2]) / 1e9)
+
+
+# Indexes to gather the ragged rows in order out of data laid out by offsets
+def _gather(offsets, rows):
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    new = np.concatenate(([0], np.cumsum(lengths)))
+    return np.repeat(starts - new[:-1], lengths) + np.arange(new[-1]), new
+
+
+# Positions in a sorted array of the values that are present
+def _lookup(sorted_values, values):
+    values = np.asarray(values, dtype=np.int64)
+    if len(sorted_values) == 0 or len(values) == 0:
+        return np.empty(0, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return pos[sorted_values[pos] == values]
+
+
+def _has_tags(ftags, tags):
+    for k in tags:
+        if k not in ftags or (tags[k] is not None and ftags[k] != tags[k]):
+            return False
+    return True
+
+
+def _cell(x):
+    return np.floor(np.asarray(x) / CELL_SIZE).astype(np.int64)
+
+
+def _cell_key(row, col):
+    return (row + 4000) * 10000 + (col + 4000)
+
+
+def index_dir(filename):
+    return os.path.abspath(filename) + ".idx"
+
+
+# Read the extract and write the index used to answer queries
+def build_index(filename, indexdir=None):
+    log = logging.getLogger(__name__)
+    filename = os.path.abspath(filename)
+    if indexdir is None:
+        indexdir = index_dir(filename)
+    log.info("Building index of {} in {}".format(filename, indexdir))
+
+    bbox = None
+    node_ids = []
+    node_lat = []
+    node_lon = []
+    way_ids = array("q")
+    way_lengths = array("q")
+    way_refs = []
+    tag_codes = {}
+    way_tag_counts = array("q")
+    way_tag_codes = array("q")
+    relations = []
+
+    for btype, data in _blocks(filename):
+        if btype == "OSMHeader":
+            bbox = _header(data)
+        elif btype == "OSMData":
+            for item in _primitives(data):
+                if item[0] == "nodes":
+                    node_ids.append(item[1])
+                    node_lat.append(item[2])
+                    node_lon.append(item[3])
+                elif item[0] == "way":
+                    wid, tags, refs = item[1:]
+                    if len(refs) == 0:
+                        continue
+                    way_ids.append(wid)
+                    way_lengths.append(len(refs))
+                    way_refs.append(refs)
+                    # Every tag is kept, as any key may be used by a
+                    # layer to pick features
+                    for key in tags.items():
+                        if key not in tag_codes:
+                            tag_codes[key] = len(tag_codes)
+                        way_tag_codes.append(tag_codes[key])
+                    way_tag_counts.append(len(tags))
+                elif item[0] == "relation":
+                    rid, tags, members = item[1:]
+                    # Only multipolygons are assembled into map features
+                    if "type" in tags and tags["type"] == "multipolygon":
+                        relations.append({"id": rid, "tags": tags, "members": members})
+        else:
+            log.warning("Skipping unknown PBF block " + str(btype))
+
+    # Nodes sorted by id
+    node_ids = np.concatenate(node_ids) if len(node_ids) > 0 else np.empty(0, dtype=np.int64)
+    order = np.argsort(node_ids, kind="stable")
+    node_ids = node_ids[order]
+    latlon = np.column_stack((np.concatenate(node_lat)[order],
+                              np.concatenate(node_lon)[order])) \
+        if len(order) > 0 else np.empty((0, 2))
+    log.info("Indexed {} nodes".format(len(node_ids)))
+
+    # Ways, as indexes into the node arrays, dropping missing nodes
+    ids = np.frombuffer(way_ids, dtype=np.int64)
+    lengths = np.frombuffer(way_lengths, dtype=np.int64)
+    refs = np.concatenate(way_refs) if len(way_refs) > 0 else np.empty(0, dtype=np.int64)
+    index = np.searchsorted(node_ids, refs)
+    found = index < len(node_ids)
+    found[found] = node_ids[index[found]] == refs[found]
+    if not found.all():
+        log.warning("Extract is missing {} nodes used by ways".format(np.count_nonzero(~found)))
+        owner = np.repeat(np.arange(len(ids)), lengths)
+        lengths = np.bincount(owner[found], minlength=len(ids))
+        index = index[found]
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    tag_offsets = np.concatenate(([0], np.cumsum(np.frombuffer(way_tag_counts, dtype=np.int64))))
+    codes = np.frombuffer(way_tag_codes, dtype=np.int64)
+
+    # Sorted by id, keeping only ways with some nodes
+    order = np.argsort(ids, kind="stable")
+    order = order[lengths[order] > 0]
+    gather, offsets_sorted = _gather(offsets, order)
+    way_index = index[gather]
+    gather, tag_offsets_sorted = _gather(tag_offsets, order)
+    codes = codes[gather]
+    ids = ids[order]
+    offsets = offsets_sorted
+    tag_offsets = tag_offsets_sorted
+    log.info("Indexed {} ways".format(len(ids)))
+
+    # Bounding box of each way
+    coords = latlon[way_index]
+    way_bbox = np.column_stack((
+        np.minimum.reduceat(coords[:, 0], offsets[:-1]),
+        np.minimum.reduceat(coords[:, 1], offsets[:-1]),
+        np.maximum.reduceat(coords[:, 0], offsets[:-1]),
+        np.maximum.reduceat(coords[:, 1], offsets[:-1]))) \
+        if len(ids) > 0 else np.empty((0, 4))
+
+    # Grid of cells listing the ways that touch them
+    r0 = _cell(way_bbox[:, 0])
+    c0 = _cell(way_bbox[:, 1])
+    rows = _cell(way_bbox[:, 2]) - r0 + 1
+    cols = _cell(way_bbox[:, 3]) - c0 + 1
+    small = (rows <= MAX_CELLS) & (cols <= MAX_CELLS)
+    large = np.flatnonzero(~small)
+    pos = np.flatnonzero(small)
+    counts = rows[pos] * cols[pos]
+    starts = np.concatenate(([0], np.cumsum(counts)))
+    k = np.arange(starts[-1]) - np.repeat(starts[:-1], counts)
+    owner = np.repeat(pos, counts)
+    keys = _cell_key(r0[owner] + k // cols[owner], c0[owner] + k % cols[owner])
+    order = np.argsort(keys, kind="stable")
+    cell_keys, first = np.unique(keys[order], return_index=True)
+    cell_offsets = np.concatenate((first, [len(keys)]))
+    cell_ways = owner[order]
+
+    # Relations with the area covered by their member ways
+    kept = []
+    for rel in relations:
+        p = _lookup(ids, [m[1] for m in rel["members"] if m[0] == "way"])
+        if len(p) > 0:
+            rel["bbox"] = [float(way_bbox[p, 0].min()), float(way_bbox[p, 1].min()),
+                           float(way_bbox[p, 2].max()), float(way_bbox[p, 3].max())]
+            kept.append(rel)
+    log.info("Indexed {} multipolygons".format(len(kept)))
+
+    if bbox is None and len(node_ids) > 0:
+        bbox = (float(latlon[:, 0].min()), float(latlon[:, 1].min()),
+                float(latlon[:, 0].max()), float(latlon[:, 1].max()))
+
+    # Write to a temporary directory and move into place when complete
+    tmpdir = indexdir + ".tmp{}".format(os.getpid())
+    os.makedirs(tmpdir, exist_ok=True)
+    arrays = {"node_ids": node_ids, "latlon": latlon,
+              "way_ids": ids, "way_offsets": offsets, "way_index": way_index,
+              "way_bbox": way_bbox, "tag_offsets": tag_offsets, "tag_codes": codes,
+              "cell_keys": cell_keys, "cell_offsets": cell_offsets,
+              "cell_ways": cell_ways, "large_ways": large}
+    for name in arrays:
+        np.save(os.path.join(tmpdir, name + ".npy"), arrays[name])
+    with open(os.path.join(tmpdir, "tags.json"), "w") as f:
+        json.dump(sorted(tag_codes, key=tag_codes.get), f)
+    with open(os.path.join(tmpdir, "relations.json"), "w") as f:
+        json.dump(kept, f)
+    stat = os.stat(filename)
+    meta = {"version": INDEX_VERSION, "source": filename,
+            "size": stat.st_size, "mtime": stat.st_mtime, "bbox": bbox}
+    with open(os.path.join(tmpdir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    if os.path.exists(indexdir):
+        shutil.rmtree(indexdir, ignore_errors=True)
+    try:
+        os.rename(tmpdir, indexdir)
+    except OSError:
+        # Someone else got there first
+        log.info("Index was built by another process")
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    log.info("Index complete")
+
+
+# Is the index there and built from the current extract?
+def _index_current(filename, indexdir):
+    metafile = os.path.join(indexdir, "meta.json")
+    if not os.path.exists(metafile):
+        return False
+    with open(metafile) as f:
+        meta = json.load(f)
+    stat = os.stat(filename)
+    return meta["version"] == INDEX_VERSION and \
+           meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime
+
+
+# Identifies the version of an index on disk, which changes whenever
+# it is rebuilt
+def _index_stat(indexdir):
+    stat = os.stat(os.path.join(indexdir, "meta.json"))
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+# Returns the index of an extract, building it first if needed
+def open_index(filename):
+    log = logging.getLogger(__name__)
+    filename = os.path.abspath(filename)
+    indexdir = index_dir(filename)
+
+    if not _index_current(filename, indexdir):
+        # Only one process builds the index, any others wait for it
+        with open(indexdir + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not _index_current(filename, indexdir):
+                build_index(filename, indexdir)
+
+    stat = _index_stat(indexdir)
+    if indexdir in _indexes and _indexes[indexdir]["stat"] == stat:
+        return _indexes[indexdir]
+
+    log.info("Opening index " + indexdir)
+    idx = {"stat": stat}
+    for name in os.listdir(indexdir):
+        if name.endswith(".npy"):
+            idx[name[:-4]] = np.load(os.path.join(indexdir, name), mmap_mode="r")
+    with open(os.path.join(indexdir, "meta.json")) as f:
+        idx["meta"] = json.load(f)
+    with open(os.path.join(indexdir, "tags.json")) as f:
+        idx["tags"] = [tuple(t) for t in json.load(f)]
+    with open(os.path.join(indexdir, "relations.json")) as f:
+        idx["relations"] = json.load(f)
+
+    # Codes of the tags for each key
+    idx["keys"] = {}
+    for code, (k, v) in enumerate(idx["tags"]):
+        if k in idx["keys"]:
+            idx["keys"][k].append(code)
+        else:
+            idx["keys"][k] = [code]
+
+    _indexes[indexdir] = idx
+    return idx
+
+
+# Returns the first configured extract that covers the whole area, or None
+def find_extract(config, min_lat, min_lon, max_lat, max_lon):
+    log = logging.getLogger(__name__)
+    if "overpass" not in config or "extracts" not in config["overpass"]:
+        return None
+    for filename in config["overpass"]["extracts"]:
+        if not os.path.exists(filename):
+            log.warning("Extract not found: " + filename)
+            continue
+        bbox = open_index(filename)["meta"]["bbox"]
+        if bbox is not None and bbox[0] <= min_lat and bbox[1] <= min_lon and \
+                bbox[2] >= max_lat and bbox[3] >= max_lon:
+            log.info("Using local extract " + filename)
+            return filename
+    return None
+
+
+# Codes of the tags that match a (key, value) with None matching any value
+def _codes(idx, k, v):
+    if v is None:
+        if k in idx["keys"]:
+            return idx["keys"][k]
+        return []
+    return [c for c in idx["keys"].get(k, []) if idx["tags"][c][1] == v]
+
+
+# Builds OSMData holding the features for the configured layers in the area
+def get_osm(filename, min_lat, min_lon, max_lat, max_lon, config):
+    log = logging.getLogger(__name__)
+    idx = open_index(filename)
+    rules = osm.make_rules(config["layers"])
+
+    # Ways near the area from the grid, then the ones that really overlap
+    keys = []
+    for row in range(_cell(min_lat), _cell(max_lat) + 1):
+        for col in range(_cell(min_lon), _cell(max_lon) + 1):
+            keys.append(_cell_key(row, col))
+    parts = [np.asarray(idx["large_ways"])]
+    for c in _lookup(idx["cell_keys"], keys):
+        parts.append(idx["cell_ways"][idx["cell_offsets"][c]:idx["cell_offsets"][c + 1]])
+    pos = np.unique(np.concatenate(parts)).astype(np.int64)
+    box = idx["way_bbox"][pos]
+    pos = pos[(box[:, 0] <= max_lat) & (box[:, 2] >= min_lat) &
+              (box[:, 1] <= max_lon) & (box[:, 3] >= min_lon)]
+
+    # Tags of those ways
+    gather, tag_offsets = _gather(idx["tag_offsets"], pos)
+    codes = idx["tag_codes"][gather]
+    owner = np.repeat(np.arange(len(pos)), np.diff(tag_offsets))
+
+    # Ways matching any of the rules
+    wanted = np.zeros(len(pos), dtype=bool)
+    multipolygons = []
+    for name in rules:
+        for feature, tags in rules[name]:
+            if feature == "way":
+                match = np.ones(len(pos), dtype=bool)
+                for k in tags:
+                    has = np.zeros(len(pos), dtype=bool)
+                    has[owner[np.isin(codes, _codes(idx, k, tags[k]))]] = True
+                    match &= has
+                wanted |= match
+            else:
+                multipolygons.append(tags)
+
+    # Relations matching the rules, and their member ways
+    relations = []
+    members = []
+    for rel in idx["relations"]:
+        b = rel["bbox"]
+        if b[0] > max_lat or b[2] < min_lat or b[1] > max_lon or b[3] < min_lon:
+            continue
+        for tags in multipolygons:
+            if _has_tags(rel["tags"], tags):
+                relation = osm.Relation(str(rel["id"]))
+                relation.tags = dict(rel["tags"])
+                for mtype, ref, role in rel["members"]:
+                    relation.add(osm.Member(mtype, str(ref), role))
+                    if mtype == "way":
+                        members.append(ref)
+                relations.append(relation)
+                break
+
+    # Positions of all of the ways we need
+    mpos = _lookup(idx["way_ids"], members)
+    ways = np.unique(np.concatenate((pos[wanted], mpos))).astype(np.int64)
+
+    # Gather the ways and the nodes they use
+    gather, offsets = _gather(idx["way_offsets"], ways)
+    nodes = np.asarray(idx["way_index"])[gather]
+    used = np.unique(nodes)
+    node_ids = np.asarray(idx["node_ids"])
+
+    gather, tag_offsets = _gather(idx["tag_offsets"], ways)
+    codes = np.asarray(idx["tag_codes"])[gather].tolist()
+    way_tags = []
+    for i in range(len(ways)):
+        tags = {}
+        for c in codes[tag_offsets[i]:tag_offsets[i + 1]]:
+            k, v = idx["tags"][c]
+            tags[k] = v
+        way_tags.append(tags)
+
+    osmap = osm.OSMData()
+    osmap.add_nodes(node_ids[used], idx["latlon"][used])
+    osmap.add_ways(idx["way_ids"][ways], np.diff(offsets), node_ids[nodes], way_tags)
+    for relation in relations:
+        osmap.add_relation(relation)
+    osmap.bounds = {"minlat": str(min_lat), "minlon": str(min_lon),
+                    "maxlat": str(max_lat), "maxlon": str(max_lon)}
+    log.info("Found {} ways and {} relations in the local extract".format(
+        len(ways), len(relations)))
+    return osmap
+
+
+def main():
+    # Configure logging
+    common.setup_logging()
+    log = logging.getLogger(__name__)
+    log.info("PBF - Starting")
+
+    # Set up command line interface
+    parser = ArgumentParser()
+    parser.add_argument(
+            "extract",
+            help="The .osm.pbf extract to read. It is indexed the first time it is used"
+            )
+    parser.add_argument(
+            "outputfile",
+            help="The output filename."
+            )
+    parser.add_argument(
+            "--config",
+            dest="configfile",
+            default="conf/all.yaml",
+            help="Config file to use. Defaults to ./conf/all.yaml"
+            )
+    parser.add_argument(
+            "min_lat",
+            type=float,
+            help="Minimum latitude"
+            )
+    parser.add_argument(
+            "min_lon",
+            type=float,
+            help="Minimum longitude"
+            )
+    parser.add_argument(
+            "max_lat",
+            type=float,
+            help="Maximum latitude"
+            )
+    parser.add_argument(
+            "max_lon",
+            type=float,
+            help="Maximum longitude"
+            )
+
+    # Parse the command line
+    args = parser.parse_args()
+
+    outfile = os.path.abspath(args.outputfile)
+    configfile = os.path.abspath(args.configfile)
+
+    # Load the config
+    config = common.load_config(configfile)
+
+    osmap = get_osm(args.extract, args.min_lat, args.min_lon, args.max_lat, args.max_lon, config)
+
+    # Write out the file
+    osmap.write(outfile)
+
+    # And we are done!
+    log.info("Processing completed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import os
+import re
+import time
+import uuid
+import random
+import logging
+import logging.config
+import threading
+import contextvars
+import email.utils
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Redis is only needed to share the slots between workers
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# Keeps the Overpass requests of all of the workers within the number
+# of slots the server gives us.  Slots are held in a Redis sorted set
+# (shared by every worker using the same Redis) or, if there is no
+# Redis, a semaphore shared by the threads of this process.  Requests
+# that are turned away (429 or 504) are retried after the time given
+# by the server, or a jittered exponential backoff.  A slot's lease in
+# Redis is renewed for as long as it is held, e.g. while a large
+# response is read
+
+
+# Time spent waiting for a slot or backing off, in seconds, summed over
+# every thread of the process.  See WaitClock for the time of a job
+stats = {"wait": 0.0}
+_stats_lock = threading.Lock()
+
+# The WaitClock of the job being run, if it is timing its waits.  Threads
+# started for the job need to be run in a copy of its context to see it
+_clock = contextvars.ContextVar("clock", default=None)
+
+# One scheduler per configuration, so that the session and slots are shared
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+# Take a slot if one is free.  Leases past their expiry time are
+# first dropped, so a crashed worker can't hold a slot forever
+# KEYS[1] slots  ARGV: now, number of slots, expiry time, token
+ACQUIRE = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+if redis.call('zcard', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('zadd', KEYS[1], ARGV[3], ARGV[4])
+    return 1
+end
+return 0
+"""
+
+# Responses that mean the server is too busy for us right now
+RETRY_STATUS = (429, 503, 504)
+
+
+def add_wait(seconds):
+    with _stats_lock:
+        stats["wait"] += seconds
+
+
+# The wall-clock time a job spends with at least one of its requests
+# waiting for a slot or backing off.  Waits on several threads at once
+# are only counted once, so this never exceeds the time taken
+class WaitClock(object):
+
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__waiting = 0
+        self.__since = None
+        self.__wait = 0.0
+
+    @property
+    def wait(self):
+        with self.__lock:
+            if self.__waiting > 0:
+                return self.__wait + time.time() - self.__since
+            return self.__wait
+
+    def start(self):
+        with self.__lock:
+            if self.__waiting == 0:
+                self.__since = time.time()
+            self.__waiting += 1
+
+    def stop(self):
+        with self.__lock:
+            self.__waiting -= 1
+            if self.__waiting == 0:
+                self.__wait += time.time() - self.__since
+
+
+# Times the waits of the requests made within, as:
+#   with scheduler.timing() as clock:
+#       ...
+#   clock.wait
+@contextmanager
+def timing():
+    clock = WaitClock()
+    token = _clock.set(clock)
+    try:
+        yield clock
+    finally:
+        _clock.reset(token)
+
+
+# Counts the time spent within as waiting
+@contextmanager
+def waiting():
+    clock = _clock.get()
+    if clock is not None:
+        clock.start()
+    t = time.time()
+    try:
+        yield
+    finally:
+        add_wait(time.time() - t)
+        if clock is not None:
+            clock.stop()
+
+
+# Returns the scheduler for the overpass section of the config
+def get_scheduler(config):
+    conf = {}
+    if "scheduler" in config["overpass"]:
+        conf = config["overpass"]["scheduler"]
+    key = repr(sorted(conf.items()))
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = Scheduler(conf)
+        return _schedulers[key]
+
+
+class Scheduler(object):
+
+
+    def __init__(self, conf):
+        log = logging.getLogger(__name__)
+        self.slots = conf["slots"] if "slots" in conf else 2
+        self.retries = conf["retries"] if "retries" in conf else 5
+        self.backoff = conf["backoff"] if "backoff" in conf else 2
+        self.max_backoff = conf["max_backoff"] if "max_backoff" in conf else 120
+        self.timeout = conf["timeout"] if "timeout" in conf else 300
+        # A slot is given up if not released in this time
+        self.lease = conf["lease"] if "lease" in conf else 2 * self.timeout
+        self.key = conf["key"] if "key" in conf else "osm2svg:overpass:slots"
+
+        # Keep-alive connections, shared by all the threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.slots, 10))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.__local = threading.BoundedSemaphore(self.slots)
+        # Token -> (Redis client, Event that stops the renewal of its lease)
+        self.__leases = {}
+        self.__redis = None
+        if "redis" in conf:
+            if redis is None:
+                log.warning("redis is not installed, Overpass slots are only shared within this process")
+            else:
+                self.__redis = redis.Redis.from_url(conf["redis"])
+                self.__acquire = self.__redis.register_script(ACQUIRE)
+
+    # Wait for a slot, returning the token that holds it
+    def __take(self):
+        log = logging.getLogger(__name__)
+        if self.__redis is not None:
+            token = "{}:{}:{}".format(os.uname()[1], os.getpid(), uuid.uuid4().hex)
+            delay = 0.1
+            try:
+                while True:
+                    now = time.time()
+                    if self.__acquire(keys=[self.key],
+                            args=[now, self.slots, now + self.lease, token]) == 1:
+                        self.__renew(token)
+                        return token
+                    time.sleep(delay * random.uniform(0.5, 1.5))
+                    delay = min(delay * 2, 2)
+            except redis.exceptions.RedisError as e:
+                log.warning("Redis unavailable, using local slots: {}".format(e))
+                self.__redis = None
+        self.__local.acquire()
+        return None
+
+    # Push the expiry of the lease on a slot back every third of the
+    # lease, until it is given up
+    def __renew(self, token):
+        log = logging.getLogger(__name__)
+        client = self.__redis
+        stop = threading.Event()
+        self.__leases[token] = (client, stop)
+
+        def renew():
+            while not stop.wait(self.lease / 3):
+                try:
+                    client.zadd(self.key, {token: time.time() + self.lease}, xx=True)
+                except redis.exceptions.RedisError as e:
+                    log.warning("Unable to renew slot: {}".format(e))
+
+        threading.Thread(target=renew, daemon=True).start()
+
+    def __give(self, token):
+        log = logging.getLogger(__name__)
+        if token is None:
+            self.__local.release()
+        else:
+            client, stop = self.__leases.pop(token)
+            stop.set()
+            try:
+                client.zrem(self.key, token)
+            except redis.exceptions.RedisError as e:
+                # The lease will expire anyway
+                log.warning("Unable to release slot: {}".format(e))
+
+    # How long Overpass says to wait, from Retry-After or the status page
+    def __retry_after(self, endpoint, response):
+        if response is not None and "Retry-After" in response.headers:
+            value = response.headers["Retry-After"]
+            if value.isdigit():
+                return int(value)
+            try:
+                when = email.utils.parsedate_to_datetime(value)
+                return max(0, when.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+        if response is not None and response.status_code == 429 and \
+                endpoint.endswith("/interpreter"):
+            # Overpass lists when each of our slots will be free
+            try:
+                status = self.session.get(endpoint[:-len("interpreter")] + "status",
+                                          timeout=10).text
+            except requests.RequestException:
+                return None
+            if re.search(r"\d+ slots? available now", status):
+                return 0
+            waits = [int(s) for s in re.findall(r"in (\d+) seconds", status)]
+            if len(waits) > 0:
+                return min(waits)
+        return None
+
+    # POST a query to the endpoint, holding a slot until the response
+    # has been read.  The slot is given up while backing off, so that
+    # other workers can use it.  With split=True the caller can split
+    # a query that the server gives up on (504 or a read timeout) and
+    # would rather do that than wait to send it again, so these are
+    # raised at once.  Use as a context manager:
+    #   with scheduler.post(endpoint, query, stream=True) as r:
+    @contextmanager
+    def post(self, endpoint, query, stream=False, split=False):
+        log = logging.getLogger(__name__)
+        retry = RETRY_STATUS
+        if split:
+            retry = tuple(status for status in RETRY_STATUS if status != 504)
+        attempt = 0
+        while True:
+            with waiting():
+                token = self.__take()
+            response = None
+            try:
+                response = self.session.post(endpoint, data=query,
+                        stream=stream, timeout=(10, self.timeout))
+                if response.status_code not in retry:
+                    break
+                problem = "HTTP {}".format(response.status_code)
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if split and isinstance(e, requests.ReadTimeout):
+                    raise
+                problem = str(e)
+                error = e
+            finally:
+                if response is None or response.status_code in retry:
+                    self.__give(token)
+
+            attempt += 1
+            if attempt > self.retries:
+                log.error("Overpass failed after {} retries: {}".format(self.retries, problem))
+                if response is not None:
+                    response.raise_for_status()
+                # Re-raised as is, so that a timeout can be told apart
+                raise error
+
+            wait = self.__retry_after(endpoint, response)
+            if wait is None:
+                wait = self.backoff * 2 ** (attempt - 1)
+            # Jitter so that the workers don't all come back at once
+            wait = min(self.max_backoff, wait) * random.uniform(1, 1.5)
+            log.warning("Overpass busy ({}), retrying in {:.1f}s".format(problem, wait))
+            with waiting():
+                time.sleep(wait)
+
+        try:
+            response.raise_for_status()
+            yield response
+        finally:
+            response.close()
+            self.__give(token)
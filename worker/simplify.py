@@ -0,0 +1,77 @@
+import logging
+import logging.config
+
+import numpy as np
+
+
+# Douglas-Peucker simplification of many polylines at once.  Rather
+# than recursing line by line, every span still to be looked at (of
+# every line) is handled together in each round, so the work is done
+# in a few passes of numpy over all of the points
+
+
+# Returns lines, a list of (n, 2) arrays, with the points dropped that
+# are within tolerance of the simplified line.  The points are scaled
+# by scale (per column) before measuring, so that the tolerance can be
+# in other units, e.g. mm on the map.  The ends of each line are
+# always kept, and closed lines that would be left with fewer than
+# four points are kept as they are
+def simplify(lines, tolerance, scale=(1.0, 1.0)):
+    log = logging.getLogger(__name__)
+    if len(lines) == 0:
+        return []
+
+    lengths = np.array([len(line) for line in lines])
+    original = np.concatenate(lines)
+    points = original * np.asarray(scale, dtype=np.float64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[offsets[:-1]] = True
+    keep[offsets[1:] - 1] = True
+
+    # Spans of (start, end) points with points between them to check
+    starts = offsets[:-1]
+    ends = offsets[1:] - 1
+    tolerance2 = tolerance * tolerance
+    while True:
+        spans = ends - starts > 1
+        starts = starts[spans]
+        ends = ends[spans]
+        if len(starts) == 0:
+            break
+
+        # Every point inside every span, with the span it is in
+        counts = ends - starts - 1
+        firsts = np.cumsum(counts) - counts
+        span = np.repeat(np.arange(len(starts)), counts)
+        index = np.arange(len(span)) - firsts[span] + starts[span] + 1
+
+        # Squared distance of each point from its span's chord
+        a = points[starts[span]]
+        ab = points[ends[span]] - a
+        ap = points[index] - a
+        length2 = np.einsum("ij,ij->i", ab, ab)
+        t = np.einsum("ij,ij->i", ap, ab) / np.where(length2 > 0, length2, 1)
+        t = np.clip(np.where(length2 > 0, t, 0), 0, 1)
+        off = ap - t[:, np.newaxis] * ab
+        distance2 = np.einsum("ij,ij->i", off, off)
+
+        # The furthest point of each span splits it, if out of tolerance
+        furthest = np.maximum.reduceat(distance2, firsts)
+        candidates = np.flatnonzero(distance2 == furthest[span])
+        first = np.concatenate(([True], span[candidates][1:] != span[candidates][:-1]))
+        split = index[candidates[first]]
+        out = furthest > tolerance2
+        split = split[out]
+        keep[split] = True
+        starts, ends = np.concatenate((starts[out], split)), np.concatenate((split, ends[out]))
+
+    kept = np.add.reduceat(keep.astype(np.int64), offsets[:-1])
+    simplified = np.split(original[keep], np.cumsum(kept)[:-1])
+    for i, line in enumerate(lines):
+        if kept[i] < 4 and lengths[i] >= 4 and (line[0] == line[-1]).all():
+            simplified[i] = line
+    log.debug("Simplified {} lines from {} to {} points".format(
+        len(lines), len(points), int(np.sum(keep))))
+    return simplified
@@ -12,6 +12,11 @@
 import os
 import sys
 import math
+import json
+import zlib
+import fcntl
+import struct
+import threading
 import logging
 import logging.config
 import yaml
@@ -23,13 +28,14 @@ import xml.etree.ElementTree as ET
 import requests
 from requests.auth import HTTPBasicAuth
 from requests.compat import urljoin
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from skimage import measure
-
-from zipfile import ZipFile
 
 import common
+import marching
+import simplify
 
 
 # Session code from: 
@@ -59,48 +65,275 @@ class SessionWithHeaderRedirection(requests.Session):
         return
 
 
-def download(url, config):
-    log = logging.getLogger(__name__)
-    log.info("Downloading: " + url)
+# Size of the pieces a tile is downloaded and decoded in
+CHUNK_SIZE = 1024 * 1024
+
+# Sessions for each credentials file, shared by the downloads
+_sessions = {}
+_sessions_lock = threading.Lock()
 
+
+# An authenticated session, pooled so that tiles can be downloaded
+# several at once over kept alive connections
+def get_session(config):
     credsfile = os.path.abspath(config["options"]["credentials"])
-    creds = common.load_config(credsfile)
+    with _sessions_lock:
+        if credsfile not in _sessions:
+            creds = common.load_config(credsfile)
+            session = SessionWithHeaderRedirection(creds["username"], creds["password"])
+            adapter = HTTPAdapter(pool_maxsize=16)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[credsfile] = session
+        return _sessions[credsfile]
+
+
+# Yields the contents of the first file in a zip as it is decompressed,
+# from the zip in chunks.  The zip is read from the start, without the
+# central directory at the end, so a download can be decoded as it
+# arrives
+def unzip_stream(chunks):
+    chunks = iter(chunks)
+
+    def more():
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("The zip ended early")
+        return chunk
+
+    data = b""
+    header = struct.Struct("<IHHHHHIIIHH")
+    while len(data) < header.size:
+        data += more()
+    signature, version, flags, method, mtime, mdate, crc, csize, size, name_len, extra_len = \
+            header.unpack(data[:header.size])
+    if signature != 0x04034b50:
+        raise ValueError("Not a zip file")
+    while len(data) < header.size + name_len + extra_len:
+        data += more()
+    data = data[header.size + name_len + extra_len:]
+
+    if method == 0:
+        # Stored
+        remaining = size
+        while remaining > 0:
+            piece = data[:remaining]
+            remaining -= len(piece)
+            yield piece
+            if remaining > 0:
+                data = more()
+    elif method == 8:
+        # Deflated, which ends itself
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while True:
+            yield decompressor.decompress(data)
+            if decompressor.eof:
+                break
+            data = more()
+    else:
+        raise ValueError("Unsupported zip compression method {}".format(method))
 
+
+# Write the tile's big endian .hgt data, given in pieces, into the native
+# endian .npy used by load_tile.  Nothing is visible until it is complete
+def save_tile(pieces, npyfile, samples):
+    log = logging.getLogger(__name__)
+    row_bytes = samples * 2
+    tmpfile = npyfile + ".tmp{}".format(os.getpid())
+    npy = np.lib.format.open_memmap(tmpfile, "w+", np.int16, (samples, samples))
+    try:
+        row = 0
+        data = b""
+        for piece in pieces:
+            data += piece
+            rows = min(len(data) // row_bytes, samples - row)
+            if rows > 0:
+                npy[row:row + rows] = np.frombuffer(data, np.dtype('>i2'), rows * samples) \
+                        .reshape((rows, samples))
+                row += rows
+                data = data[rows * row_bytes:]
+        if row != samples:
+            raise ValueError("Tile has {} rows, expected {}".format(row, samples))
+        npy.flush()
+    except BaseException:
+        npy = None
+        os.remove(tmpfile)
+        raise
+    npy = None
+    os.replace(tmpfile, npyfile)
+    log.info("Saved " + npyfile)
+
+
+# Ask for url, from offset bytes on if more than 0
+def request_tile(config, url, offset=0):
+    headers = {}
+    if offset > 0:
+        headers["Range"] = "bytes={}-".format(offset)
+    return get_session(config).get(url, stream=True, headers=headers, timeout=(10, 300))
+
+
+# Yields a download in chunks, adding them to partfile as they arrive.
+# The first offset bytes are read back from partfile, left there by an
+# earlier attempt, and response is the rest.  If the connection drops
+# the download is resumed with a Range request, up to retries times
+def download_chunks(config, url, response, partfile, offset, retries):
+    log = logging.getLogger(__name__)
+    try:
+        with open(partfile, "ab" if offset > 0 else "wb") as part:
+            if offset > 0:
+                with open(partfile, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        yield chunk
+            attempt = 0
+            while True:
+                try:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        part.write(chunk)
+                        offset += len(chunk)
+                        yield chunk
+                    return
+                except (requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.ConnectionError) as e:
+                    attempt += 1
+                    if attempt > retries:
+                        raise
+                    log.warning("Download of {} interrupted after {} bytes, resuming: {}".format(
+                        url, offset, e))
+                    part.flush()
+                    response.close()
+                    response = request_tile(config, url, offset)
+                    if response.status_code != (206 if offset > 0 else 200):
+                        response.raise_for_status()
+                        raise requests.exceptions.HTTPError(
+                            "Unable to resume the download of " + url, response=response)
+    finally:
+        response.close()
+
+
+# Fetch a tile straight into the .npy cache.  Returns True if it was
+# saved, False if there is no data for it (maybe in the sea) and None
+# if it couldn't be downloaded.
+# The data directory may be shared by several workers, so each tile is
+# locked while it is fetched.  Workers wanting the same tile wait for
+# the lock and then find the tile there already.  The download is kept
+# in a .part file until it is decoded, so that if it fails part way it
+# can be carried on from there next time
+def fetch_tile(config, grid):
+    log = logging.getLogger(__name__)
     datadir = config["options"]["datadir"]
+    samples = config["data"]["samples"]
+    npyfile = os.path.abspath(os.path.join(datadir, grid + ".npy"))
+
+    with open(os.path.join(datadir, grid + ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(npyfile):
+            log.info("Fetched by another worker: " + npyfile)
+            return True
+        if grid in read_nodata(datadir):
+            return False
+
+        template = config["data"]["url_template"]
+        url = template.replace("<GRID>", grid, 1)
+        zipfilename = os.path.join(datadir, url[url.rfind('/')+1:])
+        if os.path.exists(zipfilename):
+            # Downloaded by an earlier version
+            log.info("Decoding: " + zipfilename)
+            with open(zipfilename, "rb") as f:
+                save_tile(unzip_stream(iter(lambda: f.read(CHUNK_SIZE), b"")), npyfile, samples)
+            return True
+
+        partfile = zipfilename + ".part"
+        offset = 0
+        if os.path.exists(partfile):
+            offset = os.path.getsize(partfile)
+        retries = 3
+        if "retries" in config["data"]:
+            retries = config["data"]["retries"]
+
+        try:
+            if offset > 0:
+                log.info("Resuming: {} from {} bytes".format(url, offset))
+            else:
+                log.info("Downloading: " + url)
+            # submit the request using the session
+            response = request_tile(config, url, offset)
+            if response.status_code == 416:
+                # The part is no use, so start again
+                response.close()
+                response = request_tile(config, url)
+            if response.status_code == 200:
+                # The whole download, whether or not a part was asked for
+                offset = 0
+
+            if response.status_code in (200, 206):
+                # decode as it arrives
+                chunks = download_chunks(config, url, response, partfile, offset, retries)
+                try:
+                    save_tile(unzip_stream(chunks), npyfile, samples)
+                except (ValueError, zlib.error) as e:
+                    # Not a tile, so don't carry on from it next time
+                    os.remove(partfile)
+                    log.error("Unable to decode {}: {}".format(url, e))
+                    return None
+                finally:
+                    chunks.close()
+                os.remove(partfile)
+                return True
+
+            response.close()
+            if response.status_code == 401:
+                log.error("Unauthorized to get the data. "  + 
+                        "Have you put your login details into " +
+                        "the credentials.yaml file?")
+                log.error("If you don't have a login go to " +
+                        "https://ers.cr.usgs.gov/register/")
+            elif response.status_code == 404:
+                log.warning("Unable to find: " + url)
+                log.warning("Maybe its in the sea? (No data)")
+                # Recorded while locked, so that others waiting don't ask again
+                add_nodata(datadir, [grid])
+                log.warning("Data not downloaded for " + grid + ", recorded in " +
+                            os.path.join(datadir, "nodata.json") +
+                            " If you want to redownload please remove it from there")
+                return False
+            else:
+                # raise an exception in case of http errors
+                response.raise_for_status()
+
+        except requests.exceptions.RequestException as e:
+            # handle any errors here, keeping the part to carry on from
+            log.error(e)
+    return None
+
+
+# The grids known to have no data, listed in nodata.json in the datadir
+def read_nodata(datadir):
+    try:
+        with open(os.path.join(datadir, "nodata.json")) as f:
+            return set(json.load(f))
+    except FileNotFoundError:
+        return set()
 
-    # extract the filename from the url to be used when saving the file
-    filename = os.path.join(datadir, url[url.rfind('/')+1:])  
-    filename = os.path.abspath(filename) 
-    # create session with the user credentials that will be used to
-    # authenticate access to the data
-    session = SessionWithHeaderRedirection(creds["username"], creds["password"])
 
-    try:
-        # submit the request using the session
-        response = session.get(url, stream=True)
-        if response.status_code == 200:
-            # save the file
-            with open(filename, 'wb') as fd:
-                for chunk in response.iter_content(chunk_size=1024*1024):
-                    fd.write(chunk)
-                log.info("Successfully saved to " + filename)
-        elif response.status_code == 401:
-            log.error("Unauthorized to get the data. "  + 
-                    "Have you put your login details into " +
-                    "the credentials.yaml file?")
-            log.error("If you don't have a login go to " +
-                    "https://ers.cr.usgs.gov/register/")
-        elif response.status_code == 404:
-            log.warning("Unable to find: " + url)
-            log.warning("Maybe its in the sea? (No data)")
-        else:
-            # raise an exception in case of http errors
-            print(response.status_code)
-            response.raise_for_status()  
+# Locked, as other workers may be adding to it too
+def add_nodata(datadir, grids):
+    log = logging.getLogger(__name__)
+    manifest = os.path.join(datadir, "nodata.json")
+    with open(manifest + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        nodata = read_nodata(datadir) | set(grids)
+        tmpfile = manifest + ".tmp{}".format(os.getpid())
+        with open(tmpfile, "w") as f:
+            json.dump(sorted(nodata), f)
+        os.replace(tmpfile, manifest)
+    log.info("No data for {}".format(", ".join(grids)))
 
-    except requests.exceptions.HTTPError as e:
-        # handle any errors here
-        log.error(e)
+
+# Is there data for a tile, either as the .npy or a .hgt to convert?
+def has_tile(filename):
+    npyfile = os.path.splitext(filename)[0] + ".npy"
+    return os.path.exists(npyfile) or \
+        (os.path.exists(filename) and os.path.getsize(filename) > 0)
 
 
 def get_SRTM_grid(lat, lon):
@@ -149,53 +382,317 @@ def get_SRTM_data(config, min_lat, min_lon, max_lat, max_lon):
     os.makedirs(datadir, exist_ok=True)
 
     # Make sure we have the data
+    nodata = read_nodata(datadir)
+    missing = []
+    touched = []
     for grid in grids:
         log.info("Checking data for grid " + grid)
         # Check to see whether we already have this data
         filename = os.path.join(datadir, grid + ".hgt")
         filename = os.path.abspath(filename)
 
-        if os.path.exists(filename):
-            log.info("Data available: " + filename)
+        if grid in nodata:
+            log.info("No data for grid " + grid)
+        elif os.path.exists(filename) and os.path.getsize(filename) == 0:
+            # An empty file was "touched" by earlier versions to
+            # mark no data
+            touched.append(grid)
+        elif has_tile(filename):
+            log.info("Data available for grid " + grid)
         else:
-            template = config["data"]["url_template"]
-            url = template.replace("<GRID>", grid, 1)
-            zipfilename = os.path.join(datadir, url[url.rfind('/')+1:])  
-            # Download
-            if not os.path.exists(zipfilename):
-                download(url, config)
-            # If still not downloaded it may be sea (no data)
-            if not os.path.exists(zipfilename):
-                datafile = os.path.join(datadir, grid + ".hgt")
-                log.warning("Data not downloaded - Touching " + datafile +
-                            " If you want to redownload please delete this file")
-                open(datafile, "a").close()
-
-            # Unzip
-            if os.path.exists(zipfilename):
-                log.info("Unzipping: " + zipfilename)
-                with ZipFile(zipfilename, "r") as zipf:
-                    zipf.extractall(datadir)
-
-
-def constrain(value, max):
-    if value < 0:
-        value = 0
-    elif value > max:
-        value = max
-    return value
-
-
-def contour(config, interval, min_lat, min_lon, max_lat, max_lon):
+            missing.append(grid)
+
+    # Download the missing tiles all at once
+    if len(missing) > 0:
+        workers = 4
+        if "workers" in config["data"]:
+            workers = config["data"]["workers"]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda grid: fetch_tile(config, grid), missing))
+
+    if len(touched) > 0:
+        add_nodata(datadir, touched)
+
+
+# Returns a tile's elevations as a read only memory map.  The first
+# time a tile is used its big endian .hgt is converted to a native
+# endian .npy alongside it.  After that only the pages under the part
+# of the tile in use are read, with no byte swapped copy, and the page
+# cache holding them is shared by all of the workers.
+# With a factor, an overview with every factor'th sample is returned,
+# made from the next finer overview the first time it is needed
+def load_tile(filename, samples, factor=1):
+    log = logging.getLogger(__name__)
+    if factor > 1:
+        finer = load_tile(filename, samples, factor // 2)
+        npyfile = os.path.splitext(filename)[0] + ".x{}.npy".format(factor)
+        if not os.path.exists(npyfile) or \
+                os.path.getmtime(npyfile) < os.path.getmtime(finer.filename):
+            log.info("Making overview {}".format(npyfile))
+            overview = reduce_tile(finer)
+            tmpfile = npyfile + ".tmp{}".format(os.getpid())
+            with open(tmpfile, "wb") as f:
+                np.save(f, overview)
+            os.replace(tmpfile, npyfile)
+        return np.load(npyfile, mmap_mode="r")
+
+    # Tiles downloaded by fetch_tile only have the .npy
+    npyfile = os.path.splitext(filename)[0] + ".npy"
+    if os.path.exists(filename) and (not os.path.exists(npyfile) or \
+            os.path.getmtime(npyfile) < os.path.getmtime(filename)):
+        log.info("Converting {} to {}".format(filename, npyfile))
+        hgt = np.memmap(filename, np.dtype('>i2'), "r", shape=(samples, samples))
+        # Written alongside then moved into place, as other workers
+        # may be reading or converting the same tile
+        tmpfile = npyfile + ".tmp{}".format(os.getpid())
+        npy = np.lib.format.open_memmap(tmpfile, "w+", np.int16, (samples, samples))
+        # A band of rows at a time, to keep the memory used down
+        for row in range(0, samples, 256):
+            npy[row:row + 256] = hgt[row:row + 256]
+        npy.flush()
+        del npy, hgt
+        os.replace(tmpfile, npyfile)
+    return np.load(npyfile, mmap_mode="r")
+
+
+# Halve the resolution of a tile, smoothing with a 1 2 1 filter before
+# keeping every other sample.  The edge rows and columns are only
+# smoothed along themselves, so that they stay the same as those of
+# the neighbouring tiles.  Samples near a hole are left as holes
+def reduce_tile(elevations):
+    def reduce(z):
+        # Down the columns, at the rows kept
+        v = z[::2].copy()
+        v[1:-1] = (z[1:-2:2] + 2 * z[2:-1:2] + z[3::2]) / 4
+        # Along the rows, at the columns kept
+        h = v[:, ::2].copy()
+        h[:, 1:-1] = (v[:, 1:-2:2] + 2 * v[:, 2:-1:2] + v[:, 3::2]) / 4
+        return h
+
+    z = np.asarray(elevations, dtype=np.float32)
+    holes = reduce((z == -32768).astype(np.float32)) > 0
+    reduced = np.rint(reduce(z)).astype(np.int16)
+    reduced[holes] = -32768
+    return reduced
+
+
+# The mm on a map x_mm wide or y_mm high of a degree of latitude and
+# of longitude.  In the Mercator projection of the map a degree of
+# latitude is the longer of the two
+def get_map_mm(min_lat, min_lon, max_lat, max_lon, x_mm=None, y_mm=None):
+    stretch = 1 / math.cos(math.radians((min_lat + max_lat) / 2))
+    if x_mm is not None:
+        lon_mm = x_mm / (max_lon - min_lon)
+    else:
+        lon_mm = y_mm / (max_lat - min_lat) / stretch
+    return lon_mm * stretch, lon_mm
+
+
+# The coarsest overview factor for a map x_mm wide or y_mm high whose
+# samples are no further apart on the map than data.feature_mm, the
+# smallest detail worth drawing.  1 (all of the data) if not known
+def get_factor(config, min_lat, min_lon, max_lat, max_lon, x_mm=None, y_mm=None):
+    log = logging.getLogger(__name__)
+    if "feature_mm" not in config["data"] or (x_mm is None and y_mm is None):
+        return 1
+    res = config["data"]["samples"] - 1
+    max_factor = 16
+    if "max_factor" in config["data"]:
+        max_factor = config["data"]["max_factor"]
+
+    # The samples are closest together across the map
+    lat_mm, lon_mm = get_map_mm(min_lat, min_lon, max_lat, max_lon, x_mm, y_mm)
+    spacing = lon_mm / res
+
+    factor = 1
+    while factor * 2 <= max_factor and res % (factor * 2) == 0 and \
+            spacing * factor * 2 <= config["data"]["feature_mm"]:
+        factor *= 2
+    log.info("Samples {:.3f}mm apart, using overview factor {}".format(spacing * factor, factor))
+    return factor
+
+
+# The contours of a whole tile at every interval metres, as arrays of
+# the heights, the first line of each height (and the end), the first
+# point of each line (and the end) and the points as row, column of the
+# tile.  Contours depend only on the tile, interval and factor, so they
+# are made once and kept in a .npz alongside the tile for later maps.
+# Tiles with no data have no contours
+def tile_contours(config, grid, interval, factor=1):
+    log = logging.getLogger(__name__)
+    datadir = config["options"]["datadir"]
+    filename = os.path.join(datadir, grid + ".hgt")
+    if not has_tile(filename):
+        log.warning("SRTM file {} has no content. Maybe in the sea?".format(filename))
+        return None
+
+    tile = load_tile(filename, config["data"]["samples"], factor)
+    npzfile = os.path.join(datadir, "{}.c{}.x{}.npz".format(grid, interval, factor))
+    if os.path.exists(npzfile) and os.path.getmtime(npzfile) >= os.path.getmtime(tile.filename):
+        with np.load(npzfile) as cached:
+            return cached["heights"], cached["levels"], cached["lines"], cached["points"]
+
+    log.info("Contouring {} every {}m".format(tile.filename, interval))
+    # Get the lowest and highest points in the tile
+    max = np.amax(tile)
+    min = np.amin(tile)
+    if min == -32768:
+        # Missing height data is given the value -32768
+        log.warning("There are holes in your SRTM data, " +
+                    "setting min height to -40m")
+        min = -40
+
+    log.info("min height: {}, max height: {}".format(min, max))
+
+    # Find the contours at all of the heights from min to max in one
+    # pass over the data, a band of the tile's rows at a time.  Each
+    # height's points are kept as float32 as soon as they are made
+    heights = np.arange(interval * (min // interval) + interval,
+            interval * (max // interval) + interval, interval, dtype=np.int32)
+    log.info("Processing {} contour heights".format(len(heights)))
+    points = []
+    lengths = []
+    for contours in marching.iter_contours(tile, heights):
+        lengths.append(np.array([len(line) for line in contours], dtype=np.int64))
+        if len(contours) > 0:
+            points.append(np.concatenate(contours).astype(np.float32))
+    levels = np.cumsum([0] + [len(level) for level in lengths])
+    ends = np.cumsum(np.concatenate([[0]] + lengths))
+    if len(points) > 0:
+        points = np.concatenate(points)
+    else:
+        points = np.zeros((0, 2), dtype=np.float32)
+
+    # Written alongside then moved into place, as other workers may
+    # be reading or contouring the same tile
+    tmpfile = npzfile + ".tmp{}".format(os.getpid())
+    with open(tmpfile, "wb") as f:
+        np.savez(f, heights=heights, levels=levels, lines=ends, points=points)
+    os.replace(tmpfile, npzfile)
+    log.info("Saved {} lines of {} points to {}".format(len(ends) - 1, len(points), npzfile))
+    return heights, levels, ends, points
+
+
+# Cut the lines of points to those inside rows top to btm and columns
+# lft to rgt, both inclusive.  Lines leaving and coming back in are
+# split.  Returns the first line of each level (and the end) and the
+# lines of the points inside
+def clip_lines(levels, lines, points, top, btm, lft, rgt):
+    inside = (points[:, 0] >= top) & (points[:, 0] <= btm) & \
+        (points[:, 1] >= lft) & (points[:, 1] <= rgt)
+
+    # Runs of points inside the same line
+    line = np.repeat(np.arange(len(lines) - 1), np.diff(lines))
+    run = np.where(inside, line, -1)
+    starts = np.flatnonzero(np.diff(run, prepend=-2, append=-2) != 0)
+    keep = (run[starts[:-1]] >= 0) & (np.diff(starts) > 1)
+    ends = starts[1:][keep]
+    starts = starts[:-1][keep]
+
+    level = np.searchsorted(levels, line[starts], "right") - 1
+    first = np.searchsorted(level, np.arange(len(levels)), "left")
+    return first, [points[s:e] for s, e in zip(starts, ends)]
+
+
+# Join up lines that carry on where another leaves off.  A contour
+# crossing from one tile to the next ends on their shared edge row or
+# column in one and starts there in the other, as both tiles have the
+# same samples along it, at exactly the same point.  Returns the joined
+# lines in the order of their first part
+def join_lines(lines):
+    starts = {}
+    for i, line in enumerate(lines):
+        starts.setdefault(tuple(line[0].tolist()), i)
+
+    # The line each one carries on into, if any
+    after = {}
+    before = {}
+    for i, line in enumerate(lines):
+        j = starts.get(tuple(line[-1].tolist()))
+        if j is not None and j != i and j not in before:
+            after[i] = j
+            before[j] = i
+
+    joined = []
+    done = set()
+    # Lines with no part before them first, then those left that join
+    # up into rings, from where they come first
+    for i in [i for i in range(len(lines)) if i not in before] + list(range(len(lines))):
+        if i in done:
+            continue
+        parts = [lines[i]]
+        done.add(i)
+        j = after.get(i)
+        while j is not None and j not in done:
+            parts.append(lines[j][1:])
+            done.add(j)
+            j = after.get(j)
+        joined.append((i, np.concatenate(parts) if len(parts) > 1 else parts[0]))
+    return [line for _, line in sorted(joined, key=lambda entry: entry[0])]
+
+
+# Yields the contour lines of the area as (tags, path), where path is
+# an (n, 2) array of lat, lon and the tags are those of an OSM contour
+# way.  x_mm and y_mm are the size of the map, if known, so that no
+# more detail is contoured than can be drawn at that size
+def contour_lines(config, interval, min_lat, min_lon, max_lat, max_lon, x_mm=None, y_mm=None):
     log = logging.getLogger(__name__)
 
     # Make sure we have the SRTM tiles
     get_SRTM_data(config, min_lat, min_lon, max_lat, max_lon)
 
-    # Define some variables to ease code readability
-    datadir = config["options"]["datadir"]
-    samples = config["data"]["samples"]
+    # Samples per degree of the data used
+    factor = get_factor(config, min_lat, min_lon, max_lat, max_lon, x_mm, y_mm)
+    res = (config["data"]["samples"] - 1) // factor
 
+    # Each tile's contours are cut to the area, keeping the samples
+    # around it so that the lines reach its edges.  Neighbouring tiles
+    # share their edge samples, so their lines meet exactly and are
+    # joined up again afterwards
+    contours = {}
+    for grid in get_SRTM_grid_list(min_lat, min_lon, max_lat, max_lon):
+        log.debug("Grid: " + grid)
+        found = tile_contours(config, grid, interval, factor)
+        if found is None:
+            continue
+        heights, levels, lines, points = found
+
+        # Lat/lon of the tile's top left sample
+        lat = int(grid[1:3]) * (-1 if grid[0] == "S" else 1) + 1
+        lon = int(grid[4:]) * (-1 if grid[3] == "W" else 1)
+        top = math.floor((lat - max_lat) * res)
+        btm = math.ceil((lat - min_lat) * res)
+        lft = math.floor((min_lon - lon) * res)
+        rgt = math.ceil((max_lon - lon) * res)
+        log.info("Subsetting contours to: [{}:{}, {}:{}]".format(top, btm, lft, rgt))
+        first, clipped = clip_lines(levels, lines, points, top, btm, lft, rgt)
+
+        # Convert the rows and columns back to lat/lon
+        for i, height in enumerate(heights.tolist()):
+            contours.setdefault(height, []).extend(
+                np.column_stack((lat - line[:, 0].astype(np.float64) / res,
+                                 lon + line[:, 1].astype(np.float64) / res))
+                for line in clipped[first[i]:first[i + 1]])
+
+    heights = sorted(contours)
+    contours = {height: join_lines(contours[height]) for height in heights}
+    if "tolerance_mm" in config["data"] and (x_mm is not None or y_mm is not None):
+        # Drop the points that make no difference on the map, measuring
+        # the lat and lon in mm
+        lat_mm, lon_mm = get_map_mm(min_lat, min_lon, max_lat, max_lon, x_mm, y_mm)
+        lines = iter(simplify.simplify([line for height in heights for line in contours[height]],
+                config["data"]["tolerance_mm"], (lat_mm, lon_mm)))
+        contours = {height: [next(lines) for line in contours[height]] for height in heights}
+
+    for height in heights:
+        log.debug("Processing contour at height " + str(height))
+        tags = {"contour": "elevation", "ele": str(height)}
+        for line in contours[height]:
+            yield tags, line
+
+
+# The contour lines as OSM XML, with a node for every point
+def contour(config, interval, min_lat, min_lon, max_lat, max_lon, x_mm=None, y_mm=None):
     # Create the root OSM node and the bounds tag
     root = ET.Element("osm")
     ET.SubElement(root, "bounds", 
@@ -207,95 +704,25 @@ def contour(config, interval, min_lat, min_lon, max_lat, max_lon):
     # Start ID counter for nodes and ways
     id = 1000000000
 
-    # Get each data file for the area of interest
-    grids = get_SRTM_grid_list(min_lat, min_lon, max_lat, max_lon)
-    for grid in grids:
-        log.debug("Grid: " + grid)
-        # Set up some base data for each grid
-        lat_sign = 1
-        lon_sign = 1
-        if grid[0] == "S":
-            lat_sign = -1
-        if grid[3] == "W":
-            lon_sign = -1
-        base_lat = int(grid[1:3]) * lat_sign
-        base_lon = int(grid[4:]) * lon_sign
-
-
-        # Generate the contours for a single SRTM tile
-        filename = os.path.join(datadir, grid + ".hgt")
-        if os.path.exists(filename) and os.path.getsize(filename) > 0:
-            # Checking size > 0 allows us to "touch" empty files to prevent downloads
-            with open(filename, "rb") as f:
-                # Each data is 16bit signed integer(i2) - big endian(>)
-                elevations = np.fromfile(f, np.dtype('>i2'), samples*samples)\
-                        .reshape((samples, samples))
-
-
-                # Work out the data we want to process from this tile
-                log.debug("base_lat: {}, base_lon: {}".format(base_lat, base_lon))
-                log.debug("min_lat: {}, min_lon: {}, max_lat: {}, max_lon: {}".format(min_lat, min_lon, max_lat, max_lon))
-
-
-                # Convert lat/lon to array indexes
-                top = int(((base_lat + 1) - max_lat) * (samples - 1))
-                top = constrain(top, samples)
-                btm = int(((base_lat + 1) - min_lat) * (samples - 1))
-                btm = constrain(btm, samples)
-                lft = int((min_lon - base_lon) * (samples - 1))
-                lft = constrain(lft, samples)
-                rgt = int((max_lon - base_lon) * (samples - 1))
-                rgt = constrain(rgt, samples)
-
-                # Get co-ords for top left corner of the array
-                # so we can convert back to lat/lon
-                top_lat = base_lat + 1 - top / (samples - 1)
-                lft_lon = base_lon + lft / (samples - 1)
-
-                # Subset the array
-                log.info("Subsetting data to: [{}:{}, {}:{}]".format(top, btm, lft, rgt))
-                subset = elevations[top:btm, lft:rgt]
-                x_range = rgt - lft
-                y_range = btm - top
-                log.debug("NP - Width: {}, Height: {}".format(x_range, y_range))
-
-                # Get the lowest and highest points in the range
-                max = np.amax(subset)
-                min = np.amin(subset)
-                if min == -32768:
-                    # Missing height data is given the value -32768
-                    log.warning("There are holes in your SRTM data, " +
-                                "setting min height to -40m")
-                    min = -40
-
-                log.info("min height: {}, max height: {}".format(min, max))
-
-                # Loop through the contour heights from min to max
-                for height in range(interval * (min // interval) + interval,
-                        interval * (max // interval) + interval, interval):
-                    log.info("Processing contour at height " + str(height))
-
-                    for line in measure.find_contours(subset, height):
-                        nd_refs = []
-                        for nd in line:
-                            id += 1
-                            nd_refs.append(id)
-                            attr = {"id": str(id),
-                                    "lat": str(top_lat - nd[0] / (samples - 1)),
-                                    "lon": str(lft_lon + nd[1] / (samples - 1))
-                                    }
-                            ET.SubElement(root, "node", attr)
-                            #log.debug("{} => {}".format(str(nd), str(attr)))
-
-                        id += 1
-                        way = ET.SubElement(root, "way", {"id": str(id)})
-                        for nr in nd_refs:
-                            ET.SubElement(way, "nd", {"ref": str(nr)})
-
-                        ET.SubElement(way, "tag", {"k": "contour", "v": "elevation"})
-                        ET.SubElement(way, "tag", {"k": "ele", "v": str(height)})
-        else:
-            log.warning("SRTM file {} has no content. Maybe in the sea?".format(filename))
+    for tags, path in contour_lines(config, interval, min_lat, min_lon, max_lat, max_lon,
+                                    x_mm, y_mm):
+        nd_refs = []
+        for lat, lon in path.tolist():
+            id += 1
+            nd_refs.append(id)
+            attr = {"id": str(id),
+                    "lat": str(lat),
+                    "lon": str(lon)
+                    }
+            ET.SubElement(root, "node", attr)
+
+        id += 1
+        way = ET.SubElement(root, "way", {"id": str(id)})
+        for nr in nd_refs:
+            ET.SubElement(way, "nd", {"ref": str(nr)})
+
+        for k in tags:
+            ET.SubElement(way, "tag", {"k": k, "v": tags[k]})
 
     return root
 
@@ -341,6 +768,12 @@ def main():
             default="conf/srtm.yaml",
             help="Config file to use. Defaults to ./conf/srtm.yaml"
             )
+    parser.add_argument(
+            "--width", 
+            dest="width",
+            type=float,
+            help="Width of the map in mm, so that no more detail is used than can be drawn"
+            )
     parser.add_argument(
             "--interval", 
             dest="interval",
@@ -371,7 +804,7 @@ def main():
     config["creds"] = common.load_config(credsfile)
 
     osm = contour(config, args.interval, args.min_lat, args.min_lon, args.max_lat,
-            args.max_lon)
+            args.max_lon, x_mm=args.width)
 
     osm_write(osm, config["outputfile"])
 
@@ -1,9 +1,11 @@
 import logging
 import logging.config
 import xml.etree.ElementTree as ET
+import numpy as np
 from pyproj import CRS, Transformer
 
 import osm
+import pathdata
 
 # Class representing a generic 2D point
 # Used for representing the locations in a Cartesian coordinate system
@@ -134,154 +136,173 @@ class SVG(object):
             log.warning("Insufficient configuration to allow creation of the svg")
             return None
         else:
-            # Generate the svg document properties
-            dp = {"xmlns": "http://www.w3.org/2000/svg",
-                "version": "1.1",
-                "baseProfile": "full",
-                "height": str(self.height) + "mm",
-                "width": str(self.width) + "mm",
-                "viewBox": "0 0 {} {}".format(self.width, self.height)
-                }
-            # Add inkscape xmlns if needed
-            if self.inkscape:
-                dp["xmlns:inkscape"] = "http://www.inkscape.org/namespaces/inkscape"
-
             # Create the root node
-            svg = ET.Element('svg', dp)
-
-            for layer in self.layers:
-                l = self.layers[layer]
-                log.info("Compiling layer: " + l.name)
-                # Add a group to contain all of the layer data
-                dp = dict(l.attrib)
-                dp["id"] = l.name
-                # Inkscape attributes for the layer
-                if self.inkscape:
-                    dp["inkscape:label"] = l.name
-                    dp["inkscape:groupmode"] = "layer"
-                g = ET.SubElement(svg, 'g', dp)
-
-                for path in l.paths:
-                    if type(path) is dict and "inner" in path and "outer" in path:
-                        # This is a complex way
-                        d = self.__complex(path)
-                    elif type(path) is list:
-                        # This is a way or area
-                        d = self.__way(path)
-                    else:
-                        raise ValueError
+            svg = ET.Element('svg', self.get_attrib())
 
+            for dp, paths in self.get_layers():
+                g = ET.SubElement(svg, 'g', dp)
+                data = pathdata.path_data([fmt["d"] for fmt in paths], 2, implicit=False)
+                for fmt, d in zip(paths, data):
                     # Add path to layer
-                    fmt = {}
-                    if "fill" in l.attrib:
-                        fmt["fill"] = str(l.attrib["fill"])
-                    else:
-                        fmt["fill"] = "none"
-                    if "stroke" in l.attrib:
-                        fmt["stroke"] = str(l.attrib["stroke"])
-                    else:
-                        fmt["stroke"] = "none"
-                    if "stroke-width" in l.attrib:
-                        fmt["stroke-width"] = str(l.attrib["stroke-width"])                        
-
                     fmt["d"] = d
                     ET.SubElement(g, "path", fmt)
             return svg
 
 
-    # https://stackoverflow.com/questions/1165647/how-to-determine-if-a-list-of-polygon-points-are-in-clockwise-order/1180256#1180256
-    def __is_cw(self, path):
-        min_x = float(path[0].lon)
-        min_indices = [0]
-        for i, point in enumerate(path):
-            if float(point.lon) < min_x:
-                min_x = float(point.lon)
-                min_indices = [i]
-            elif float(point.lon) == min_x:
-                min_indices.append(i)
-
-        min_point_index = min_indices[0]
-
-        # In case we have more than one leftmost point
-        if len(min_indices) > 1:
-            # Look for min_y
-            min_y = float(path[min_indices[0]].lat)
-            for i, index in enumerate(min_indices):
-                if float(path[index].lat) < min_y:
-                    min_point_index = min_indices[i]
-
-        a = path[(min_point_index + 1) % len(path)]
-        b = path[min_point_index]
-        c = path[(min_point_index - 1) % len(path)]
-        v = (
-                float(b.lon) * float(c.lat) + 
-                float(a.lon) * float(b.lat) + 
-                float(a.lat) * float(c.lon)
-            ) - (
-                float(a.lat) * float(b.lon) + 
-                float(b.lat) * float(c.lon) + 
-                float(a.lon) * float(c.lat)
-            )
-        if v > 0:
-            return True
+    # The attributes of the svg document
+    def get_attrib(self):
+        # Generate the svg document properties
+        dp = {"xmlns": "http://www.w3.org/2000/svg",
+            "version": "1.1",
+            "baseProfile": "full",
+            "height": str(self.height) + "mm",
+            "width": str(self.width) + "mm",
+            "viewBox": "0 0 {} {}".format(self.width, self.height)
+            }
+        # Add inkscape xmlns if needed
+        if self.inkscape:
+            dp["xmlns:inkscape"] = "http://www.inkscape.org/namespaces/inkscape"
+        return dp
+
+
+    # Generates the attributes of the group for each layer along with
+    # the attributes of each of its paths, one layer at a time so that
+    # the layers can be written out as they are made.  The d of each
+    # path is left as its subpaths, ((n, 2) array of x, y in mm, closed)
+    # tuples, for clipsvg.clip_paths or pathdata to write out
+    def get_layers(self):
+        log = logging.getLogger(__name__)
+        for layer in self.layers:
+            l = self.layers[layer]
+            log.info("Compiling layer: " + l.name)
+            # Add a group to contain all of the layer data
+            dp = dict(l.attrib)
+            dp["id"] = l.name
+            # Inkscape attributes for the layer
+            if self.inkscape:
+                dp["inkscape:label"] = l.name
+                dp["inkscape:groupmode"] = "layer"
+
+            # Project the points of the whole layer in one go, then
+            # hand each path its rings in mm
+            rings = [self.__rings(path) for path in l.paths]
+            latlon = [ring for parts in rings for ring in parts]
+            points = iter(self.__project(latlon))
+            clockwise = iter(self.__is_cw(latlon))
+
+            subpaths = []
+            for path, parts in zip(l.paths, rings):
+                mm = [next(points) for ring in parts]
+                cw = [next(clockwise) for ring in parts]
+                if type(path) is dict:
+                    # This is a complex way
+                    subpaths.append(self.__complex(
+                        mm[:len(path["outer"])], mm[len(path["outer"]):],
+                        cw[:len(path["outer"])], cw[len(path["outer"]):]))
+                else:
+                    # This is a way or area
+                    subpaths.append([self.__way(mm[0])])
+
+            paths = []
+            for d in subpaths:
+                if sum(len(points) for points, closed in d) == 0:
+                    # Nothing to draw, e.g. a relation with none
+                    # of its members in the data
+                    continue
+
+                fmt = {}
+                if "fill" in l.attrib:
+                    fmt["fill"] = str(l.attrib["fill"])
+                else:
+                    fmt["fill"] = "none"
+                if "stroke" in l.attrib:
+                    fmt["stroke"] = str(l.attrib["stroke"])
+                else:
+                    fmt["stroke"] = "none"
+                if "stroke-width" in l.attrib:
+                    fmt["stroke-width"] = str(l.attrib["stroke-width"])                        
+
+                fmt["d"] = d
+                paths.append(fmt)
+            yield dp, paths
+
+
+    # The rings of lat, lon of a path: the way itself, or the outer
+    # then the inner rings of a complex way
+    def __rings(self, path):
+        if type(path) is dict and "inner" in path and "outer" in path:
+            return [self.__latlon(pth) for pth in path["outer"]] + \
+                [self.__latlon(pth) for pth in path["inner"] if len(pth) > 1]
+        elif type(path) is list or type(path) is np.ndarray:
+            return [self.__latlon(path)]
         else:
-            return False
-
+            raise ValueError
 
-    def __complex(self, cx):
-        log = logging.getLogger(__name__) 
-        if "inner" not in cx or "outer" not in cx:
-            log.error("Called __complex without 'inner' or 'outer' in the data")
-            raise ValueError("Called __complex without 'inner' or 'outer' in the data")
 
+    # Paths may be lists of osm.Node or (n, 2) arrays of lat, lon
+    def __latlon(self, path):
+        if type(path) is np.ndarray:
+            return path
+        else:
+            return np.array([[float(nd.lat), float(nd.lon)] for nd in path]).reshape((-1, 2))
+
+
+    # Whether each ring of lat, lon goes clockwise, from the sign of its
+    # area (the shoelace formula), for all of the rings at once
+    def __is_cw(self, rings):
+        if len(rings) == 0:
+            return np.zeros(0, dtype=bool)
+        lengths = np.array([len(ring) for ring in rings])
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        path = np.concatenate(rings)
+        lat = path[:, 0]
+        lon = path[:, 1]
+
+        # The next point round each ring
+        following = np.arange(1, len(path) + 1)
+        ends = lengths > 0
+        following[offsets[1:][ends] - 1] = offsets[:-1][ends]
+
+        cross = lon * lat[following] - lon[following] * lat
+        area = np.bincount(np.repeat(np.arange(len(rings)), lengths), cross, len(rings))
+        return area < 0
+
+
+    # The rings of lat, lon as (n, 2) arrays of x, y in mm on the map,
+    # all projected with one call
+    def __project(self, rings):
+        if len(rings) == 0:
+            return []
+        lengths = np.array([len(ring) for ring in rings])
+        xy = self.__projection.transform_array(np.concatenate(rings))
+        xy[:, 0] = (xy[:, 0] - self.geo_bounds["w"]) * 1000 / self.scale
+        xy[:, 1] = - (xy[:, 1] - self.geo_bounds["n"]) * 1000 / self.scale
+        return np.split(xy, np.cumsum(lengths)[:-1])
+
+
+    # The subpaths of a complex way, with the outer rings going
+    # anticlockwise and the inner rings clockwise
+    def __complex(self, outer, inner, outer_cw, inner_cw):
         path = []
         # Below is rendering of complex relations
-        for pth in cx["outer"]:
+        for pth, cw in zip(outer, outer_cw):
             # Check the direction of the polygon
-            if self.__is_cw(pth):
-                pth = list(reversed(pth))
+            if cw:
+                pth = pth[::-1]
             path.append(self.__way(pth))
 
-        for pth in cx["inner"]:
-            if len(pth) > 1:
-                # Check the direction of the polygon
-                if not self.__is_cw(pth):
-                    pth = list(reversed(pth))
-                path.append(self.__way(pth))
+        for pth, cw in zip(inner, inner_cw):
+            # Check the direction of the polygon
+            if not cw:
+                pth = pth[::-1]
+            path.append(self.__way(pth))
 
-        return " ".join(path)
+        return path
 
 
-    def __way(self, wy):
-        path = []
-        if wy is not None and len(wy) > 0:
-            # Deal with the first point
-            p = self.__node(wy[0])
-            # Move to start point
-            path.append("M {:0.2f} {:0.2f}".format(p.x, p.y))
-            if len(wy) > 1:
-                # Do the rest of the points
-                for nd in wy[1:]:
-                    # Transfrom and scale
-                    p = self.__node(nd)
-                    # Line to next point
-                    path.append("L {:0.2f} {:0.2f}".format(p.x, p.y))
-        if wy[0].id == wy[-1].id:
-            path.append("Z")
-        return " ".join(path)
-
-
-    def __node(self, nd):
-        left = self.geo_bounds["w"]
-        top = self.geo_bounds["n"]
-        # Transfrom and scale
-        if type(nd) is osm.Node:
-            p = self.__projection.transform(nd)
-            p.x = (p.x - left) * 1000 / self.scale
-            p.y = - (p.y - top) * 1000 / self.scale
-            return p
-        else:
-            return Point()
+    # A subpath of x, y in mm, closed if it ends where it starts
+    def __way(self, points):
+        return points, len(points) > 0 and bool((points[0] == points[-1]).all())
 
 
 
@@ -309,13 +330,20 @@ class Projection (object):
     def transform(self, n):
         if type(n) == osm.Node:
             return self.__tf(n.lat, n.lon)
-        elif type(n) is list or type(n) is tuple and len(n) == 2:
+        elif type(n) is list or type(n) is tuple or type(n) is np.ndarray and len(n) == 2:
             return self.__tf(n[0], n[1])
         elif type(n) is dict and "lat" in n and "lon" in n:
             return self.__tf(n["lat"], n["lon"])
         else:
             raise ValueError
 
+    # Transform an (n, 2) array of lat, lon into an (n, 2) array of x, y
+    # with one call to the transformer
+    def transform_array(self, latlon):
+        latlon = np.asarray(latlon, dtype=np.float64)
+        x, y = self.__t.transform(latlon[:, 0], latlon[:, 1])
+        return np.column_stack((x, y))
+
     # Transform a Way or other sensible list type into a list of Points
     def transform_way(self, way):
         points = []
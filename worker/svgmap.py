@@ -10,6 +10,7 @@ import osm
 from svg import SVG, Layer
 import clipsvg
 import common
+import svgwriter
 
 def txt_attribution():
     attr = """
@@ -78,26 +79,6 @@ def read_OSM_data(filename):
         sys.exit()
 
 
-def make_xpath(feature, source):
-    log = logging.getLogger(__name__)
-    xp = None
-    if "=" in source:
-        parts = source.split("=")
-        if len(parts) != 2:
-            log.error("Unable to correctly parse kv pair from " + source)
-        else:
-            if feature == "relation":
-                xp = "./relation/tag[@k='type'][@v='multipolygon']/../tag[@k='{}'][@v='{}']/..".format(parts[0], parts[1])
-            else:
-                xp = "./{}/tag[@k='{}'][@v='{}']/..".format(feature, parts[0], parts[1])
-    else:
-        if feature == "relation":
-            xp = "./relation/tag[@k='type'][@v='multipolygon']/../tag[@k='{}']/..".format(source)
-        else:
-            xp = "./{}/tag[@k='{}']/..".format(feature, source)
-    log.info("Source: {}, XPath: {}".format(source, xp))
-    return xp
-
 def indent(elem, level=0):
     i = "\n" + level*"  "
     j = "\n" + (level-1)*"  "
@@ -125,11 +106,16 @@ def svg_write(root, filename, pretty=True):
         tree.write(f, encoding="UTF-8", xml_declaration=True)
 
 
-def osm_to_svg(osmdata, config, x_mm=None, y_mm=None, scale=None, no_inkscape=False, epsg=3857):
+def osm_to_svg(osmdata, config, x_mm=None, y_mm=None, scale=None, no_inkscape=False, epsg=3857,
+               lines=None, out=None, pretty=True):
     """Gathers the OSM data needed to create the desired SVG
     
     Grabs data from the openstreetmap object based on the configuration
-    then populates the svg.SVG object
+    then populates the svg.SVG object.  lines are more ways, as (tags,
+    (n, 2) array of lat, lon), e.g. contours, added to the layers that
+    their tags match without going through the OSM data.  Given out, a
+    binary file, the svg is written to it as each layer is made and
+    None returned, otherwise the svg is returned as an element
     """
 
     log = logging.getLogger(__name__)
@@ -156,26 +142,31 @@ def osm_to_svg(osmdata, config, x_mm=None, y_mm=None, scale=None, no_inkscape=Fa
     if scale is not None and scale > 0:
         svgdata.scale = scale
 
-    # Add the OSM paths we want to render in the SVG
+    # Work out the tags for every source of every layer
+    rules = osm.make_rules(config["layers"])
+
+    # Pick out the OSM paths we want to render in the SVG
+    paths = osmap.classify(rules)
+    if lines is not None:
+        for tags, path in lines:
+            for name in rules:
+                for feature, query in rules[name]:
+                    if feature == "way" and osm.match_tags(query, tags):
+                        paths[name].append(path)
+                        break
+
     for name in config["layers"]:
         log.info("Compiling layer: " + name)
         l = Layer(name)
         l.attrib = config["layers"][name]["attrib"]
-        for shape in ["ways", "areas", "complex"]:
-            if shape in config["layers"][name]:
-                log.info("Processing " + shape)
-                for source in config["layers"][name][shape]:
-                    log.info("Using source " + source)
-                    if shape == "complex":
-                        xp = make_xpath("relation", config["layers"][name][shape][source])
-                        log.debug("XPath " + xp)
-                        l.paths += osmap.get_relations(xp)
-                    elif shape == "areas" or shape == "ways":
-                        xp = make_xpath("way", config["layers"][name][shape][source])
-                        log.debug("XPath " + xp)
-                        l.paths += osmap.get_ways(xp)
-                    else:
-                        log.warning("Unrecognised shape in config " + shape)
+        l.paths = paths[name]
+
+        # Report any trouble building the complex areas
+        for path in l.paths:
+            if type(path) is dict and "diagnostics" in path:
+                for d in path["diagnostics"]:
+                    log.warning("Layer {}: relation {} way {} ({}): {}".format(
+                        name, d.relation, d.way, d.role, d.problem))
                 
         # Add layer to SVG
         if len(l.paths) == 0:
@@ -184,17 +175,59 @@ def osm_to_svg(osmdata, config, x_mm=None, y_mm=None, scale=None, no_inkscape=Fa
             log.info("Found {} elements for layer {}".format(len(l.paths), name))
             svgdata.layers[name] = l
 
-    # Generate the svg file based on the config and the map data
-    svg = svgdata.get_svg()
+    decimal_places = 1
+    relative = False
+    if "options" in config:
+        if "decimal_places" in config["options"]:
+            decimal_places = config["options"]["decimal_places"]
+        if "relative_paths" in config["options"]:
+            relative = config["options"]["relative_paths"]
+
+    # Generate the svg based on the config and the map data, straight
+    # to the file if given one
+    if out is None:
+        target = ET.TreeBuilder(insert_comments=True)
+    else:
+        target = svgwriter.SVGWriter(out, pretty)
+    make_svg(svgdata, target, x_mm, y_mm, decimal_places, relative)
+    svg = target.close()
+    if out is None and pretty:
+        svg = indent(svg)
 
-    # Add OSM Copyright and attribution
-    svg.append(svg_attribution(y_mm, x_mm))
-    svg.insert(0, txt_attribution())
+    return svg
 
-    # Clip svg to viewBox
-    clipsvg.svg_clip(svg)
 
-    return svg
+# Passes the svg to target, an ET.TreeBuilder or svgwriter.SVGWriter,
+# one layer at a time with its paths clipped to the viewBox
+def make_svg(svgdata, target, x_mm, y_mm, decimal_places=1, relative=False):
+    # The document, bounded as the clipping leaves it
+    svg = ET.Element("svg", svgdata.get_attrib())
+    l, t, w, h = clipsvg.clip_bounds(clipsvg.get_bounds(svg), decimal_places=decimal_places)
+    clipsvg.set_bounds(svg, l, t, w, h)
+    target.start("svg", svg.attrib)
+
+    # Add OSM Copyright
+    svgwriter.write_element(target, txt_attribution())
+
+    for attrib, paths in svgdata.get_layers():
+        clipsvg.clip_paths(paths, l, t, w, h, decimal_places, relative)
+        target.start("g", attrib)
+        for path in paths:
+            target.start("path", path)
+            target.end("path")
+        target.end("g")
+
+    # And attribution, in the corner of the map as scaled if it wasn't
+    # given a size
+    if x_mm is None:
+        x_mm = svgdata.width
+    if y_mm is None:
+        y_mm = svgdata.height
+    attribution = svg_attribution(y_mm, x_mm)
+    clipsvg.clip_paths([path.attrib for path in attribution.iter("path")], l, t, w, h,
+                       decimal_places, relative)
+    svgwriter.write_element(target, attribution)
+    target.end("svg")
 
 
 def main ():
@@ -207,7 +240,7 @@ def main ():
     parser = ArgumentParser()
     parser.add_argument(
             "osmdatafile",
-            help="The OSM data file containing map data"
+            help="The OSM data file, or snapshot directory, containing map data"
             )
     parser.add_argument(
             "outputfile",
@@ -246,6 +279,12 @@ def main ():
             action="store_true",
             help="Do not add inkscape tags to the data"
             )
+    parser.add_argument(
+            "--stream",
+            dest="stream",
+            action="store_true",
+            help="Index the data file as it is read rather than loading the whole XML tree. Uses much less memory on large files"
+            )
     parser.add_argument(
             "--epsg",
             dest="epsg",
@@ -280,14 +319,16 @@ large area.
     config = common.load_config(configfile)
 
     # Load the data file
-    osmdata = osm.OSMData(datafile)
-
-    # Convert into svg
-    svg = osm_to_svg(osmdata, config, args.x_mm, args.y_mm, args.scale, args.no_inkscape, args.epsg)
-    #svg = get_svg(osmdata, config, args.x_mm, args.y_mm)
-
-    # Write it to disk
-    svg_write(svg, outfile)
+    osmdata = osm.OSMData(datafile, stream=args.stream)
+    if osmdata.bounds is None:
+        log.error("Data file has no bounds and no nodes to take them from: " + datafile)
+        sys.exit(1)
+
+    # Convert into svg, writing it to disk as it goes
+    log.info("Writing svg file to " + outfile)
+    with open(outfile, "wb") as f:
+        osm_to_svg(osmdata, config, args.x_mm, args.y_mm, args.scale, args.no_inkscape, args.epsg,
+                   out=f)
 
     # And we are done!
     log.info("Processing completed")
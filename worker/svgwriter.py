@@ -0,0 +1,114 @@
+import re
+import xml.etree.ElementTree as ET
+
+
+# Writes an xml document (the svg) to a file as it is made rather than
+# building the tree first.  It takes the same calls as an
+# ET.TreeBuilder, start, end, data, comment and close, so whatever makes
+# the document can build either.  With pretty, each element goes on its
+# own line indented as svgmap.indent would, otherwise nothing is added
+
+
+# Most text needs no escaping, so look for anything that does first
+TEXT = re.compile(r"[&<>]")
+ATTRIB = re.compile(r"[&<>\"\r\n\t]")
+
+
+def escape_text(text):
+    if not TEXT.search(text):
+        return text
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def escape_attrib(value):
+    if not ATTRIB.search(value):
+        return value
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;") \
+        .replace("\"", "&quot;").replace("\r", "&#13;").replace("\n", "&#10;").replace("\t", "&#09;")
+
+
+class SVGWriter(object):
+
+    def __init__(self, f, pretty=True):
+        self.__f = f
+        self.__pretty = pretty
+        # Whether each open element has children and whether it has text
+        self.__children = []
+        self.__text = []
+        # A start tag still to be finished with > or />
+        self.__pending = False
+        self.__write("<?xml version='1.0' encoding='UTF-8'?>\n")
+
+    def __write(self, s):
+        self.__f.write(s.encode("UTF-8"))
+
+    # Finish any start tag and move on to the line for a child
+    def __child(self):
+        if self.__pending:
+            self.__write(">")
+            self.__pending = False
+        if len(self.__children) > 0:
+            self.__children[-1] = True
+            if self.__pretty and not self.__text[-1]:
+                self.__write("\n" + "  " * len(self.__children))
+
+    def start(self, tag, attrib):
+        self.__child()
+        self.__write("<" + tag + "".join(
+            " {}=\"{}\"".format(key, escape_attrib(str(value))) for key, value in attrib.items()))
+        self.__pending = True
+        self.__children.append(False)
+        self.__text.append(False)
+
+    def end(self, tag):
+        children = self.__children.pop()
+        text = self.__text.pop()
+        if self.__pending:
+            self.__write(" />")
+            self.__pending = False
+        else:
+            if children and self.__pretty and not text:
+                self.__write("\n" + "  " * len(self.__children))
+            self.__write("</" + tag + ">")
+        # Let the reader have each part of the document as soon as
+        # it is done
+        if len(self.__children) <= 1 and hasattr(self.__f, "flush"):
+            self.__f.flush()
+
+    def data(self, text):
+        # Pretty printing replaces the whitespace between elements
+        if len(self.__children) == 0 or self.__pretty and text.strip() == "":
+            return
+        if self.__pending:
+            self.__write(">")
+            self.__pending = False
+        self.__text[-1] = True
+        self.__write(escape_text(text))
+
+    def comment(self, text):
+        self.__child()
+        self.__write("<!--" + text + "-->")
+
+    def close(self):
+        if len(self.__children) > 0:
+            raise ValueError("The svg has {} unclosed elements".format(len(self.__children)))
+        if self.__pretty:
+            self.__write("\n")
+        if hasattr(self.__f, "flush"):
+            self.__f.flush()
+        return None
+
+
+# Passes an element and everything in it to a TreeBuilder or SVGWriter
+def write_element(target, elem):
+    if elem.tag is ET.Comment:
+        target.comment(elem.text)
+    else:
+        target.start(elem.tag, elem.attrib)
+        if elem.text:
+            target.data(elem.text)
+        for child in elem:
+            write_element(target, child)
+        target.end(elem.tag)
+    if elem.tail:
+        target.data(elem.tail)
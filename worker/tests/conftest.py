@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The worker modules are imported by name, as they are when run from
+# the worker directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,32 @@
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+import clipsvg
+
+
+# The d of each path clipped to a 10mm square
+def clipped(*ds):
+    svg = clipsvg.new_svg(0, 0, 10, 10)
+    for d in ds:
+        ET.SubElement(svg, "path", {"d": d})
+    clipsvg.svg_clip(svg, decimal_places=1, pretty=False)
+    return [path.attrib["d"] for path in svg.iter("path")]
+
+
+def test_arrays_clip_as_path_data():
+    points = np.array([[-5.0, 5.0], [5.0, 5.0], [5.0, 15.0], [12.0, 15.0], [8.0, 2.0]])
+    assert clipped([(points, False)], "M -5 5 L 5 5 L 5 15 L 12 15 L 8 2") == \
+        ["M 0 5 L 5 5 5 10 10 8.5 8 2"] * 2
+
+
+def test_arrays_written_once():
+    # Rounded straight to 1 place, not to 2 places and then to 1
+    points = np.array([[1.049, 1.0], [2.0, 2.0], [1.0, 1.0]])
+    assert clipped([(points, True)]) == ["M 1 1 L 2 2 1 1 Z"]
+
+
+def test_arrays_outside_kept():
+    # Crosses the box but has no point inside, so is left as it is
+    points = np.array([[-5.0, 5.0], [15.0, 5.0]])
+    assert clipped([(points, False)]) == ["M -5 5 L 15 5"]
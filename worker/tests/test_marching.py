@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import marching
+
+measure = pytest.importorskip("skimage.measure")
+
+
+# Fixed grids, each with the levels to contour it at
+GRIDS = [
+    # A peak in the middle, giving closed rings
+    (np.array([[0, 0, 0, 0, 0],
+               [0, 1, 2, 1, 0],
+               [0, 2, 4, 2, 0],
+               [0, 1, 2, 1, 0],
+               [0, 0, 0, 0, 0]], dtype=float), [0.5, 1.5, 3.0]),
+    # Saddles, in both directions
+    (np.array([[2, 0, 2],
+               [0, 2, 0],
+               [2, 0, 2]], dtype=float), [1.0]),
+    (np.array([[0, 2, 0],
+               [2, 0, 2],
+               [0, 2, 0]], dtype=float), [0.5, 1.0, 1.5]),
+    # A slope running off the edges, giving open lines, with levels
+    # landing exactly on some of the values
+    (np.array([[0, 1, 2, 3],
+               [1, 2, 3, 4],
+               [2, 3, 4, 5]], dtype=float), [1.0, 2.5, 4.0]),
+    # Levels outside the data, and flat ground at a level
+    (np.array([[1, 1, 1],
+               [1, 1, 1]], dtype=float), [0.0, 1.0, 2.0]),
+]
+
+
+def assert_same(image, levels, found):
+    assert len(found) == len(levels)
+    for level, contours in zip(levels, found):
+        expected = measure.find_contours(image, level)
+        assert len(contours) == len(expected)
+        for line, other in zip(contours, expected):
+            assert np.array_equal(line, other)
+
+
+@pytest.mark.parametrize("image, levels", GRIDS)
+def test_fixed_grids(image, levels):
+    assert_same(image, levels, marching.find_contours(image, levels))
+
+
+def test_random_grid():
+    image = np.random.default_rng(3).integers(0, 10, (30, 40)).astype(float)
+    levels = np.arange(0.5, 10, 1.0)
+    assert_same(image, levels, marching.find_contours(image, levels))
+
+
+def test_bands_and_batches(monkeypatch):
+    # Contours crossing from one band of rows to the next, and levels
+    # taken a few at a time, come out as if done all at once
+    monkeypatch.setattr(marching, "BAND", 3)
+    monkeypatch.setattr(marching, "BATCH", 50)
+    rows, cols = np.mgrid[0:25, 0:20]
+    image = np.hypot(rows - 12, cols - 9) + np.sin(cols)
+    levels = np.arange(1.0, 12.0, 0.5)
+    assert_same(image, levels, marching.find_contours(image, levels))
+
+
+def test_nan_cells_skipped():
+    image = np.array([[0, 0, 0, 0],
+                      [0, 2, np.nan, 0],
+                      [0, 2, 2, 0],
+                      [0, 0, 0, 0]], dtype=float)
+    assert_same(image, [1.0], marching.find_contours(image, [1.0]))
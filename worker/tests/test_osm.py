@@ -0,0 +1,106 @@
+import numpy as np
+
+import osm
+
+
+BOUNDS = {"minlat": "0", "minlon": "0", "maxlat": "1", "maxlon": "1"}
+
+
+# bbox limited geometry (out geom with a bbox) of the ways, leaving out
+# the nodes in missing
+def clipped(nodes, ways, missing, relations=()):
+    osmap = osm.OSMData()
+    ids = [nid for nid in nodes if nid not in missing]
+    osmap.add_nodes(ids, [nodes[nid] for nid in ids])
+    osmap.add_ways(list(ways), [len(ways[wid]) for wid in ways],
+                   [ref for wid in ways for ref in ways[wid]],
+                   [{"landuse": "forest"} for wid in ways])
+    for relation in relations:
+        osmap.add_relation(relation)
+    osmap.close()
+    osmap.bounds = BOUNDS
+    return osmap
+
+
+def test_area_across_two_edges():
+    # A square over the north east corner, with the node beyond the
+    # corner outside the bbox and missing
+    nodes = {1: (0.5, 0.5), 2: (0.5, 1.5), 3: (1.5, 1.5), 4: (1.5, 0.5)}
+    osmap = clipped(nodes, {10: [1, 2, 3, 4, 1]}, {3})
+    paths = osmap.get_ways([10])
+    assert len(paths) == 1
+    ring = paths[0]
+    assert (ring[0] == ring[-1]).all()
+    # No chord across the map: the ring follows the edges round the corner
+    assert {tuple(p) for p in ring} == {(0.5, 0.5), (0.5, 1.0), (1.0, 1.0), (1.0, 0.5)}
+
+
+def test_area_closing_node_missing():
+    nodes = {1: (1.5, 0.5), 2: (0.5, 0.5), 3: (0.5, 1.5), 4: (1.5, 1.5)}
+    osmap = clipped(nodes, {10: [1, 2, 3, 4, 1]}, {4})
+    ring = osmap.get_ways([10])[0]
+    assert {tuple(p) for p in ring} == {(0.5, 0.5), (0.5, 1.0), (1.0, 1.0), (1.0, 0.5)}
+
+
+def test_open_way_split_at_gap():
+    # Leaves through the east edge and comes back in through the north
+    nodes = {1: (0.5, 0.5), 2: (0.5, 1.5), 3: (1.5, 1.5), 4: (1.5, 0.5), 5: (0.8, 0.2)}
+    osmap = clipped(nodes, {10: [1, 2, 3, 4, 5]}, {3})
+    paths = osmap.get_ways([10])
+    assert [p.tolist() for p in paths] == [[[0.5, 0.5], [0.5, 1.5]], [[1.5, 0.5], [0.8, 0.2]]]
+
+
+def test_multipolygon_member_outside():
+    # The outer ring is two ways, joined at nodes outside the bbox
+    nodes = {1: (0.5, 0.5), 2: (0.5, 1.5), 3: (1.5, 1.5), 4: (1.5, 0.5)}
+    relation = osm.Relation(20)
+    relation.add(osm.Member("way", 10, "outer"))
+    relation.add(osm.Member("way", 11, "outer"))
+    osmap = clipped(nodes, {10: [1, 2, 3], 11: [3, 4, 1]}, {3}, [relation])
+    [mp] = osmap.get_relations([20])
+    assert [d.problem for d in mp["diagnostics"]] == []
+    assert len(mp["outer"]) == 1
+    assert {tuple(p) for p in mp["outer"][0]} == {(0.5, 0.5), (0.5, 1.0), (1.0, 1.0), (1.0, 0.5)}
+
+
+def test_missing_nodes_found_later():
+    # A later tile has the node that was missing
+    nodes = {1: (0.5, 0.5), 2: (0.5, 1.5), 3: (1.5, 1.5), 4: (1.5, 0.5)}
+    osmap = clipped(nodes, {10: [1, 2, 3, 4, 1]}, {3})
+    osmap.add_nodes([3], [nodes[3]])
+    osmap.add_ways([10], [5], [1, 2, 3, 4, 1])
+    osmap.close()
+    [ring] = osmap.get_ways([10])
+    assert ring.tolist() == [[0.5, 0.5], [0.5, 1.5], [1.5, 1.5], [1.5, 0.5], [0.5, 0.5]]
+
+
+def test_clip_ring_walks_shorter_way():
+    # Leaves through the north edge and comes back through the east
+    ring = np.array([[0.5, 0.9], [1.2, 0.9], [np.nan, np.nan], [0.9, 1.2], [0.5, 0.9]])
+    clipped_ring = osm.clip_ring(ring, (0, 0, 1, 1))
+    assert (1.0, 1.0) in {tuple(p) for p in clipped_ring}
+    assert (0.0, 0.0) not in {tuple(p) for p in clipped_ring}
+
+
+OVERPASS_JSON = ('{"version": 0.6, "generator": "Overpass API", "elements": [\n'
+                 '{"type": "node", "id": 1, "lat": 51.5, "lon": -0.1},\n'
+                 '{"type": "node", "id": 2, "lat": 51.6, "lon": -0.2},\n'
+                 '{"type": "way", "id": 10, "nodes": [1, 2], "tags": {"highway": "primary"}}\n'
+                 '], "remark": "runtime error: test"}').encode("utf-8")
+
+
+def test_json_fed_a_byte_at_a_time():
+    osmap = osm.OSMData()
+    for i in range(len(OVERPASS_JSON)):
+        osmap.feed(OVERPASS_JSON[i:i + 1])
+    osmap.close()
+    assert osmap.remark == "runtime error: test"
+    assert osmap.get_ways([10])[0].tolist() == [[51.5, -0.1], [51.6, -0.2]]
+
+
+def test_json_bounds_from_nodes(tmp_path):
+    filename = tmp_path / "data.json"
+    filename.write_bytes(OVERPASS_JSON)
+    osmap = osm.OSMData(str(filename))
+    assert {k: float(v) for k, v in osmap.bounds.items()} == \
+        {"minlat": 51.5, "minlon": -0.2, "maxlat": 51.6, "maxlon": -0.1}
@@ -0,0 +1,147 @@
+import os
+import re
+import contextlib
+import itertools
+
+import osm
+import overpass
+import scheduler
+
+
+def test_tiles_on_grid_lines():
+    # -0.95 / 0.05 is -18.999..., which used to give an extra column
+    tiles = overpass.ovp_tiles(0.05, 51.4, -1.0, 51.45, -0.95)
+    assert tiles == [(51.4, -1.0, 51.45, -0.95)]
+
+
+def test_tiles_on_grid_lines_everywhere():
+    for i in range(-1800, 1800):
+        lat = round(i * 0.05, 6)
+        assert len(overpass.ovp_tiles(0.05, lat, lat, round(lat + 0.1, 6), round(lat + 0.1, 6))) == 4
+
+
+def test_tiles_cover_bbox():
+    tiles = overpass.ovp_tiles(0.05, 51.41, -0.99, 51.46, -0.94)
+    assert len(tiles) == 4
+    assert min(t[0] for t in tiles) == 51.4
+    assert max(t[2] for t in tiles) == 51.5
+
+
+# An XML response with one way, a different one for each call
+def responses():
+    count = [0]
+
+    def stream(config, query):
+        count[0] += 1
+        n = count[0]
+        yield ('<osm version="0.6"><node id="{0}1" lat="51.41" lon="-0.99"/>'
+               '<node id="{0}2" lat="51.42" lon="-0.98"/>'
+               '<way id="{0}"><nd ref="{0}1"/><nd ref="{0}2"/>'
+               '<tag k="highway" v="primary"/></way>').format(n).encode("utf-8")
+        yield b"</osm>"
+    return stream
+
+
+def test_tiles_built_once(monkeypatch):
+    builds = []
+    build = osm.OSMData._OSMData__build
+
+    def counted(self):
+        builds.append(self)
+        build(self)
+    monkeypatch.setattr(osm.OSMData, "_OSMData__build", counted)
+    monkeypatch.setattr(overpass, "ovp_stream", responses())
+    config = {"overpass": {"endpoint": "http://localhost/", "tile": 0.05},
+              "layers": {"roads": {"ways": {"highway": "highway"}}}}
+
+    osmap = overpass.get_osm(51.41, -0.99, 51.46, -0.94, config)
+    assert builds == []
+    layers = osmap.classify(osm.make_rules(config["layers"]))
+    assert len(layers["roads"]) == 4
+
+
+# Stands in for the scheduler, answering each part of a split query
+# with a way across the middle of its bbox, or with respond(bbox) if
+# that gives anything
+class Parts(object):
+
+    def __init__(self, respond=None):
+        self.respond = respond
+        self.queries = []
+        self.ids = itertools.count(1)
+
+    @contextlib.contextmanager
+    def post(self, endpoint, query, stream=False, split=False):
+        self.queries.append(query)
+        bbox = tuple(float(x) for x in re.search(r"\(([-\d.]+), ([-\d.]+), ([-\d.]+), ([-\d.]+)\)",
+                                                 query).groups())
+        data = self.respond(bbox) if self.respond is not None else None
+        if data is None:
+            wid = next(self.ids)
+            lat = (bbox[0] + bbox[2]) / 2
+            data = ('<osm version="0.6">'
+                    '<node id="{0}1" lat="{1}" lon="{2}"/><node id="{0}2" lat="{1}" lon="{3}"/>'
+                    '<way id="{0}"><nd ref="{0}1"/><nd ref="{0}2"/>'
+                    '<tag k="highway" v="primary"/></way></osm>').format(
+                        wid, lat, bbox[1], bbox[3]).encode("utf-8")
+
+        class Response(object):
+            def iter_content(self, chunk_size):
+                for i in range(0, len(data), 16):
+                    yield data[i:i + 16]
+        yield Response()
+
+
+def split_config(tmp_path, **split):
+    return {"overpass": {"endpoint": "http://localhost/", "snapshots": str(tmp_path),
+                         "split": dict({"workers": 2, "size": 0.06}, **split)},
+            "layers": {"roads": {"ways": {"highway": "highway"}},
+                       "contours": {"attrib": {}},
+                       "buildings": {"areas": {"building": "building"}}}}
+
+
+def test_split_parts_merged(monkeypatch, tmp_path):
+    parts = Parts()
+    monkeypatch.setattr(scheduler, "get_scheduler", lambda config: parts)
+    config = split_config(tmp_path, groups=[["buildings"], ["contours"]])
+
+    osmap = overpass.get_osm(51.4, -1.0, 51.5, -0.9, config)
+    # Four quarters, each with a query for the buildings and one for
+    # the roads, but none for the contours that have nothing to query
+    assert len(parts.queries) == 8
+    assert len(overpass.ovp_groups(config)) == 2
+    assert len(osmap.classify(osm.make_rules(config["layers"]))["roads"]) == 8
+    assert osmap.remarks == []
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_split_remark_in_any_part(monkeypatch, tmp_path):
+    # One of the parts, which isn't the last to be merged, is partial
+    def respond(bbox):
+        if bbox[:2] == (51.4, -1.0):
+            return (b'<osm version="0.6"><remark>runtime error: partial</remark></osm>')
+    parts = Parts(respond)
+    monkeypatch.setattr(scheduler, "get_scheduler", lambda config: parts)
+    config = split_config(tmp_path, workers=1)
+    del config["layers"]["buildings"]
+
+    osmap = overpass.get_osm(51.4, -1.0, 51.5, -0.9, config)
+    assert osmap.remarks == ["runtime error: partial"]
+    assert len(osmap.classify(osm.make_rules(config["layers"]))["roads"]) == 3
+    assert os.listdir(tmp_path) == []
+
+
+def test_split_on_remark(monkeypatch, tmp_path):
+    # Overpass gives up on the whole area, so it is split
+    def respond(bbox):
+        if bbox[2] - bbox[0] > 0.06:
+            return b'<osm version="0.6"><remark>runtime error: Query timed out</remark></osm>'
+    parts = Parts(respond)
+    monkeypatch.setattr(scheduler, "get_scheduler", lambda config: parts)
+    config = split_config(tmp_path, size=1)
+    del config["layers"]["buildings"]
+
+    osmap = overpass.get_osm(51.4, -1.0, 51.5, -0.9, config)
+    assert len(parts.queries) == 5
+    assert osmap.remarks == []
+    assert len(osmap.classify(osm.make_rules(config["layers"]))["roads"]) == 4
@@ -0,0 +1,97 @@
+import os
+import shutil
+
+import numpy as np
+
+import osm
+import pbf
+
+
+# extract.osm.pbf is extract.osm written out by osmium, with a header bbox
+DATA = os.path.join(os.path.dirname(__file__), "data")
+
+LAYERS = {
+    "roads": {"ways": {"highway": "highway"}},
+    "forests": {"areas": {"forest": "landuse=forest"}},
+    "quarries": {"areas": {"acme": "operator=Acme"}},
+    "water": {"complex": {"water": "natural=water"}},
+}
+
+
+def extract(tmp_path):
+    filename = str(tmp_path / "extract.osm.pbf")
+    shutil.copy(os.path.join(DATA, "extract.osm.pbf"), filename)
+    return filename
+
+
+# The layers as plain lists, to compare
+def shapes(osmap):
+    layers = osmap.classify(osm.make_rules(LAYERS))
+    found = {}
+    for name in layers:
+        found[name] = sorted(
+            repr({"outer": [r.tolist() for r in path["outer"]],
+                  "inner": [r.tolist() for r in path["inner"]]})
+            if type(path) is dict else repr(path.tolist())
+            for path in layers[name])
+    return found
+
+
+def test_build_index(tmp_path):
+    filename = extract(tmp_path)
+    pbf.build_index(filename)
+    idx = pbf.open_index(filename)
+    assert idx["meta"]["bbox"] == [51.4, -1.0, 51.65, -0.9]
+    assert idx["node_ids"].tolist() == list(range(1, 20))
+    assert idx["way_ids"].tolist() == list(range(100, 107))
+    # Only the multipolygon is kept
+    assert [rel["id"] for rel in idx["relations"]] == [200]
+    # Every tag, including free text ones
+    assert ("name", "High Street") in idx["tags"]
+    assert ("source", "survey") in idx["tags"]
+
+    # Nodes read as they are from the xml
+    xml = osm.OSMData(os.path.join(DATA, "extract.osm"))
+    assert np.array_equal(idx["latlon"], xml.get_nodes(idx["node_ids"]))
+
+
+def test_get_osm_matches_xml(tmp_path):
+    filename = extract(tmp_path)
+    xml = osm.OSMData(os.path.join(DATA, "extract.osm"))
+    local = pbf.get_osm(filename, 51.4, -1.0, 51.65, -0.9, {"layers": LAYERS})
+    assert shapes(local) == shapes(xml)
+    assert len(shapes(local)["quarries"]) == 1
+    assert len(shapes(local)["water"]) == 1
+
+
+def test_get_osm_area(tmp_path):
+    filename = extract(tmp_path)
+    local = shapes(pbf.get_osm(filename, 51.4, -1.0, 51.45, -0.9, {"layers": LAYERS}))
+    # The track is well to the north
+    assert len(local["roads"]) == 1
+    assert local["forests"] == shapes(osm.OSMData(os.path.join(DATA, "extract.osm")))["forests"]
+
+
+def test_find_extract(tmp_path):
+    filename = extract(tmp_path)
+    config = {"overpass": {"extracts": [str(tmp_path / "missing.osm.pbf"), filename]}}
+    assert pbf.find_extract(config, 51.4, -1.0, 51.45, -0.95) == filename
+    assert pbf.find_extract(config, 51.3, -1.0, 51.45, -0.95) is None
+    assert pbf.find_extract({"overpass": {}}, 51.4, -1.0, 51.45, -0.95) is None
+
+
+def test_index_reopened_when_rebuilt(tmp_path):
+    filename = extract(tmp_path)
+    idx = pbf.open_index(filename)
+    assert pbf.open_index(filename) is idx
+
+    # Rebuilt by another worker
+    pbf.build_index(filename)
+    rebuilt = pbf.open_index(filename)
+    assert rebuilt is not idx
+    assert pbf.open_index(filename) is rebuilt
+
+    # A new extract in its place
+    stat = os.stat(filename)
+    os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+    assert pbf.open_index(filename) is not rebuilt
@@ -0,0 +1,234 @@
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+import scheduler
+
+
+# A stub Overpass.  Each POST to /api/interpreter is answered by
+# respond(n), n counting from 0, as (status, headers, body) and
+# /api/status with the status text
+class Overpass(object):
+
+    def __init__(self, respond, status=""):
+        self.respond = respond
+        self.status = status
+        self.posts = 0
+        self.running = 0
+        self.most = 0
+        self.lock = threading.Lock()
+        overpass = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.reply(200, {}, overpass.status.encode("utf-8"))
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                with overpass.lock:
+                    n = overpass.posts
+                    overpass.posts += 1
+                    overpass.running += 1
+                    overpass.most = max(overpass.most, overpass.running)
+                try:
+                    status, headers, body = overpass.respond(n)
+                    self.reply(status, headers, body)
+                finally:
+                    with overpass.lock:
+                        overpass.running -= 1
+
+            def reply(self, status, headers, body):
+                self.send_response(status)
+                for k in headers:
+                    self.send_header(k, headers[k])
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.endpoint = "http://127.0.0.1:{}/api/interpreter".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(respond, status=""):
+        servers.append(Overpass(respond, status))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.close()
+
+
+# Records the backoffs rather than waiting them out, without jitter
+@pytest.fixture
+def sleeps(monkeypatch):
+    waits = []
+    monkeypatch.setattr(scheduler.time, "sleep", waits.append)
+    monkeypatch.setattr(scheduler.random, "uniform", lambda a, b: a)
+    return waits
+
+
+def ok(n):
+    return 200, {}, b"<osm/>"
+
+
+def busy_once(headers, status=429):
+    def respond(n):
+        if n == 0:
+            return status, headers, b""
+        return 200, {}, b"<osm/>"
+    return respond
+
+
+def test_retry_after_seconds(stub, sleeps):
+    server = stub(busy_once({"Retry-After": "7"}))
+    with scheduler.Scheduler({}).post(server.endpoint, "q") as r:
+        assert r.content == b"<osm/>"
+    assert server.posts == 2
+    assert sleeps == [7]
+
+
+def test_retry_after_date(stub, sleeps):
+    when = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 30))
+    server = stub(busy_once({"Retry-After": when}))
+    with scheduler.Scheduler({}).post(server.endpoint, "q") as r:
+        assert r.status_code == 200
+    assert 25 < sleeps[0] <= 30
+
+
+def test_retry_after_status_page(stub, sleeps):
+    server = stub(busy_once({}), status="Connected as: 1\nRate limit: 2\n"
+                  "Slot available after: 2026-10-17T10:00:09Z, in 9 seconds.\n"
+                  "Slot available after: 2026-10-17T10:00:04Z, in 4 seconds.\n")
+    with scheduler.Scheduler({}).post(server.endpoint, "q") as r:
+        assert r.status_code == 200
+    assert sleeps == [4]
+
+
+def test_retry_status_page_slot_free(stub, sleeps):
+    server = stub(busy_once({}), status="Rate limit: 2\n1 slots available now.\n")
+    with scheduler.Scheduler({}).post(server.endpoint, "q") as r:
+        assert r.status_code == 200
+    assert sleeps == [0]
+
+
+def test_backoff_without_retry_after(stub, sleeps):
+    server = stub(lambda n: (503, {}, b""))
+    with pytest.raises(requests.HTTPError):
+        with scheduler.Scheduler({"retries": 3, "backoff": 2}).post(server.endpoint, "q"):
+            pass
+    assert server.posts == 4
+    assert sleeps == [2, 4, 8]
+
+
+def test_gateway_timeout_raised_at_once_for_split(stub, sleeps):
+    server = stub(lambda n: (504, {}, b""))
+    with pytest.raises(requests.HTTPError) as e:
+        with scheduler.Scheduler({"retries": 3}).post(server.endpoint, "q", split=True):
+            pass
+    assert e.value.response.status_code == 504
+    assert server.posts == 1
+    assert sleeps == []
+
+
+def concurrent(sched, endpoint, n):
+    def post():
+        with sched.post(endpoint, "q") as r:
+            r.content
+    threads = [threading.Thread(target=post) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def slow(n):
+    time.sleep(0.1)
+    return ok(n)
+
+
+def test_concurrency_cap(stub):
+    server = stub(slow)
+    concurrent(scheduler.Scheduler({"slots": 2}), server.endpoint, 8)
+    assert server.posts == 8
+    assert server.most == 2
+
+
+def test_semaphore_fallback(stub, monkeypatch):
+    # Redis can't be reached (or isn't installed), so the slots are
+    # kept by this process alone and still capped
+    class Broken(Exception):
+        pass
+
+    class Client(object):
+        def register_script(self, script):
+            def acquire(keys, args):
+                raise Broken("connection refused")
+            return acquire
+
+    class Redis(object):
+        exceptions = type("exceptions", (), {"RedisError": Broken})
+        Redis = type("Redis", (), {"from_url": staticmethod(lambda url: Client())})
+    monkeypatch.setattr(scheduler, "redis", Redis)
+
+    server = stub(slow)
+    concurrent(scheduler.Scheduler({"slots": 2, "redis": "redis://127.0.0.1:1/"}),
+               server.endpoint, 6)
+    assert server.posts == 6
+    assert server.most == 2
+
+
+def test_lease_renewed_while_reading(stub, monkeypatch):
+    # A fake Redis that records the lease on each slot
+    leases = {}
+    renewals = []
+
+    class Client(object):
+        def register_script(self, script):
+            def acquire(keys, args):
+                leases[args[3]] = args[2]
+                return 1
+            return acquire
+
+        def zadd(self, key, mapping, xx=False):
+            renewals.extend(mapping.values())
+            leases.update(mapping)
+
+        def zrem(self, key, token):
+            del leases[token]
+
+    class Redis(object):
+        exceptions = type("exceptions", (), {"RedisError": Exception})
+        Redis = type("Redis", (), {"from_url": staticmethod(lambda url: Client())})
+    monkeypatch.setattr(scheduler, "redis", Redis)
+
+    server = stub(ok)
+    sched = scheduler.Scheduler({"redis": "redis://", "lease": 0.3})
+    with sched.post(server.endpoint, "q", stream=True) as r:
+        [token] = leases
+        first = leases[token]
+        # Longer than the lease to read the response
+        time.sleep(0.5)
+        assert leases[token] > first
+        r.content
+    assert len(renewals) >= 2
+    assert leases == {}
+    time.sleep(0.2)
+    # No more renewals once it has been given up
+    count = len(renewals)
+    time.sleep(0.2)
+    assert len(renewals) == count
@@ -0,0 +1,62 @@
+import numpy as np
+
+import simplify
+
+
+# Textbook recursive Douglas-Peucker, keeping the first of the
+# furthest points, to check the batched version against
+def douglas_peucker(points, tolerance):
+    if len(points) < 3:
+        return points
+    a = points[0]
+    ab = points[-1] - a
+    length2 = ab.dot(ab)
+    furthest = 0
+    index = 0
+    for i in range(1, len(points) - 1):
+        ap = points[i] - a
+        t = 0 if length2 == 0 else min(max(ap.dot(ab) / length2, 0), 1)
+        off = ap - t * ab
+        if off.dot(off) > furthest:
+            furthest = off.dot(off)
+            index = i
+    if furthest <= tolerance * tolerance:
+        return points[[0, -1]]
+    return np.concatenate((douglas_peucker(points[:index + 1], tolerance)[:-1],
+                           douglas_peucker(points[index:], tolerance)))
+
+
+LINES = [
+    np.array([[0, 0], [1, 0.1], [2, -0.1], [3, 5], [4, 6], [5, 7], [6, 8.1], [7, 9]], dtype=float),
+    # A zigzag, only some of whose corners are out of tolerance
+    np.array([[0, 0], [1, 1], [2, 0], [3, 0.3], [4, 0], [5, 2], [6, 0]], dtype=float),
+    # Straight, so only the ends are left
+    np.array([[0, 0], [1, 1], [2, 2], [3, 3]], dtype=float),
+    # Two points, and doubling back on itself
+    np.array([[0, 0], [1, 1]], dtype=float),
+    np.array([[0, 0], [4, 0], [2, 0.2], [1, 0]], dtype=float),
+    # A closed ring
+    np.array([[0, 0], [2, 0.1], [4, 0], [4, 4], [2, 4.2], [0, 4], [0, 0]], dtype=float),
+]
+
+
+def test_fixed_lines():
+    for tolerance in [0.05, 0.15, 0.5, 1.5]:
+        found = simplify.simplify(LINES, tolerance)
+        assert len(found) == len(LINES)
+        for line, simplified in zip(LINES, found):
+            assert np.array_equal(simplified, douglas_peucker(line, tolerance))
+
+
+def test_scale():
+    # Measured with the columns scaled, but the points are given back
+    # as they were
+    line = np.array([[0, 0], [1, 0.5], [2, 0]], dtype=float)
+    assert np.array_equal(simplify.simplify([line], 0.6)[0], line[[0, 2]])
+    assert np.array_equal(simplify.simplify([line], 0.6, scale=(1, 2))[0], line)
+
+
+def test_small_ring_kept():
+    # A ring that would be left with fewer than four points is kept whole
+    ring = np.array([[0, 0], [1, 0.01], [2, 0], [1, -0.01], [0, 0]], dtype=float)
+    assert np.array_equal(simplify.simplify([ring], 0.1)[0], ring)
@@ -0,0 +1,210 @@
+import io
+import os
+import re
+import time
+import fcntl
+import zipfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pytest
+
+import srtm
+
+
+SAMPLES = 41
+
+
+# A tile of a round hill centred at lat, lon, as srtm.load_tile reads it
+def hill(datadir, grid, lat, lon):
+    top = int(grid[1:3]) + 1
+    left = -int(grid[4:]) if grid[3] == "W" else int(grid[4:])
+    row, col = np.mgrid[0:SAMPLES, 0:SAMPLES] / (SAMPLES - 1)
+    distance = np.hypot(top - row - lat, left + col - lon)
+    np.save(os.path.join(datadir, grid + ".npy"), (500 - 1000 * distance).astype(np.int16))
+
+
+def test_contour_across_tiles_is_one_line(tmp_path):
+    hill(str(tmp_path), "N50W001", 51.0, -0.5)
+    hill(str(tmp_path), "N51W001", 51.0, -0.5)
+    config = {"options": {"datadir": str(tmp_path)}, "data": {"samples": SAMPLES}}
+    lines = {}
+    for tags, line in srtm.contour_lines(config, 100, 50.2, -0.9, 51.8, -0.1):
+        lines.setdefault(tags["ele"], []).append(line)
+    for height in ["100", "200", "300", "400"]:
+        found = lines[height]
+        # Each is a ring round the hill, crossing the edge of the tiles
+        assert len(found) == 1
+        assert np.array_equal(found[0][0], found[0][-1])
+        assert found[0][:, 0].min() < 51.0 < found[0][:, 0].max()
+
+
+def test_join_lines():
+    a = np.array([[0.0, 0.0], [1.0, 0.0]])
+    b = np.array([[1.0, 0.0], [1.0, 1.0]])
+    c = np.array([[1.0, 1.0], [0.0, 0.0]])
+    d = np.array([[5.0, 5.0], [6.0, 6.0]])
+    joined = srtm.join_lines([b, d, c, a])
+    assert len(joined) == 2
+    assert np.array_equal(joined[0], [[1.0, 0.0], [1.0, 1.0], [0.0, 0.0], [1.0, 0.0]])
+    assert np.array_equal(joined[1], d)
+
+
+# A tile of random heights, as the big endian .hgt in a zip
+def hgt_zip(samples):
+    heights = np.random.default_rng(1).integers(-500, 3000, (samples, samples)).astype(">i2")
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("N51W001.hgt", heights.tobytes())
+    return heights, data.getvalue()
+
+
+# Serves the tile's zip, with Range requests.  The first cut responses
+# stop after cut_at bytes of the body, as if the connection dropped
+class Tiles(object):
+
+    def __init__(self, data, cuts=0, cut_at=None, delay=0):
+        self.data = data
+        self.cuts = cuts
+        self.cut_at = cut_at
+        self.delay = delay
+        self.ranges = []
+        tiles = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(tiles.delay)
+                start = 0
+                if "Range" in self.headers:
+                    start = int(re.match(r"bytes=(\d+)-", self.headers["Range"]).group(1))
+                    tiles.ranges.append(start)
+                    if start >= len(tiles.data):
+                        self.send_response(416)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                        start, len(tiles.data) - 1, len(tiles.data)))
+                else:
+                    tiles.ranges.append(None)
+                    self.send_response(200)
+                body = tiles.data[start:]
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if tiles.cuts > 0:
+                    tiles.cuts -= 1
+                    body = body[:tiles.cut_at - start]
+                    self.close_connection = True
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def tiles(tmp_path, monkeypatch):
+    # Small chunks so that some of the tile arrives before the cut
+    monkeypatch.setattr(srtm, "CHUNK_SIZE", 4096)
+    servers = []
+    heights, data = hgt_zip(201)
+
+    def start(**kwargs):
+        servers.append(Tiles(data, **kwargs))
+        credentials = tmp_path / "credentials.yaml"
+        credentials.write_text("username: user\npassword: secret\n")
+        config = {"options": {"datadir": str(tmp_path), "credentials": str(credentials)},
+                  "data": {"samples": 201, "retries": 2, "url_template":
+                           "http://127.0.0.1:{}/<GRID>.SRTMGL1.hgt.zip".format(
+                               servers[-1].server.server_port)}}
+        return servers[-1], config, heights, data
+    yield start
+    for server in servers:
+        server.close()
+
+
+def saved(config):
+    return np.load(os.path.join(config["options"]["datadir"], "N51W001.npy"))
+
+
+def test_fetch_resumed_after_cut(tiles):
+    server, config, heights, data = tiles(cuts=1, cut_at=30000)
+    assert srtm.fetch_tile(config, "N51W001") is True
+    # Carried on from the last whole chunk before the cut
+    assert server.ranges[0] is None
+    assert 0 < server.ranges[1] <= 30000
+    assert len(server.ranges) == 2
+    assert saved(config).tobytes() == heights.astype(np.int16).tobytes()
+    assert not any(name.endswith(".part") for name in os.listdir(config["options"]["datadir"]))
+
+
+def test_fetch_gives_up_keeping_part(tiles):
+    server, config, heights, data = tiles(cuts=10, cut_at=30000)
+    assert srtm.fetch_tile(config, "N51W001") is None
+    partfile = os.path.join(config["options"]["datadir"], "N51W001.SRTMGL1.hgt.zip.part")
+    part = open(partfile, "rb").read()
+    assert 0 < len(part) <= 30000
+    assert part == data[:len(part)]
+
+    # The next run carries on from the part, and the tile comes out
+    # the same as if it had been downloaded in one go
+    server.cuts = 0
+    server.ranges = []
+    assert srtm.fetch_tile(config, "N51W001") is True
+    assert server.ranges == [len(part)]
+    assert saved(config).tobytes() == heights.astype(np.int16).tobytes()
+    assert not os.path.exists(partfile)
+
+
+def test_fetch_restarts_on_416(tiles):
+    # A part from a longer file than is there now can't be carried on
+    server, config, heights, data = tiles()
+    partfile = os.path.join(config["options"]["datadir"], "N51W001.SRTMGL1.hgt.zip.part")
+    with open(partfile, "wb") as f:
+        f.write(b"x" * (len(data) + 10))
+    assert srtm.fetch_tile(config, "N51W001") is True
+    assert server.ranges == [len(data) + 10, None]
+    assert saved(config).tobytes() == heights.astype(np.int16).tobytes()
+    assert not os.path.exists(partfile)
+
+
+def test_fetch_waits_for_lock_and_reuses(tiles):
+    # Another worker holds the tile's lock while it downloads it
+    server, config, heights, data = tiles()
+    datadir = config["options"]["datadir"]
+    lock = open(os.path.join(datadir, "N51W001.lock"), "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(srtm.fetch_tile(config, "N51W001")))
+    thread.start()
+    time.sleep(0.3)
+    assert results == []
+
+    np.save(os.path.join(datadir, "N51W001.npy"), heights.astype(np.int16))
+    lock.close()
+    thread.join(10)
+    assert results == [True]
+    assert server.ranges == []
+
+
+def test_fetch_same_tile_at_once(tiles):
+    server, config, heights, data = tiles(delay=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(srtm.fetch_tile(config, "N51W001")))
+               for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert results == [True, True, True]
+    assert server.ranges == [None]
+    assert saved(config).tobytes() == heights.astype(np.int16).tobytes()